@@ -24,11 +24,10 @@ csrf = CSRFProtect()
 migrate = Migrate()
 limiter = Limiter(
     key_func=get_remote_address,
-    default_limits=["200 per day"],
-    storage_uri="memory://"
+    default_limits=["200 per day"]
 )
 
-def create_app():
+def create_app(config=None):
     app = Flask(__name__)
     app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY')
     app.config['QR_HMAC_SECRET_KEY'] = os.environ.get('QR_HMAC_SECRET_KEY')
@@ -52,24 +51,128 @@ def create_app():
     app.config['PAYER_FEE_LINK_PERCENT'] = float(os.environ.get('PAYER_FEE_LINK_PERCENT', 0.10)) # 10%
     app.config['PAYER_FEE_QR_PERCENT'] = float(os.environ.get('PAYER_FEE_QR_PERCENT', 0.07)) # 7%
     app.config['PAYER_FEE_TRANSFER_PERCENT'] = float(os.environ.get('PAYER_FEE_TRANSFER_PERCENT', 0.07)) # 7%
+
+    # Number of fee accumulator rows; more shards means less lock contention on fee credits
+    app.config['FEE_SHARD_COUNT'] = int(os.environ.get('FEE_SHARD_COUNT', 8))
+    # Rows the admin dashboard totals are spread over (app/stats.py); `flask recompute-stats` corrects any drift
+    app.config['STATS_SHARD_COUNT'] = int(os.environ.get('STATS_SHARD_COUNT', 8))
+    # Rows each hourly/daily revenue bucket is spread over (app/revenue.py), so fee-paying commits do not queue on one row
+    app.config['REVENUE_SHARD_COUNT'] = int(os.environ.get('REVENUE_SHARD_COUNT', 8))
+
+    # Webhook delivery queue. Set WEBHOOK_INPROCESS_WORKER=false when running `flask webhook-worker` separately.
+    app.config['WEBHOOK_INPROCESS_WORKER'] = os.environ.get('WEBHOOK_INPROCESS_WORKER', 'true').lower() in ['true', '1', 't']
+    app.config['WEBHOOK_WORKERS'] = int(os.environ.get('WEBHOOK_WORKERS', 8))
+    app.config['WEBHOOK_PER_MERCHANT_CONCURRENCY'] = int(os.environ.get('WEBHOOK_PER_MERCHANT_CONCURRENCY', 2))
+    app.config['WEBHOOK_TIMEOUT'] = float(os.environ.get('WEBHOOK_TIMEOUT', 5)) # seconds
+    app.config['WEBHOOK_MAX_ATTEMPTS'] = int(os.environ.get('WEBHOOK_MAX_ATTEMPTS', 8))
+    app.config['WEBHOOK_BACKOFF_BASE'] = float(os.environ.get('WEBHOOK_BACKOFF_BASE', 10)) # seconds, doubled per attempt
+    app.config['WEBHOOK_BACKOFF_MAX'] = float(os.environ.get('WEBHOOK_BACKOFF_MAX', 3600)) # seconds
+    app.config['WEBHOOK_POLL_INTERVAL'] = float(os.environ.get('WEBHOOK_POLL_INTERVAL', 5)) # seconds
+    app.config['WEBHOOK_BATCH_SIZE'] = int(os.environ.get('WEBHOOK_BATCH_SIZE', 50))
+
+    # PENDING payments older than this become EXPIRED (app/payment_expiry.py); signed links already die after 10 minutes.
+    # Run `flask expire-payments` from cron, or set PAYMENT_EXPIRY_INPROCESS_SWEEPER=true to sweep in every web worker.
+    app.config['PAYMENT_EXPIRY_MINUTES'] = int(os.environ.get('PAYMENT_EXPIRY_MINUTES', 30))
+    app.config['PAYMENT_EXPIRY_BATCH_SIZE'] = int(os.environ.get('PAYMENT_EXPIRY_BATCH_SIZE', 500)) # rows per transaction
+    app.config['PAYMENT_EXPIRY_INPROCESS_SWEEPER'] = os.environ.get('PAYMENT_EXPIRY_INPROCESS_SWEEPER', 'false').lower() in ['true', '1', 't']
+    app.config['PAYMENT_EXPIRY_INTERVAL'] = float(os.environ.get('PAYMENT_EXPIRY_INTERVAL', 60)) # seconds between sweeps
+    app.config['PAYMENT_EXPIRY_MAX_BATCHES'] = int(os.environ.get('PAYMENT_EXPIRY_MAX_BATCHES', 20)) # per sweep, so a backlog is worked off gradually
+    # Queue a payment.expired webhook (status EXPIRED) for merchants with a webhook URL
+    app.config['PAYMENT_EXPIRY_WEBHOOKS'] = os.environ.get('PAYMENT_EXPIRY_WEBHOOKS', 'false').lower() in ['true', '1', 't']
+    # Rendered QR images (app/qr_cache.py), cached by content until their payload expires
+    app.config['QR_CACHE_SIZE'] = int(os.environ.get('QR_CACHE_SIZE', 512)) # images per process; 0 disables the cache
+    app.config['QR_RENDER_PROCESSES'] = int(os.environ.get('QR_RENDER_PROCESSES', 2)) # renderer pool size; 0 renders in the request thread
+    app.config['QR_RENDER_TIMEOUT'] = float(os.environ.get('QR_RENDER_TIMEOUT', 10)) # seconds to wait for a render
     
-    app.config['MAIL_SERVER'] = 'smtp.gmail.com'
-    app.config['MAIL_PORT'] = 587
-    app.config['MAIL_USE_TLS'] = True
+    app.config['MAIL_SERVER'] = os.environ.get('MAIL_SERVER', 'smtp.gmail.com')
+    app.config['MAIL_PORT'] = int(os.environ.get('MAIL_PORT', 587))
+    app.config['MAIL_USE_TLS'] = os.environ.get('MAIL_USE_TLS', 'true').lower() in ['true', '1', 't']
     app.config['MAIL_USERNAME'] = os.environ.get('MAIL_USERNAME')
     app.config['MAIL_PASSWORD'] = os.environ.get('MAIL_PASSWORD')
     app.config['ADMIN_EMAIL'] = os.environ.get('ADMIN_EMAIL')
 
+    # Email outbox sender pool. Set MAIL_OUTBOX_INPROCESS_WORKER=false when running `flask mail-worker` separately.
+    app.config['MAIL_OUTBOX_INPROCESS_WORKER'] = os.environ.get('MAIL_OUTBOX_INPROCESS_WORKER', 'true').lower() in ['true', '1', 't']
+    app.config['MAIL_OUTBOX_WORKERS'] = int(os.environ.get('MAIL_OUTBOX_WORKERS', 2)) # One SMTP connection each
+    app.config['MAIL_OUTBOX_IDLE_TIMEOUT'] = float(os.environ.get('MAIL_OUTBOX_IDLE_TIMEOUT', 30)) # seconds an idle SMTP connection is kept
+    app.config['MAIL_OUTBOX_POLL_INTERVAL'] = float(os.environ.get('MAIL_OUTBOX_POLL_INTERVAL', 5)) # seconds
+    app.config['MAIL_OUTBOX_MAX_ATTEMPTS'] = int(os.environ.get('MAIL_OUTBOX_MAX_ATTEMPTS', 5))
+    app.config['MAIL_RATE_PER_DOMAIN_PER_MINUTE'] = int(os.environ.get('MAIL_RATE_PER_DOMAIN_PER_MINUTE', 60))
+
+    # Decrypted API credential cache used by require_api_auth (per process)
+    app.config['API_CREDENTIAL_CACHE_SIZE'] = int(os.environ.get('API_CREDENTIAL_CACHE_SIZE', 1024))
+    app.config['API_CREDENTIAL_CACHE_TTL'] = float(os.environ.get('API_CREDENTIAL_CACHE_TTL', 60)) # seconds; 0 disables the cache
+
+    # bcrypt cost per secret type (see `flask benchmark-hashing`). Hashes with another cost are upgraded on the next successful check.
+    app.config['BCRYPT_COST_PASSWORD'] = int(os.environ.get('BCRYPT_COST_PASSWORD', 12))
+    app.config['BCRYPT_COST_PIN'] = int(os.environ.get('BCRYPT_COST_PIN', 12))
+    app.config['BCRYPT_COST_OTP'] = int(os.environ.get('BCRYPT_COST_OTP', 8)) # OTPs expire after 10 minutes and are rate limited
+    # Threads for bcrypt work so gthread/gevent workers are not blocked by it; 0 hashes on the request thread
+    app.config['HASHING_WORKERS'] = int(os.environ.get('HASHING_WORKERS', 0))
+    app.config['HASHING_MAX_PENDING'] = int(os.environ.get('HASHING_MAX_PENDING', 64)) # queued hashes before callers wait
+
+    # Optional "PIN verified for N minutes" window for payments (see app/pin_session.py); 0 disables it
+    app.config['PIN_SESSION_MINUTES'] = int(os.environ.get('PIN_SESSION_MINUTES', 5))
+    app.config['PIN_SESSION_MAX_AMOUNT'] = int(os.environ.get('PIN_SESSION_MAX_AMOUNT', 5000000)) # cents per payment; Rp 50,000.00
+
+    # Cached identity (id, email, admin/ban state, balance) behind current_user, per process.
+    # Local changes invalidate it on commit; other workers see them after at most the TTL.
+    app.config['IDENTITY_CACHE_SIZE'] = int(os.environ.get('IDENTITY_CACHE_SIZE', 4096))
+    app.config['IDENTITY_CACHE_TTL'] = float(os.environ.get('IDENTITY_CACHE_TTL', 5)) # seconds; 0 disables the cache
+
+    # Rate limit counters shared by every worker on the host (app/rate_limit.py); memory:// keeps them per process.
+    # Workers lease RATELIMIT_LEASE_FRACTION of a limit at a time, so most hits are checked without touching the file.
+    app.config['RATELIMIT_STORAGE_URI'] = os.environ.get(
+        'RATELIMIT_STORAGE_URI', 'sqlite:///' + os.path.join(app.instance_path, 'ratelimit.sqlite')
+    )
+    app.config['RATELIMIT_STRATEGY'] = os.environ.get('RATELIMIT_STRATEGY', 'sliding-window-counter')
+    app.config['RATELIMIT_STORAGE_OPTIONS'] = {
+        'lease_fraction': float(os.environ.get('RATELIMIT_LEASE_FRACTION', 0.05))
+    }
+
+    # Replay protection for signed API requests (X-REQUEST-NONCE). Use a redis:// URI to share nonces between workers.
+    app.config['API_NONCE_STORAGE_URI'] = os.environ.get('API_NONCE_STORAGE_URI', 'memory://')
+    app.config['API_NONCE_MAX_ENTRIES'] = int(os.environ.get('API_NONCE_MAX_ENTRIES', 200000)) # memory:// only
+    app.config['API_REQUIRE_NONCE'] = os.environ.get('API_REQUIRE_NONCE', 'false').lower() in ['true', '1', 't']
+
+    # Money-moving views re-run on deadlocks/serialization failures (see app/unit_of_work.py)
+    app.config['DB_RETRY_MAX_ATTEMPTS'] = int(os.environ.get('DB_RETRY_MAX_ATTEMPTS', 4)) # total attempts, including the first
+    app.config['DB_RETRY_BASE_DELAY'] = float(os.environ.get('DB_RETRY_BASE_DELAY', 0.02)) # seconds, doubled per retry
+    app.config['DB_RETRY_MAX_DELAY'] = float(os.environ.get('DB_RETRY_MAX_DELAY', 0.5)) # seconds
+
+    # Lock wait timing for row-locking statements, shown on /admin/locks (per process)
+    app.config['LOCK_STATS_ENABLED'] = os.environ.get('LOCK_STATS_ENABLED', 'true').lower() in ['true', '1', 't']
+    app.config['LOCK_STATS_HOT_ROWS'] = int(os.environ.get('LOCK_STATS_HOT_ROWS', 256)) # rows tracked for the hot-row list
+
+    # Opt-in per-request SQL profiling: Server-Timing headers and /admin/sql-profile (per process)
+    app.config['SQL_PROFILER_ENABLED'] = os.environ.get('SQL_PROFILER_ENABLED', 'false').lower() in ['true', '1', 't']
+    app.config['SQL_PROFILER_WINDOW'] = int(os.environ.get('SQL_PROFILER_WINDOW', 500)) # recent requests kept per endpoint
+    app.config['SQL_PROFILER_SLOW_STATEMENTS'] = int(os.environ.get('SQL_PROFILER_SLOW_STATEMENTS', 5)) # slowest statements kept per request
+
+    # Maximum number of items accepted by the batch API endpoints
+    app.config['API_BATCH_MAX_ITEMS'] = int(os.environ.get('API_BATCH_MAX_ITEMS', 1000))
+
     # VAPID keys for push notifications
     app.config['VAPID_PUBLIC_KEY'] = os.environ.get('VAPID_PUBLIC_KEY')
     app.config['VAPID_PRIVATE_KEY'] = os.environ.get('VAPID_PRIVATE_KEY')
     app.config['VAPID_CLAIM_EMAIL'] = os.environ.get('ADMIN_EMAIL') # Use admin email for claim
 
+    # Background push dispatcher
+    app.config['PUSH_WORKERS'] = int(os.environ.get('PUSH_WORKERS', 8))
+    app.config['PUSH_QUEUE_SIZE'] = int(os.environ.get('PUSH_QUEUE_SIZE', 10000))
+    app.config['PUSH_BATCH_SIZE'] = int(os.environ.get('PUSH_BATCH_SIZE', 50))
+    app.config['PUSH_TIMEOUT'] = float(os.environ.get('PUSH_TIMEOUT', 10)) # seconds
+
+    # Overrides for the environment settings above (e.g. the throwaway app of `flask check-query-budget`)
+    if config:
+        app.config.update(config)
+
     db.init_app(app)
     login_manager.init_app(app)
     bcrypt.init_app(app)
     mail.init_app(app)
     csrf.init_app(app)
+    from . import rate_limit  # registers the sqlite:// rate limit storage
     limiter.init_app(app)
     migrate.init_app(app, db)
 
@@ -118,6 +221,10 @@ def create_app():
         permissions_policy={'clipboard-write': '*'}
     )
 
+    # Registered before the other hooks so the user/ban lookups are profiled too
+    from .sql_profiler import init_sql_profiler
+    init_sql_profiler(app)
+
     login_manager.login_view = 'auth.login'
     login_manager.login_message_category = 'info'
 
@@ -129,6 +236,14 @@ def create_app():
                 flash('Akun Anda telah diblokir. Silakan hubungi support untuk informasi lebih lanjut.', 'danger')
                 return redirect(url_for('auth.login'))
 
+    if app.config['PAYMENT_EXPIRY_INPROCESS_SWEEPER']:
+        from .payment_expiry import get_expiry_sweeper
+
+        @app.before_request
+        def start_payment_expiry_sweeper():
+            # Started on first use so it runs in each forked worker, not in a preloading master
+            get_expiry_sweeper().start()
+
     from .routes import main_bp
     app.register_blueprint(main_bp)
 
@@ -1,12 +1,25 @@
 from functools import wraps
 from datetime import datetime, timedelta
-from flask import Blueprint, render_template, flash, redirect, url_for, abort, request
+from flask import Blueprint, render_template, flash, redirect, url_for, abort, request, jsonify, current_app, Response
 from flask_login import login_required, current_user, logout_user
-from . import db, bcrypt
-from .models import User, Transaction, APIKey
+from . import db, ledger
+from .models import User, JournalEntry, JournalLeg, APIKey
+from .journal import record_entry, leg_query
+from .unit_of_work import unit_of_work, should_retry, get_retry_stats
+from .lock_stats import get_lock_stats
+from .sql_profiler import get_profiler_stats
+from .credentials import invalidate_api_key, invalidate_owner
+from .hashing import verify_pin
+from .pin_session import revoke_pin_windows
+from .user_search import search_users
+from .revenue import revenue_series, PERIODS, DEFAULT_BUCKETS, SOURCES, SIDES
+from .stats import get_dashboard_stats, recompute_stats, add_stat_delta
+from .fees import combined_system_balance, system_balance_with_fees, pending_fee_total, roll_up_fees, get_system_user_id
 from decimal import Decimal
+from sqlalchemy.exc import NoResultFound
+import csv
+import io
 from .forms import ModifyBalanceForm, ManageBanForm, DeleteUserForm, WithdrawRevenueForm
-from sqlalchemy import func
 
 admin_bp = Blueprint('admin', __name__)
 
@@ -23,20 +36,26 @@ def admin_required(f):
 @admin_bp.route('/dashboard')
 @admin_required
 def dashboard():
-    user_count = User.query.count()
-    total_balance = db.session.query(func.sum(User.balance)).scalar() or 0
-    total_transactions = Transaction.query.count()
-    recent_transactions = Transaction.query.order_by(Transaction.timestamp.desc()).limit(5).all()
+    # Totals are kept up to date on every commit (app/stats.py) instead of counting whole tables
+    stats = get_dashboard_stats()
+    if stats is None:
+        stats = recompute_stats()
+        db.session.commit()
+    recent_transactions = leg_query().order_by(JournalLeg.id.desc()).limit(5).all()
     
-    system_user = User.query.filter_by(email='sistem@gabutpay.com').first()
-    system_revenue_balance = system_user.balance if system_user else 0
+    try:
+        system_revenue_balance = system_balance_with_fees() or 0
+    except NoResultFound:
+        system_revenue_balance = 0
     
     return render_template(
         'admin_dashboard.html', 
         title='Admin Dashboard', 
-        user_count=user_count,
-        total_balance=total_balance,
-        total_transactions=total_transactions,
+        user_count=stats.user_count,
+        total_balance=stats.total_balance,
+        total_transactions=stats.journal_leg_count,
+        stats_updated_at=stats.updated_at,
+        stats_recomputed_at=stats.recomputed_at,
         recent_transactions=recent_transactions,
         system_revenue_balance=system_revenue_balance
     )
@@ -44,25 +63,18 @@ def dashboard():
 @admin_bp.route('/users')
 @admin_required
 def users():
-    page = request.args.get('page', 1, type=int)
     search_query = request.args.get('search', '')
-    
-    query = User.query
-    if search_query:
-        search_term = f"%{search_query}%"
-        query = query.filter(
-            db.or_(
-                User.email.ilike(search_term),
-                User.id.ilike(search_term)
-            )
-        )
-        
-    all_users = query.order_by(User.created_at.desc()).paginate(page=page, per_page=15)
+    after = request.args.get('after', type=int)
+    users, next_cursor, match = search_users(search_query, after)
     
     return render_template(
         'admin_users.html', 
         title='Kelola Pengguna', 
-        users=all_users,
+        users=users,
+        next_cursor=next_cursor,
+        is_first_page=after is None,
+        search_query=search_query,
+        match=match,
         now=datetime.utcnow
     )
 
@@ -85,6 +97,7 @@ def edit_user(user_id):
 
 @admin_bp.route('/user/<int:user_id>/modify-balance', methods=['POST'])
 @admin_required
+@unit_of_work
 def modify_balance(user_id):
     user = User.query.get_or_404(user_id)
     form = ModifyBalanceForm()
@@ -93,20 +106,20 @@ def modify_balance(user_id):
         amount_in_cents = int(amount * 100)
         reason = form.reason.data
 
-        user.balance += amount_in_cents
+        try:
+            if amount_in_cents < 0:
+                ledger.debit_user(user.id, -amount_in_cents)
+            else:
+                ledger.credit_user(user.id, amount_in_cents)
+        except ledger.InsufficientFunds:
+            db.session.rollback()
+            flash(f'Saldo {user.email} tidak mencukupi untuk pengurangan ini.', 'danger')
+            return redirect(url_for('admin.edit_user', user_id=user_id))
         
-        tx_type = 'ADMIN_CREDIT' if amount_in_cents > 0 else 'ADMIN_DEBIT'
+        leg_type = JournalLeg.ADMIN_CREDIT if amount_in_cents > 0 else JournalLeg.ADMIN_DEBIT
         
         # Consistent with other parts: Debit is negative, Credit is positive
-        tx_amount = amount_in_cents
-
-        adj_tx = Transaction(
-            user_id=user.id,
-            transaction_type=tx_type,
-            amount=tx_amount,
-            description=f'Admin: {reason}'
-        )
-        db.session.add(adj_tx)
+        record_entry([(user.id, leg_type, amount_in_cents, None)], reference=reason)
         db.session.commit()
         flash(f'Saldo untuk {user.email} berhasil diubah.', 'success')
     else:
@@ -131,6 +144,7 @@ def manage_ban(user_id):
                 user.banned_until = datetime.utcnow() + timedelta(days=1)
             elif duration == 'permanent':
                 user.banned_until = datetime.utcnow() + timedelta(days=9999)
+            revoke_pin_windows(user.id)
             flash(f'{user.email} telah diblokir.', 'warning')
         db.session.commit()
     else:
@@ -148,10 +162,21 @@ def delete_user(user_id):
             return redirect(url_for('admin.edit_user', user_id=user_id))
 
         email = user_to_delete.email
-        # Reassign transactions to a system/deleted user or handle otherwise
-        Transaction.query.filter_by(user_id=user_to_delete.id).delete()
+        # The user's own journal legs go with the account; other people's legs keep their amounts
+        JournalLeg.query.filter_by(counterparty_id=user_to_delete.id).update({'counterparty_id': None}, synchronize_session=False)
+        entry_ids = [entry_id for (entry_id,) in db.session.query(JournalLeg.entry_id)
+                     .filter_by(account_id=user_to_delete.id).distinct()]
+        deleted_legs = JournalLeg.query.filter_by(account_id=user_to_delete.id).delete(synchronize_session=False)
+        add_stat_delta('journal_leg_count', -deleted_legs)
+        # Entries that were only this user's (bonuses, admin credits, key purchases) are now empty
+        if entry_ids:
+            JournalEntry.query.filter(
+                JournalEntry.id.in_(entry_ids),
+                ~JournalEntry.legs.any()
+            ).delete(synchronize_session=False)
         db.session.delete(user_to_delete)
         db.session.commit()
+        invalidate_owner(user_id)
 
         flash(f'Pengguna {email} dan semua datanya telah berhasil dihapus secara permanen.', 'success')
         return redirect(url_for('admin.users'))
@@ -163,15 +188,25 @@ def delete_user(user_id):
 @admin_required
 def revenue():
     page = request.args.get('page', 1, type=int)
+    period = request.args.get('period', 'day')
+    if period not in PERIODS:
+        period = 'day'
     system_user = User.query.filter_by(email='sistem@gabutpay.com').first()
     
     if not system_user:
         flash('Akun Kas Sistem tidak ditemukan. Harap restart aplikasi.', 'danger')
         return redirect(url_for('admin.dashboard'))
 
-    transactions = Transaction.query.filter_by(user_id=system_user.id)\
-        .order_by(Transaction.timestamp.desc())\
+    transactions = leg_query().filter(JournalLeg.account_id == system_user.id)\
+        .order_by(JournalLeg.id.desc())\
         .paginate(page=page, per_page=20)
+
+    # Fee revenue chart, read from the rollup tables only (app/revenue.py)
+    series = revenue_series(period, DEFAULT_BUCKETS[period])
+    revenue_totals = {}
+    for bucket in series:
+        for key, amount in bucket.amounts.items():
+            revenue_totals[key] = revenue_totals.get(key, 0) + amount
     
     form = WithdrawRevenueForm()
     
@@ -179,55 +214,150 @@ def revenue():
         'admin_revenue.html',
         title='Laporan Keuangan Sistem',
         system_user=system_user,
+        system_balance=combined_system_balance(system_user),
+        pending_fees=pending_fee_total(),
         transactions=transactions,
+        period=period,
+        revenue_series=series,
+        revenue_max=max(bucket.total for bucket in series) or 1,
+        revenue_totals=revenue_totals,
+        revenue_sources=SOURCES,
+        revenue_sides=SIDES,
         form=form
     )
 
+@admin_bp.route('/revenue.csv')
+@admin_required
+def revenue_csv():
+    period = request.args.get('period', 'day')
+    if period not in PERIODS:
+        abort(400)
+    buckets = min(max(request.args.get('buckets', DEFAULT_BUCKETS[period], type=int), 1), 1000)
+    columns = [(source, side) for source in SOURCES for side in SIDES]
+
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(['bucket_start_utc'] + [f'{source}_{side}' for source, side in columns] + ['total', 'fee_count'])
+    for bucket in revenue_series(period, buckets):
+        writer.writerow(
+            [bucket.start.isoformat(sep=' ')]
+            + [f'{Decimal(bucket.amounts.get(key, 0)) / 100:.2f}' for key in columns]
+            + [f'{Decimal(bucket.total) / 100:.2f}', bucket.fee_count]
+        )
+    return Response(
+        output.getvalue(),
+        mimetype='text/csv',
+        headers={'Content-Disposition': f'attachment; filename=pendapatan_{period}.csv'}
+    )
+
+@admin_bp.route('/locks')
+@admin_required
+def lock_stats():
+    stats = get_lock_stats().snapshot()
+    return render_template(
+        'admin_locks.html',
+        title='Statistik Lock Database',
+        stats=stats,
+        since=datetime.utcfromtimestamp(stats['since']),
+        retries=get_retry_stats().snapshot(),
+        enabled=current_app.config['LOCK_STATS_ENABLED']
+    )
+
+@admin_bp.route('/locks.json')
+@admin_required
+def lock_stats_json():
+    top_rows = request.args.get('top_rows', 20, type=int)
+    return jsonify({
+        'locks': get_lock_stats().snapshot(top_rows=top_rows),
+        'retries': get_retry_stats().snapshot()
+    })
+
+@admin_bp.route('/locks/reset', methods=['POST'])
+@admin_required
+def reset_lock_stats():
+    get_lock_stats().reset()
+    flash('Statistik lock di proses ini telah direset.', 'success')
+    return redirect(url_for('admin.lock_stats'))
+
+@admin_bp.route('/sql-profile')
+@admin_required
+def sql_profile():
+    stats = get_profiler_stats().snapshot()
+    return render_template(
+        'admin_sql_profile.html',
+        title='Profil Query SQL',
+        stats=stats,
+        since=datetime.utcfromtimestamp(stats['since']),
+        enabled=current_app.config['SQL_PROFILER_ENABLED']
+    )
+
+@admin_bp.route('/sql-profile.json')
+@admin_required
+def sql_profile_json():
+    return jsonify(get_profiler_stats().snapshot())
+
+@admin_bp.route('/sql-profile/reset', methods=['POST'])
+@admin_required
+def reset_sql_profile():
+    get_profiler_stats().reset()
+    flash('Profil query di proses ini telah direset.', 'success')
+    return redirect(url_for('admin.sql_profile'))
+
+@admin_bp.route('/rollup-fees', methods=['POST'])
+@admin_required
+@unit_of_work
+def rollup_fees():
+    try:
+        moved = roll_up_fees()
+        db.session.commit()
+        flash(f'Berhasil merekap biaya sebesar Rp {moved/100:,.2f} ke Akun Kas Sistem.', 'success')
+    except Exception as e:
+        db.session.rollback()
+        if should_retry(e):
+            raise
+        current_app.logger.error(f"Fee roll-up failed: {e}")
+        flash('Terjadi kesalahan internal saat merekap biaya.', 'danger')
+    return redirect(url_for('admin.revenue'))
+
 @admin_bp.route('/withdraw-revenue', methods=['POST'])
 @admin_required
+@unit_of_work
 def withdraw_revenue():
     form = WithdrawRevenueForm()
     if form.validate_on_submit():
         amount_to_withdraw = int(Decimal(form.amount.data) * 100)
         pin = form.pin.data
 
-        if not bcrypt.check_password_hash(current_user.pin_hash, pin):
+        if not verify_pin(current_user, pin):
             flash('PIN Keamanan Anda salah.', 'danger')
             return redirect(url_for('admin.revenue'))
 
         try:
-            system_user = db.session.query(User).filter_by(email='sistem@gabutpay.com').with_for_update().one()
-            admin_user = db.session.query(User).filter_by(id=current_user.id).with_for_update().one()
+            system_user_id = get_system_user_id()
+            admin_user = current_user
+            # Fold sharded fees in first so the whole revenue is withdrawable
+            roll_up_fees()
 
-            if system_user.balance < amount_to_withdraw:
-                flash('Saldo Akun Kas Sistem tidak mencukupi untuk penarikan ini.', 'danger')
+            # Perform the withdrawal (conditional debit of the system account)
+            try:
+                ledger.post(debits=[(system_user_id, amount_to_withdraw)], credits=[(admin_user.id, amount_to_withdraw)])
+            except ledger.InsufficientFunds:
                 db.session.rollback()
+                flash('Saldo Akun Kas Sistem tidak mencukupi untuk penarikan ini.', 'danger')
                 return redirect(url_for('admin.revenue'))
 
-            # Perform the withdrawal
-            system_user.balance -= amount_to_withdraw
-            admin_user.balance += amount_to_withdraw
-
-            # Create transaction records
-            withdrawal_tx = Transaction(
-                user_id=system_user.id,
-                transaction_type='SYSTEM_WITHDRAWAL',
-                amount=-amount_to_withdraw,
-                description=f'Penarikan dana ke akun admin {admin_user.email}'
-            )
-            deposit_tx = Transaction(
-                user_id=admin_user.id,
-                transaction_type='ADMIN_DEPOSIT',
-                amount=amount_to_withdraw,
-                description='Deposit dana dari Akun Kas Sistem'
-            )
-            
-            db.session.add_all([withdrawal_tx, deposit_tx])
+            # Journal entry
+            record_entry([
+                (system_user_id, JournalLeg.SYSTEM_WITHDRAWAL, -amount_to_withdraw, admin_user.id),
+                (admin_user.id, JournalLeg.ADMIN_DEPOSIT, amount_to_withdraw, system_user_id),
+            ])
             db.session.commit()
             flash(f'Berhasil menarik dana sebesar Rp {amount_to_withdraw/100:,.2f} dari Akun Kas Sistem.', 'success')
 
         except Exception as e:
             db.session.rollback()
+            if should_retry(e):
+                raise
             print(f"ERROR during revenue withdrawal: {e}")
             flash('Terjadi kesalahan internal saat penarikan dana.', 'danger')
     else:
@@ -241,6 +371,7 @@ def toggle_partner(user_id):
     user = User.query.get_or_404(user_id)
     user.is_partner = not user.is_partner
     db.session.commit()
+    invalidate_owner(user.id)
     status = "Partner" if user.is_partner else "Biasa"
     flash(f'Status {user.email} diubah menjadi {status}.', 'success')
     return redirect(url_for('admin.edit_user', user_id=user_id))
@@ -262,6 +393,7 @@ def update_inbound_config(key_id):
         return redirect(url_for('admin.edit_user', user_id=api_key.user_id))
 
     db.session.commit()
+    invalidate_api_key(api_key.public_key)
     flash(f'Konfigurasi Inbound untuk key {api_key.public_key} berhasil diperbarui.', 'success')
     return redirect(url_for('admin.edit_user', user_id=api_key.user_id))
 
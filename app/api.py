@@ -1,18 +1,27 @@
 import hmac
 import hashlib
 import time
+import uuid
 from functools import wraps
 from flask import Blueprint, request, jsonify, g, current_app, url_for
 from itsdangerous import URLSafeTimedSerializer
-from sqlalchemy import func
-from datetime import datetime, date
+from sqlalchemy import insert
 
-from . import db
-from .models import APIKey, User, Payment, Transaction, InboundLog
-from .utils import decrypt_data, generate_qr_code
+from . import db, ledger
+from .models import APIKey, User, Payment, JournalLeg, InboundLog
+from .journal import record_entry
+from .unit_of_work import unit_of_work, should_retry
+from .lock_stats import timed_lock
+from .utils import generate_qr_code
+from .credentials import load_credential
+from .inbound_usage import lock_daily_usage, record_usage
+from .nonces import get_nonce_store, NonceStoreFull, NONCE_PATTERN
 
 api_bp = Blueprint('api', __name__)
 
+# Seconds a signed request stays valid; nonces are remembered for the same window
+REQUEST_TIMESTAMP_TOLERANCE = 60
+
 # --- DECORATOR UNTUK OTENTIKASI API DENGAN SIGNATURE ---
 def require_api_auth(inbound_only=False):
     def decorator(f):
@@ -22,6 +31,7 @@ def require_api_auth(inbound_only=False):
             public_key = request.headers.get('X-PUBLIC-KEY')
             signature_header = request.headers.get('X-SIGNATURE')
             timestamp_header = request.headers.get('X-REQUEST-TIMESTAMP')
+            nonce_header = request.headers.get('X-REQUEST-NONCE')
 
             if not all([public_key, signature_header, timestamp_header]):
                 return jsonify({"error": "Missing required headers"}), 401
@@ -29,46 +39,68 @@ def require_api_auth(inbound_only=False):
             # 2. Validasi timestamp
             try:
                 timestamp = int(timestamp_header)
-                if abs(int(time.time()) - timestamp) > 60:
+                if abs(int(time.time()) - timestamp) > REQUEST_TIMESTAMP_TOLERANCE:
                     return jsonify({"error": "Timestamp is too old"}), 401
             except:
                 return jsonify({"error": "Invalid timestamp"}), 401
 
-            # 3. Cari API Key
-            api_key_entry = APIKey.query.filter_by(public_key=public_key).first()
-            if not api_key_entry:
+            if nonce_header is None and current_app.config['API_REQUIRE_NONCE']:
+                return jsonify({"error": "Missing required headers"}), 401
+            if nonce_header is not None and not NONCE_PATTERN.match(nonce_header):
+                return jsonify({"error": "Invalid nonce"}), 401
+
+            # 3. Cari API Key (dari cache kredensial, DB hanya saat miss)
+            try:
+                credential = load_credential(public_key)
+            except Exception as e:
+                current_app.logger.error(f"Failed to load API credential {public_key}: {e}")
+                return jsonify({"error": "Internal auth error"}), 500
+            if not credential:
                 return jsonify({"error": "Invalid API Key"}), 401
 
             # --- SECURITY CHECK: INBOUND ONLY ---
             if inbound_only:
-                if not api_key_entry.owner.is_partner or not api_key_entry.is_inbound_enabled:
+                if not credential.owner_is_partner or not credential.is_inbound_enabled:
                     return jsonify({"error": "This API Key is not authorized for inbound transfers"}), 403
                 
                 # --- SECURITY CHECK: IP WHITELISTING ---
-                if api_key_entry.allowed_ips:
-                    allowed_ips = [ip.strip() for ip in api_key_entry.allowed_ips.split(',')]
+                if credential.allowed_ips:
                     # Use request.access_route[0] to get real client IP if behind proxy
                     client_ip = request.access_route[0] if request.access_route else request.remote_addr
-                    if client_ip not in allowed_ips:
+                    if client_ip not in credential.allowed_ips:
                         current_app.logger.warning(f"Unauthorized IP {client_ip} tried to access Inbound API with key {public_key}")
                         return jsonify({"error": f"IP {client_ip} is not whitelisted"}), 403
 
             # 4. Validasi Signature (HMAC)
-            try:
-                decrypted_secret_bytes = decrypt_data(api_key_entry.secret_key_encrypted)
-                secret_key = decrypted_secret_bytes.decode('utf-8')
-            except:
-                return jsonify({"error": "Internal auth error"}), 500
-
             raw_body = request.get_data()
-            string_to_sign = f"{timestamp_header}.".encode('utf-8') + raw_body
-            expected_signature = hmac.new(secret_key.encode('utf-8'), string_to_sign, hashlib.sha256).hexdigest()
+            # The nonce is signed too, otherwise a replay could simply swap it
+            if nonce_header is not None:
+                string_to_sign = f"{timestamp_header}.{nonce_header}.".encode('utf-8') + raw_body
+            else:
+                string_to_sign = f"{timestamp_header}.".encode('utf-8') + raw_body
+            expected_signature = hmac.new(credential.secret_key, string_to_sign, hashlib.sha256).hexdigest()
 
             if not hmac.compare_digest(expected_signature, signature_header):
                 return jsonify({"error": "Invalid Signature"}), 401
 
-            g.merchant = api_key_entry.owner
-            g.api_key = api_key_entry
+            # 5. Tolak replay (hanya setelah signature valid, supaya nonce tidak bisa "dibakar" orang lain)
+            if nonce_header is not None:
+                try:
+                    is_new = get_nonce_store().add(f"{public_key}:{nonce_header}", timestamp + REQUEST_TIMESTAMP_TOLERANCE)
+                except NonceStoreFull:
+                    current_app.logger.error("API nonce store is full; rejecting signed request.")
+                    return jsonify({"error": "Service temporarily unavailable"}), 503
+                except Exception as e:
+                    current_app.logger.error(f"API nonce store error: {e}")
+                    return jsonify({"error": "Internal auth error"}), 500
+                if not is_new:
+                    current_app.logger.warning(f"Replayed request rejected for key {public_key}")
+                    return jsonify({"error": "Replayed request"}), 409
+
+            # Handlers only need the IDs; the rows are loaded (and locked) where they are used
+            g.api_credential = credential
+            g.merchant_id = credential.owner_id
+            g.api_key_id = credential.api_key_id
             return f(*args, **kwargs)
         return decorated_function
     return decorator
@@ -93,7 +125,7 @@ def create_payment():
 
     # Buat Payment record di database
     new_payment = Payment(
-        merchant_id=g.merchant.id,
+        merchant_id=g.merchant_id,
         amount=amount_in_cents,
         payment_method=payment_method.upper(), # Store method ('LINK' or 'QR')
         merchant_order_id=data['merchant_order_id'],
@@ -125,8 +157,99 @@ def create_payment():
             "payment_url": payment_url
         }), 201
 
+@api_bp.route('/payments/batch', methods=['POST'])
+@require_api_auth(inbound_only=False)
+def create_payments_batch():
+    """
+    Creates many payments in one signed request with a single multi-row INSERT.
+    QR images are not rendered here (their payload expires after 5 minutes);
+    QR items get a qr_page_url that renders the code when it is opened.
+    """
+    data = request.get_json(silent=True)
+    items = data.get('payments') if isinstance(data, dict) else None
+    if not isinstance(items, list) or not items:
+        return jsonify({"error": "Missing required field: payments (non-empty array)"}), 400
+
+    max_items = current_app.config['API_BATCH_MAX_ITEMS']
+    if len(items) > max_items:
+        return jsonify({"error": f"Too many payments in one batch (max {max_items})"}), 400
+
+    results = [None] * len(items)
+    rows = []
+    row_indexes = []
+    for index, item in enumerate(items):
+        error = _validate_payment_item(item)
+        if error:
+            results[index] = _batch_error(index, item, 400, error, id_field='merchant_order_id')
+            continue
+        payment_method = item.get('payment_method', 'link')
+        rows.append({
+            'payment_id': str(uuid.uuid4()),
+            'merchant_id': g.merchant_id,
+            'amount': int(item['amount']),
+            'payment_method': payment_method.upper(),
+            'merchant_order_id': item['merchant_order_id'],
+            'description': item.get('description', ''),
+            'redirect_url_success': item.get('redirect_url_success'),
+            'redirect_url_failure': item.get('redirect_url_failure')
+        })
+        row_indexes.append(index)
+
+    if rows:
+        try:
+            db.session.execute(insert(Payment), rows)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            current_app.logger.error(f"Failed to insert payment batch for merchant {g.merchant_id}: {e}")
+            return jsonify({"error": "Internal server error while creating payments"}), 500
+
+    # Same signature as Payment.get_signed_id(), without building a serializer per row
+    serializer = URLSafeTimedSerializer(current_app.config['SECRET_KEY'])
+    for index, row in zip(row_indexes, rows):
+        result = {
+            "index": index,
+            "merchant_order_id": row['merchant_order_id'],
+            "status": "CREATED",
+            "payment_id": row['payment_id']
+        }
+        if row['payment_method'] == 'QR':
+            result["qr_page_url"] = url_for('main.show_qr', payment_id=row['payment_id'], _external=True)
+        else:
+            signed_payment_id = serializer.dumps(row['payment_id'], salt='payment-url-salt')
+            result["payment_url"] = url_for('main.pay_page', signed_payment_id=signed_payment_id, _external=True)
+        results[index] = result
+
+    return jsonify({
+        "success": True,
+        "total": len(items),
+        "created": len(rows),
+        "failed": len(items) - len(rows),
+        "results": results
+    }), 201 if rows else 200
+
+def _validate_payment_item(item):
+    """Returns an error message for an invalid batch payment item, or None."""
+    if not isinstance(item, dict) or not all(k in item for k in ['amount', 'merchant_order_id']):
+        return "Missing required fields: amount, merchant_order_id"
+    try:
+        if int(item['amount']) <= 0:
+            raise ValueError()
+    except (ValueError, TypeError):
+        return "Invalid amount"
+    if not isinstance(item['merchant_order_id'], str) or not 0 < len(item['merchant_order_id']) <= 100:
+        return "Invalid merchant_order_id"
+    if item.get('payment_method', 'link') not in ('link', 'qr'):
+        return "Invalid payment_method (use 'link' or 'qr')"
+    for field, max_length in (('description', 255), ('redirect_url_success', 255), ('redirect_url_failure', 255)):
+        value = item.get(field)
+        if value is not None and (not isinstance(value, str) or len(value) > max_length):
+            return f"Invalid {field}"
+    return None
+
 @api_bp.route('/inbound-transfer', methods=['POST'])
 @require_api_auth(inbound_only=True)
+@unit_of_work
 def inbound_transfer():
     data = request.get_json()
     if not data or not all(k in data for k in ['amount', 'external_id', 'recipient_email']):
@@ -141,29 +264,24 @@ def inbound_transfer():
 
     external_id = data['external_id']
     recipient_email = data['recipient_email']
-    partner_id = g.merchant.id
-    api_key_id = g.api_key.id
+    partner_id = g.merchant_id
+    api_key_id = g.api_key_id
 
     try:
         # 1. LOCK API KEY to prevent daily limit race condition
-        api_key = db.session.query(APIKey).filter_by(id=api_key_id).with_for_update().one()
+        with timed_lock('api_key.lock', 'api_key', api_key_id):
+            api_key = db.session.query(APIKey).filter_by(id=api_key_id).with_for_update().one()
         
         # 2. FIND RECIPIENT
-        recipient_stub = User.query.filter_by(email=recipient_email).first()
-        if not recipient_stub:
+        recipient = User.query.filter_by(email=recipient_email).first()
+        if not recipient:
             return jsonify({"error": "Recipient user not found"}), 404
         
-        if recipient_stub.id == partner_id:
+        if recipient.id == partner_id:
             return jsonify({"error": "Cannot transfer to yourself"}), 400
 
-        # 3. CONSISTENT LOCKING ORDER to prevent Deadlock
-        # Always lock the smaller ID first
-        if partner_id < recipient_stub.id:
-            partner = db.session.query(User).filter_by(id=partner_id).with_for_update().one()
-            recipient = db.session.query(User).filter_by(id=recipient_stub.id).with_for_update().one()
-        else:
-            recipient = db.session.query(User).filter_by(id=recipient_stub.id).with_for_update().one()
-            partner = db.session.query(User).filter_by(id=partner_id).with_for_update().one()
+        # 3. PARTNER (no row lock: the balance is debited with a conditional UPDATE below)
+        partner = db.session.get(User, partner_id)
 
         # 4. STRICT IDEMPOTENCY CHECK
         existing_log = InboundLog.query.filter_by(partner_id=partner.id, external_id=external_id).first()
@@ -179,24 +297,17 @@ def inbound_transfer():
             else:
                 return jsonify({"error": "Conflict: external_id already exists with different data"}), 409
 
-        # 5. DAILY LIMIT CHECK (now safe due to APIKey lock)
-        today_start = datetime.combine(date.today(), datetime.min.time())
-        total_today = db.session.query(func.sum(InboundLog.amount)).filter(
-            InboundLog.api_key_id == api_key.id,
-            InboundLog.timestamp >= today_start,
-            InboundLog.status == 'SUCCESS'
-        ).scalar() or 0
-
-        if total_today + amount_in_cents > api_key.daily_limit:
+        # 5. DAILY LIMIT CHECK (counter row, safe due to APIKey lock)
+        usage = lock_daily_usage(api_key.id)
+        if usage.total_amount + amount_in_cents > api_key.daily_limit:
             return jsonify({"error": "Daily inbound limit exceeded for this API Key"}), 403
 
-        # 6. PARTNER BALANCE CHECK
-        if partner.balance < amount_in_cents:
+        # 6. PARTNER BALANCE CHECK + 7. EXECUTE TRANSFER (conditional debit, blind credit)
+        try:
+            ledger.post(debits=[(partner.id, amount_in_cents)], credits=[(recipient.id, amount_in_cents)])
+        except ledger.InsufficientFunds:
+            db.session.rollback()
             return jsonify({"error": "Insufficient partner balance"}), 403
-
-        # 7. EXECUTE TRANSFER
-        partner.balance -= amount_in_cents
-        recipient.balance += amount_in_cents
         
         # Create Inbound Log
         client_ip = request.access_route[0] if request.access_route else request.remote_addr
@@ -209,25 +320,13 @@ def inbound_transfer():
             request_ip=client_ip
         )
         db.session.add(inbound_log)
+        record_usage(usage, amount_in_cents)
 
-        # Create Transaction records for both sides
-        # Recipient side (Credit)
-        recipient_tx = Transaction(
-            user_id=recipient.id,
-            transaction_type='INBOUND_DEPOSIT',
-            amount=amount_in_cents,
-            description=f"Inbound top up dari {partner.email} (Ref: {external_id})",
-            counterparty_id=partner.id
-        )
-        # Partner side (Debit)
-        partner_tx = Transaction(
-            user_id=partner.id,
-            transaction_type='INBOUND_PAYMENT',
-            amount=-amount_in_cents,
-            description=f"Inbound payment ke {recipient.email} (Ref: {external_id})",
-            counterparty_id=recipient.id
-        )
-        db.session.add_all([recipient_tx, partner_tx])
+        # Journal entry for both sides: recipient credit, partner debit
+        record_entry([
+            (recipient.id, JournalLeg.INBOUND_DEPOSIT, amount_in_cents, partner.id),
+            (partner.id, JournalLeg.INBOUND_PAYMENT, -amount_in_cents, recipient.id),
+        ], reference=external_id)
 
         db.session.commit()
         
@@ -243,5 +342,158 @@ def inbound_transfer():
 
     except Exception as e:
         db.session.rollback()
+        if should_retry(e):
+            raise
         current_app.logger.error(f"FATAL Inbound Error: {e}")
         return jsonify({"error": "Internal server error during transfer"}), 500
+
+@api_bp.route('/inbound-transfer/batch', methods=['POST'])
+@require_api_auth(inbound_only=True)
+@unit_of_work
+def inbound_transfer_batch():
+    """
+    Processes many inbound transfers in one signed request and one DB transaction.
+    Each item is validated, checked for idempotency and applied independently;
+    the response lists a result per item in request order.
+    """
+    data = request.get_json(silent=True)
+    items = data.get('transfers') if isinstance(data, dict) else None
+    if not isinstance(items, list) or not items:
+        return jsonify({"error": "Missing required field: transfers (non-empty array)"}), 400
+
+    max_items = current_app.config['API_BATCH_MAX_ITEMS']
+    if len(items) > max_items:
+        return jsonify({"error": f"Too many transfers in one batch (max {max_items})"}), 400
+
+    partner_id = g.merchant_id
+    api_key_id = g.api_key_id
+
+    # 1. VALIDATE ITEMS (no DB work yet)
+    results = [None] * len(items)
+    valid = []  # (index, amount, external_id, recipient_email)
+    seen_external_ids = set()
+    for index, item in enumerate(items):
+        if not isinstance(item, dict) or not all(k in item for k in ['amount', 'external_id', 'recipient_email']):
+            results[index] = _batch_error(index, item, 400, "Missing required fields: amount, external_id, recipient_email")
+            continue
+        try:
+            amount_in_cents = int(item['amount'])
+            if amount_in_cents <= 0:
+                raise ValueError()
+        except (ValueError, TypeError):
+            results[index] = _batch_error(index, item, 400, "Invalid amount")
+            continue
+        external_id = str(item['external_id'])
+        if external_id in seen_external_ids:
+            results[index] = _batch_error(index, item, 409, "Conflict: external_id appears more than once in this batch")
+            continue
+        seen_external_ids.add(external_id)
+        valid.append((index, amount_in_cents, external_id, str(item['recipient_email'])))
+
+    try:
+        # 2. LOCK API KEY once for the whole batch (daily limit)
+        with timed_lock('api_key.lock', 'api_key', api_key_id):
+            api_key = db.session.query(APIKey).filter_by(id=api_key_id).with_for_update().one()
+
+        # 3. RESOLVE ALL RECIPIENTS IN ONE QUERY
+        emails = {email for _, _, _, email in valid}
+        recipient_ids = dict(db.session.query(User.email, User.id).filter(User.email.in_(emails)).all()) if emails else {}
+
+        # 4. LOAD PARTNER (no row locks; balances are posted in one go below)
+        partner = db.session.get(User, partner_id)
+        available_balance = partner.balance
+        total_debit = 0
+        credits = []
+
+        # 5. IDEMPOTENCY: load every previous log for these external IDs at once
+        existing_logs = {log.external_id: log for log in InboundLog.query.filter(
+            InboundLog.partner_id == partner_id,
+            InboundLog.external_id.in_([external_id for _, _, external_id, _ in valid])
+        ).all()} if valid else {}
+
+        usage = lock_daily_usage(api_key.id)
+        client_ip = request.access_route[0] if request.access_route else request.remote_addr
+        new_rows = []
+        succeeded = 0
+
+        # 6. APPLY ITEMS IN ORDER
+        for index, amount_in_cents, external_id, recipient_email in valid:
+            recipient_id = recipient_ids.get(recipient_email)
+            if recipient_id is None:
+                results[index] = _batch_error(index, items[index], 404, "Recipient user not found")
+                continue
+            if recipient_id == partner_id:
+                results[index] = _batch_error(index, items[index], 400, "Cannot transfer to yourself")
+                continue
+
+            existing_log = existing_logs.get(external_id)
+            if existing_log:
+                if existing_log.amount == amount_in_cents and existing_log.recipient_id == recipient_id:
+                    results[index] = {
+                        "index": index, "external_id": external_id, "status": "DUPLICATE", "code": 200,
+                        "message": "Transaction already processed (Idempotent)", "amount": existing_log.amount
+                    }
+                else:
+                    results[index] = _batch_error(index, items[index], 409, "Conflict: external_id already exists with different data")
+                continue
+
+            if usage.total_amount + amount_in_cents > api_key.daily_limit:
+                results[index] = _batch_error(index, items[index], 403, "Daily inbound limit exceeded for this API Key")
+                continue
+            if available_balance - total_debit < amount_in_cents:
+                results[index] = _batch_error(index, items[index], 403, "Insufficient partner balance")
+                continue
+
+            total_debit += amount_in_cents
+            credits.append((recipient_id, amount_in_cents))
+            record_usage(usage, amount_in_cents)
+
+            new_rows.append(InboundLog(
+                partner_id=partner_id,
+                api_key_id=api_key.id,
+                recipient_id=recipient_id,
+                external_id=external_id,
+                amount=amount_in_cents,
+                request_ip=client_ip
+            ))
+            record_entry([
+                (recipient_id, JournalLeg.INBOUND_DEPOSIT, amount_in_cents, partner_id),
+                (partner_id, JournalLeg.INBOUND_PAYMENT, -amount_in_cents, recipient_id),
+            ], reference=external_id)
+            results[index] = {
+                "index": index, "external_id": external_id, "status": "SUCCESS", "code": 201,
+                "amount": amount_in_cents, "recipient": recipient_email
+            }
+            succeeded += 1
+
+        # One conditional debit for the whole batch. It only fails if the partner
+        # spent money concurrently; every item is idempotent, so the batch can be retried.
+        try:
+            ledger.post(debits=[(partner_id, total_debit)], credits=credits)
+        except ledger.InsufficientFunds:
+            db.session.rollback()
+            return jsonify({"error": "Partner balance changed while processing the batch, please retry"}), 409
+
+        db.session.add_all(new_rows)
+        db.session.commit()
+
+        current_app.logger.info(f"SUCCESS Inbound batch: {succeeded}/{len(items)} transfers from {partner.email}")
+
+        return jsonify({
+            "success": True,
+            "total": len(items),
+            "succeeded": succeeded,
+            "failed": sum(1 for r in results if r['status'] == 'FAILED'),
+            "results": results
+        }), 200
+
+    except Exception as e:
+        db.session.rollback()
+        if should_retry(e):
+            raise
+        current_app.logger.error(f"FATAL Inbound Batch Error: {e}")
+        return jsonify({"error": "Internal server error during batch transfer"}), 500
+
+def _batch_error(index, item, code, message, id_field='external_id'):
+    item_id = item.get(id_field) if isinstance(item, dict) else None
+    return {"index": index, id_field: item_id, "status": "FAILED", "code": code, "error": message}
@@ -1,11 +1,13 @@
 import secrets
 from datetime import datetime, timedelta
-from threading import Thread
 from flask import Blueprint, render_template, redirect, url_for, flash, request, current_app
 from flask_login import login_user, logout_user, current_user, login_required
-from flask_mail import Message
-from . import db, bcrypt, mail, limiter
-from .models import User, Transaction
+from . import db, limiter, ledger
+from .models import User, JournalLeg
+from .journal import record_entry
+from .hashing import hash_secret, verify_secret, verify_password
+from .pin_session import revoke_current_pin_window, revoke_pin_windows
+from .outbox import queue_email
 from .forms import (
     RegistrationForm, LoginForm, OTPForm, ResetRequestForm, ResetTokenForm,
     ResetPINRequestForm, ResetPINTokenForm
@@ -13,18 +15,8 @@ from .forms import (
 
 auth_bp = Blueprint('auth', __name__)
 
-def send_async_email(app, msg):
-    with app.app_context():
-        try:
-            mail.send(msg)
-        except Exception as e:
-            app.logger.error(f"Failed to send email in background: {e}")
-
 def send_otp_email(user, otp):
-    msg = Message('Kode Verifikasi GabutPay Anda',
-                  sender=current_app.config['MAIL_USERNAME'],
-                  recipients=[user.email])
-    msg.body = f'''Selamat datang di GabutPay!
+    body = f'''Selamat datang di GabutPay!
 
 Gunakan kode ini untuk memverifikasi akun Anda:
 
@@ -34,35 +26,29 @@ Kode ini akan kedaluwarsa dalam 10 menit.
 
 Jika Anda tidak merasa mendaftar, abaikan email ini.
 '''
-    Thread(target=send_async_email, args=(current_app._get_current_object(), msg)).start()
+    queue_email('Kode Verifikasi GabutPay Anda', [user.email], body, expires_at=user.otp_expiry)
 
 def send_reset_email(user):
     token = user.get_reset_token()
-    msg = Message('Permintaan Reset Password GabutPay',
-                  sender=current_app.config['MAIL_USERNAME'],
-                  recipients=[user.email])
-    msg.body = f'''Untuk mereset password Anda, kunjungi link berikut:
+    body = f'''Untuk mereset password Anda, kunjungi link berikut:
 {url_for('auth.reset_token', token=token, _external=True)}
 
 Link ini akan kedaluwarsa dalam 30 menit.
 
 Jika Anda tidak merasa meminta ini, abaikan saja email ini.
 '''
-    Thread(target=send_async_email, args=(current_app._get_current_object(), msg)).start()
+    queue_email('Permintaan Reset Password GabutPay', [user.email], body, expires_at=datetime.utcnow() + timedelta(seconds=1800))
 
 def send_pin_reset_email(user):
     token = user.get_pin_reset_token()
-    msg = Message('Permintaan Reset PIN GabutPay',
-                  sender=current_app.config['MAIL_USERNAME'],
-                  recipients=[user.email])
-    msg.body = f'''Untuk mereset PIN Anda, kunjungi link berikut:
+    body = f'''Untuk mereset PIN Anda, kunjungi link berikut:
 {url_for('auth.reset_pin_token', token=token, _external=True)}
 
 Link ini akan kedaluwarsa dalam 30 menit.
 
 Jika Anda tidak merasa meminta ini, abaikan saja email ini.
 '''
-    Thread(target=send_async_email, args=(current_app._get_current_object(), msg)).start()
+    queue_email('Permintaan Reset PIN GabutPay', [user.email], body, expires_at=datetime.utcnow() + timedelta(seconds=1800))
 
 @auth_bp.route('/register', methods=['GET', 'POST'])
 @limiter.limit("10 per hour")
@@ -82,16 +68,16 @@ def register():
 
         # Generate a secure 6-digit numeric OTP
         otp = "{:06d}".format(secrets.randbelow(1000000))
-        otp_hash = bcrypt.generate_password_hash(otp).decode('utf-8')
+        otp_hash = hash_secret('otp', otp)
         otp_expiry = datetime.utcnow() + timedelta(minutes=10)
 
         if user and not user.is_verified:
-            user.password_hash = bcrypt.generate_password_hash(password).decode('utf-8')
+            user.password_hash = hash_secret('password', password)
             user.otp_hash = otp_hash
             user.otp_expiry = otp_expiry
             user.registration_ip = request.remote_addr
         else:
-            hashed_password = bcrypt.generate_password_hash(password).decode('utf-8')
+            hashed_password = hash_secret('password', password)
             new_user = User(email=email, password_hash=hashed_password, otp_hash=otp_hash, otp_expiry=otp_expiry, registration_ip=request.remote_addr)
             db.session.add(new_user)
         
@@ -118,7 +104,7 @@ def verify_otp(email):
             flash('OTP sudah kedaluwarsa. Silakan daftar ulang untuk mendapatkan OTP baru.', 'danger')
             return redirect(url_for('auth.register'))
 
-        if bcrypt.check_password_hash(user.otp_hash, otp_form):
+        if verify_secret('otp', user.otp_hash, otp_form):
             user.is_verified = True
             user.otp_hash = None
             user.otp_expiry = None
@@ -127,9 +113,8 @@ def verify_otp(email):
             if not existing_user_with_ip:
                 bonus_amount = current_app.config.get('REGISTRATION_BONUS', 0)
                 if bonus_amount > 0:
-                    user.balance += bonus_amount
-                    bonus_tx = Transaction(user_id=user.id, transaction_type='WELCOME_BONUS', amount=bonus_amount, description='Bonus selamat datang')
-                    db.session.add(bonus_tx)
+                    ledger.credit_user(user.id, bonus_amount)
+                    record_entry([(user.id, JournalLeg.WELCOME_BONUS, bonus_amount, None)])
                     flash(f'Verifikasi berhasil! Anda mendapatkan bonus saldo Rp {bonus_amount / 100:,.2f}.', 'success')
                 else:
                     flash('Verifikasi berhasil! Silakan login.', 'success')
@@ -155,7 +140,7 @@ def login():
         password = form.password.data
         user = User.query.filter_by(email=email).first()
 
-        if user and bcrypt.check_password_hash(user.password_hash, password):
+        if user and verify_password(user, password):
             if user.banned_until and user.banned_until > datetime.utcnow():
                 flash(f'Akun Anda sedang diblokir. Coba lagi setelah {user.banned_until.strftime("%d %b %Y %H:%M:%S")} UTC.', 'danger')
                 return redirect(url_for('auth.login'))
@@ -174,14 +159,8 @@ def login():
                 # It is a new day, grant the bonus
                 bonus_amount = current_app.config.get('DAILY_LOGIN_BONUS', 0)
                 if bonus_amount > 0:
-                    user.balance += bonus_amount
-                    bonus_tx = Transaction(
-                        user_id=user.id,
-                        transaction_type='BONUS',
-                        amount=bonus_amount,
-                        description='Bonus login harian'
-                    )
-                    db.session.add(bonus_tx)
+                    ledger.credit_user(user.id, bonus_amount)
+                    record_entry([(user.id, JournalLeg.BONUS, bonus_amount, None)])
                     flash(f'Selamat! Anda mendapatkan bonus login harian sebesar Rp {bonus_amount / 100:,.2f}!', 'success')
 
                 # Update login streak
@@ -234,8 +213,9 @@ def reset_token(token):
     
     form = ResetTokenForm()
     if form.validate_on_submit():
-        hashed_password = bcrypt.generate_password_hash(form.password.data).decode('utf-8')
+        hashed_password = hash_secret('password', form.password.data)
         user.password_hash = hashed_password
+        revoke_pin_windows(user.id)
         db.session.commit()
         flash('Password Anda telah berhasil diupdate! Silakan login.', 'success')
         return redirect(url_for('auth.login'))
@@ -243,6 +223,8 @@ def reset_token(token):
 
 @auth_bp.route("/logout")
 def logout():
+    revoke_current_pin_window()
+    db.session.commit()
     logout_user()
     flash('Anda telah berhasil logout.', 'info')
     return redirect(url_for('main.home'))
@@ -269,7 +251,8 @@ def reset_pin_token(token):
     form = ResetPINTokenForm()
     if form.validate_on_submit():
         pin = form.pin.data
-        user.pin_hash = bcrypt.generate_password_hash(pin).decode('utf-8')
+        user.pin_hash = hash_secret('pin', pin)
+        revoke_pin_windows(user.id)
         db.session.commit()
         flash('PIN Anda telah berhasil diupdate!', 'success')
         return redirect(url_for('main.dashboard'))
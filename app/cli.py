@@ -1,7 +1,18 @@
 import click
 from flask.cli import with_appcontext
-from . import db, bcrypt
-from .models import User, Achievement
+from . import db
+from .models import User, Achievement, JournalEntry
+from .fees import ensure_fee_shards, roll_up_fees
+from .stats import recompute_stats
+from .revenue import backfill_revenue
+from .payment_expiry import expire_pending_payments, get_expiry_sweeper
+from .webhooks import get_dispatcher
+from .outbox import get_email_sender
+from .inbound_usage import rebuild_daily_usage, utc_today
+from .query_budget import FIXTURE_ROWS, check_query_budgets
+from .hashing import SECRET_TYPES, hash_secret, measure_cost, measure_throughput, suggest_cost, cpu_count
+from datetime import timedelta
+from sqlalchemy import func
 import secrets
 
 @click.command('seed-data')
@@ -15,12 +26,17 @@ def seed_data_command():
     else:
         system_user = User(
             email='sistem@gabutpay.com',
-            password_hash=bcrypt.generate_password_hash(secrets.token_hex(32)).decode('utf-8'),
+            password_hash=hash_secret('password', secrets.token_hex(32)),
             is_verified=True,
             is_admin=False # Ini bukan admin yang bisa login
         )
         db.session.add(system_user)
         click.echo('Membuat Akun Kas Sistem...')
+
+    # --- Buat Shard Biaya ---
+    created_shards = ensure_fee_shards()
+    if created_shards:
+        click.echo(f'Membuat {created_shards} shard biaya...')
     
     # Commit perubahan ke database
     db.session.commit()
@@ -52,8 +68,166 @@ def seed_achievements_command():
     db.session.commit()
     click.echo('Seeding achievements selesai.')
 
+@click.command('rollup-fees')
+@with_appcontext
+def rollup_fees_command():
+    """Memindahkan saldo shard biaya ke Akun Kas Sistem. Jalankan berkala (cron/scheduler)."""
+    moved = roll_up_fees()
+    db.session.commit()
+    click.echo(f'Rekap biaya selesai: {moved} sen dipindahkan ke Akun Kas Sistem.')
+
+@click.command('reconcile-inbound-usage')
+@click.option('--days', default=1, show_default=True, help='Jumlah hari (UTC) ke belakang yang dihitung ulang, termasuk hari ini.')
+@with_appcontext
+def reconcile_inbound_usage_command(days):
+    """Membangun ulang penghitung limit harian inbound dari InboundLog."""
+    today = utc_today()
+    for offset in range(days):
+        day = today - timedelta(days=offset)
+        changes = rebuild_daily_usage(day)
+        db.session.commit()
+        for api_key_id, old_total, new_total in changes:
+            click.echo(f'{day} API key #{api_key_id}: {old_total} -> {new_total} sen')
+        click.echo(f'{day}: {len(changes)} penghitung diperbaiki.')
+
+@click.command('backfill-revenue')
+@click.option('--days', default=1, show_default=True, help='Jumlah hari (UTC) ke belakang yang dibangun ulang, termasuk hari ini.')
+@click.option('--all', 'all_days', is_flag=True, help='Bangun ulang sejak transaksi pertama.')
+@with_appcontext
+def backfill_revenue_command(days, all_days):
+    """Membangun ulang rekap pendapatan biaya per jam dan per hari dari jurnal."""
+    today = utc_today()
+    if all_days:
+        first = db.session.query(func.min(JournalEntry.created_at)).scalar()
+        days = (today - first.date()).days + 1 if first else 1
+    # One day per transaction, so a long backfill does not hold its locks for long
+    for offset in reversed(range(days)):
+        day = today - timedelta(days=offset)
+        legs = backfill_revenue(day, day)
+        db.session.commit()
+        click.echo(f'{day}: {legs} biaya direkap.')
+
+@click.command('recompute-stats')
+@with_appcontext
+def recompute_stats_command():
+    """Menghitung ulang statistik dashboard admin dari tabel sumber. Jalankan berkala (cron/scheduler)."""
+    stats = recompute_stats()
+    db.session.commit()
+    click.echo(f'Statistik dihitung ulang: {stats.user_count} pengguna, saldo {stats.total_balance} sen, '
+               f'{stats.journal_leg_count} transaksi.')
+
+@click.command('webhook-worker')
+@with_appcontext
+def webhook_worker_command():
+    """Menjalankan pengirim webhook di foreground (untuk proses worker terpisah)."""
+    click.echo('Webhook worker berjalan. Tekan Ctrl+C untuk berhenti.')
+    dispatcher = get_dispatcher()
+    try:
+        dispatcher.run_forever()
+    except KeyboardInterrupt:
+        dispatcher.stop()
+        dispatcher.executor.shutdown(wait=True)
+        click.echo('Webhook worker dihentikan.')
+
+@click.command('mail-worker')
+@with_appcontext
+def mail_worker_command():
+    """Menjalankan pengirim email outbox di foreground (untuk proses worker terpisah)."""
+    click.echo('Mail worker berjalan. Tekan Ctrl+C untuk berhenti.')
+    email_sender = get_email_sender()
+    email_sender.start()
+    try:
+        email_sender.join()
+    except KeyboardInterrupt:
+        email_sender.stop()
+        email_sender.join()
+        click.echo('Mail worker dihentikan.')
+
+@click.command('expire-payments')
+@click.option('--batch-size', default=None, type=int, help='Jumlah pembayaran per transaksi (bawaan: PAYMENT_EXPIRY_BATCH_SIZE).')
+@click.option('--max-batches', default=None, type=int, help='Berhenti setelah sejumlah batch ini (bawaan: sampai habis).')
+@click.option('--loop', is_flag=True, help='Terus berjalan dan menyapu setiap PAYMENT_EXPIRY_INTERVAL detik.')
+@with_appcontext
+def expire_payments_command(batch_size, max_batches, loop):
+    """Menandai pembayaran PENDING yang sudah terlalu lama sebagai EXPIRED. Jalankan berkala (cron/scheduler)."""
+    if loop:
+        click.echo('Penyapu pembayaran kedaluwarsa berjalan. Tekan Ctrl+C untuk berhenti.')
+        try:
+            get_expiry_sweeper().run_forever()
+        except KeyboardInterrupt:
+            click.echo('Penyapu pembayaran kedaluwarsa dihentikan.')
+        return
+    expired = expire_pending_payments(batch_size=batch_size, max_batches=max_batches)
+    click.echo(f'{expired} pembayaran ditandai EXPIRED.')
+
+@click.command('check-query-budget')
+@click.option('--rows', default=FIXTURE_ROWS, show_default=True, help='Jumlah baris contoh per daftar (tagihan, pembayaran, transaksi, pengguna).')
+def check_query_budget_command(rows):
+    """Memeriksa jumlah query SQL per halaman terhadap batasnya pada database SQLite sementara berisi data contoh."""
+    results = check_query_budgets(rows)
+
+    failed = 0
+    for endpoint, url, status_code, queries, budget in results:
+        if queries is None:
+            failed += 1
+            click.echo(f'GAGAL   {endpoint}: tidak ada data contoh')
+        elif status_code != 200 or queries > budget:
+            failed += 1
+            click.echo(f'GAGAL   {endpoint}: {queries} query (batas {budget}), HTTP {status_code} {url}')
+        else:
+            click.echo(f'OK      {endpoint}: {queries} query (batas {budget})')
+
+    if failed:
+        raise click.ClickException(f'{failed} halaman melebihi batas query, gagal dimuat, atau tanpa data contoh.')
+    click.echo('Semua halaman dalam batas query.')
+
+
+@click.command('benchmark-hashing')
+@click.option('--min-cost', default=8, show_default=True, help='Cost bcrypt terendah yang diukur.')
+@click.option('--max-cost', default=13, show_default=True, help='Cost bcrypt tertinggi yang diukur.')
+@click.option('--seconds', default=1.0, show_default=True, help='Lama pengukuran per cost (detik).')
+@click.option('--threads', default=None, type=int, help='Jumlah thread untuk uji throughput (default: jumlah core).')
+@click.option('--target-password-ms', default=250, show_default=True, help='Target waktu hash password (ms).')
+@click.option('--target-pin-ms', default=250, show_default=True, help='Target waktu hash PIN (ms).')
+@click.option('--target-otp-ms', default=20, show_default=True, help='Target waktu hash OTP (ms).')
+@with_appcontext
+def benchmark_hashing_command(min_cost, max_cost, seconds, threads, target_password_ms, target_pin_ms, target_otp_ms):
+    """Mengukur kecepatan bcrypt (hash/detik per core) dan menyarankan cost per jenis rahasia."""
+    from flask import current_app
+    if not 4 <= min_cost <= max_cost <= 31:
+        raise click.BadParameter('Cost harus di antara 4 dan 31, dengan --min-cost <= --max-cost.')
+    cores = cpu_count()
+    threads = threads or cores
+
+    click.echo(f'Satu thread, {cores} core tersedia:')
+    timings = {}
+    for cost in range(min_cost, max_cost + 1):
+        timings[cost] = measure_cost(cost, seconds)
+        click.echo(f'  cost {cost:>2}: {timings[cost] * 1000:8.1f} ms/hash, {1 / timings[cost]:8.1f} hash/detik per core')
+
+    click.echo(f'\nThroughput dengan {threads} thread pada cost yang dikonfigurasi:')
+    for kind in SECRET_TYPES:
+        cost = current_app.config[f'BCRYPT_COST_{kind.upper()}']
+        total = measure_throughput(cost, threads, seconds)
+        click.echo(f'  {kind:<8} (cost {cost:>2}): {total:8.1f} hash/detik total, {total / min(threads, cores):8.1f} per core')
+
+    click.echo('\nSaran konfigurasi:')
+    targets = {'password': target_password_ms, 'pin': target_pin_ms, 'otp': target_otp_ms}
+    for kind in SECRET_TYPES:
+        cost = suggest_cost(timings, targets[kind])
+        click.echo(f'  BCRYPT_COST_{kind.upper()}={cost}  # {timings[cost] * 1000:.1f} ms, target {targets[kind]} ms')
+
 
 def init_cli(app):
     """Mendaftarkan perintah CLI."""
     app.cli.add_command(seed_data_command)
     app.cli.add_command(seed_achievements_command)
+    app.cli.add_command(rollup_fees_command)
+    app.cli.add_command(reconcile_inbound_usage_command)
+    app.cli.add_command(recompute_stats_command)
+    app.cli.add_command(backfill_revenue_command)
+    app.cli.add_command(webhook_worker_command)
+    app.cli.add_command(mail_worker_command)
+    app.cli.add_command(expire_payments_command)
+    app.cli.add_command(check_query_budget_command)
+    app.cli.add_command(benchmark_hashing_command)
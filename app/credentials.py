@@ -0,0 +1,119 @@
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from flask import current_app
+from .models import APIKey, User
+from .utils import decrypt_data
+
+_cache_lock = threading.Lock()
+
+# Everything require_api_auth needs to authenticate a request without touching the database
+ApiCredential = namedtuple('ApiCredential', [
+    'api_key_id', 'public_key', 'secret_key', 'owner_id', 'owner_is_partner',
+    'is_inbound_enabled', 'allowed_ips', 'daily_limit'
+])
+
+def get_credential_cache(app=None):
+    """Returns the app's single CredentialCache, creating it if needed."""
+    app = app or current_app._get_current_object()
+    with _cache_lock:
+        cache = app.extensions.get('api_credential_cache')
+        if cache is None:
+            cache = app.extensions['api_credential_cache'] = CredentialCache(
+                app.config['API_CREDENTIAL_CACHE_SIZE'],
+                app.config['API_CREDENTIAL_CACHE_TTL']
+            )
+    return cache
+
+def load_credential(public_key):
+    """
+    Returns the ApiCredential for a public key, or None if the key does not exist.
+    Raises ValueError if the stored secret cannot be decrypted.
+    """
+    cache = get_credential_cache()
+    credential = cache.get(public_key)
+    if credential is not None:
+        return credential
+
+    row = APIKey.query.with_entities(
+        APIKey.id, APIKey.public_key, APIKey.secret_key_encrypted, APIKey.user_id,
+        APIKey.is_inbound_enabled, APIKey.allowed_ips, APIKey.daily_limit, User.is_partner
+    ).join(User, APIKey.user_id == User.id).filter(APIKey.public_key == public_key).first()
+    if row is None:
+        return None
+
+    decrypted_secret_bytes = decrypt_data(row.secret_key_encrypted)
+    if not decrypted_secret_bytes:
+        raise ValueError(f"Secret for API key {public_key} could not be decrypted")
+
+    allowed_ips = frozenset(ip.strip() for ip in row.allowed_ips.split(',') if ip.strip()) if row.allowed_ips else frozenset()
+    credential = ApiCredential(
+        api_key_id=row.id,
+        public_key=row.public_key,
+        secret_key=decrypted_secret_bytes,
+        owner_id=row.user_id,
+        owner_is_partner=row.is_partner,
+        is_inbound_enabled=row.is_inbound_enabled,
+        allowed_ips=allowed_ips,
+        daily_limit=row.daily_limit
+    )
+    cache.put(public_key, credential)
+    return credential
+
+def invalidate_api_key(public_key):
+    """Drops a key from this process's cache. Call after committing a change to the key."""
+    get_credential_cache().invalidate(public_key)
+
+def invalidate_owner(user_id):
+    """Drops every cached key owned by a user. Call after committing a change to the user."""
+    get_credential_cache().invalidate_owner(user_id)
+
+
+class CredentialCache:
+    """
+    Thread-safe LRU cache of decrypted API credentials with a TTL.
+
+    Writes through this app invalidate entries explicitly; the TTL bounds how
+    long other processes can keep serving a credential that was changed here.
+    """
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()  # public_key -> (expires_at, ApiCredential)
+        self._lock = threading.Lock()
+
+    def get(self, public_key):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(public_key)
+            if entry is None:
+                return None
+            expires_at, credential = entry
+            if expires_at <= now:
+                del self._entries[public_key]
+                return None
+            self._entries.move_to_end(public_key)
+            return credential
+
+    def put(self, public_key, credential):
+        if self.max_size <= 0 or self.ttl <= 0:
+            return
+        with self._lock:
+            self._entries[public_key] = (time.monotonic() + self.ttl, credential)
+            self._entries.move_to_end(public_key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, public_key):
+        with self._lock:
+            self._entries.pop(public_key, None)
+
+    def invalidate_owner(self, user_id):
+        with self._lock:
+            for public_key in [k for k, (_, c) in self._entries.items() if c.owner_id == user_id]:
+                del self._entries[public_key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
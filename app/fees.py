@@ -0,0 +1,83 @@
+import random
+from flask import current_app
+from sqlalchemy import func
+from . import db, ledger
+from .models import User, FeeShard
+from .lock_stats import timed_lock
+
+SYSTEM_EMAIL = 'sistem@gabutpay.com'
+
+def get_system_user_id():
+    """
+    Returns the system cash account's id without locking its row.
+    Looked up once per process: the account is never recreated.
+    """
+    app = current_app._get_current_object()
+    system_user_id = app.extensions.get('system_user_id')
+    if system_user_id is None:
+        system_user_id = app.extensions['system_user_id'] = \
+            db.session.query(User.id).filter_by(email=SYSTEM_EMAIL).one()[0]
+    return system_user_id
+
+def ensure_fee_shards():
+    """Creates any missing shard rows up to FEE_SHARD_COUNT. Caller commits."""
+    existing = {no for (no,) in db.session.query(FeeShard.shard_no).all()}
+    missing = [no for no in range(current_app.config['FEE_SHARD_COUNT']) if no not in existing]
+    for shard_no in missing:
+        db.session.add(FeeShard(shard_no=shard_no, balance=0))
+    return len(missing)
+
+def credit_fee(amount):
+    """
+    Adds a fee to one randomly chosen shard as a blind increment.
+    Only that shard row stays locked until the caller commits, so payments
+    between unrelated users no longer queue behind the system account row.
+    """
+    if amount <= 0:
+        return
+
+    shard_no = random.randrange(current_app.config['FEE_SHARD_COUNT'])
+    with timed_lock('fees.credit_fee', 'fee_shard', shard_no):
+        updated = db.session.query(FeeShard).filter_by(shard_no=shard_no).update(
+            {FeeShard.balance: FeeShard.balance + amount},
+            synchronize_session=False
+        )
+    if not updated:
+        # Shard not seeded yet (e.g. FEE_SHARD_COUNT was raised before `flask seed-data` ran).
+        # Inserting it here would race other payments picking the same shard, so use shard 0.
+        with timed_lock('fees.credit_fee', 'fee_shard', 0):
+            updated = db.session.query(FeeShard).filter_by(shard_no=0).update(
+                {FeeShard.balance: FeeShard.balance + amount},
+                synchronize_session=False
+            )
+        if not updated:
+            raise RuntimeError("Fee shards are not seeded; run `flask seed-data`.")
+
+def pending_fee_total():
+    """Sum of fees credited to shards but not yet rolled up."""
+    return db.session.query(func.coalesce(func.sum(FeeShard.balance), 0)).scalar()
+
+def combined_system_balance(system_user):
+    """The system account balance including fees still sitting in shards."""
+    return system_user.balance + pending_fee_total()
+
+def system_balance_with_fees():
+    """combined_system_balance in one query, for pages that only show the number."""
+    pending = db.session.query(func.coalesce(func.sum(FeeShard.balance), 0)).scalar_subquery()
+    return db.session.query(User.balance + pending).filter(User.id == get_system_user_id()).scalar()
+
+def roll_up_fees():
+    """
+    Moves every shard balance into the system account.
+    Locks the shards (which serializes concurrent roll-ups) and credits the
+    system account as a blind increment; the caller commits. Returns the amount moved.
+    """
+    with timed_lock('fees.roll_up', 'fee_shard'):
+        shards = db.session.query(FeeShard).filter(FeeShard.balance != 0)\
+            .order_by(FeeShard.shard_no).with_for_update().all()
+
+    total = sum(shard.balance for shard in shards)
+    for shard in shards:
+        shard.balance = 0
+    ledger.credit_user(get_system_user_id(), total)
+    return total
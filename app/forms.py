@@ -49,11 +49,14 @@ class GenerateKeyForm(FlaskForm):
 class TransferForm(FlaskForm):
     recipient_email = StringField('Email Penerima', validators=[DataRequired(), Email()])
     amount = DecimalField('Jumlah', places=2, validators=[DataRequired(), NumberRange(min=0.01, message="Jumlah harus positif.")])
-    pin = PasswordField('PIN Keamanan', validators=[DataRequired(), Length(min=6, max=6), Regexp(r'^\d{6}$', message='PIN harus terdiri dari 6 digit angka.')])
+    # Optional while a PIN window is active (see app/pin_session.py); the view checks it otherwise
+    pin = PasswordField('PIN Keamanan', validators=[Optional(), Length(min=6, max=6), Regexp(r'^\d{6}$', message='PIN harus terdiri dari 6 digit angka.')])
+    remember_pin = BooleanField('Jangan minta PIN lagi untuk beberapa menit')
     submit = SubmitField('Transfer')
 
 class PayPageForm(FlaskForm):
-    pin = PasswordField('PIN Keamanan', validators=[DataRequired(), Length(min=6, max=6), Regexp(r'^\d{6}$', message='PIN harus terdiri dari 6 digit angka.')])
+    pin = PasswordField('PIN Keamanan', validators=[Optional(), Length(min=6, max=6), Regexp(r'^\d{6}$', message='PIN harus terdiri dari 6 digit angka.')])
+    remember_pin = BooleanField('Jangan minta PIN lagi untuk beberapa menit')
     submit = SubmitField('Konfirmasi & Bayar')
 
 class BugReportForm(FlaskForm):
@@ -76,7 +79,7 @@ class ResetKeyForm(FlaskForm):
 
 class ModifyBalanceForm(FlaskForm):
     amount = DecimalField('Jumlah', places=2, validators=[DataRequired()])
-    reason = StringField('Alasan', validators=[DataRequired(), Length(min=5)])
+    reason = StringField('Alasan', validators=[DataRequired(), Length(min=5, max=150)])
     submit = SubmitField('Ubah Saldo')
 
 class WithdrawRevenueForm(FlaskForm):
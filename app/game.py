@@ -1,8 +1,10 @@
 import random
 from flask import Blueprint, render_template, request, jsonify, current_app
 from flask_login import login_required, current_user
-from . import db
-from .models import User, Transaction
+from . import db, ledger
+from .models import JournalLeg
+from .journal import record_entry
+from .unit_of_work import unit_of_work, should_retry
 
 # --- Blueprint Definition ---
 game_bp = Blueprint('game', __name__, template_folder='templates')
@@ -48,6 +50,7 @@ def play():
 # --- Game API Route ---
 @game_bp.route('/play-gacha', methods=['POST'])
 @login_required
+@unit_of_work
 def play_gacha():
     """Endpoint to play the gacha."""
     user = current_user
@@ -57,39 +60,34 @@ def play_gacha():
         return jsonify({"error": f"Saldo tidak cukup. Anda memerlukan setidaknya Rp {gacha_cost/100}."}), 403
 
     try:
-        # Use a transaction to ensure atomicity
-        user_to_update = User.query.filter_by(id=user.id).with_for_update().one()
-
-        # Deduct cost
-        user_to_update.balance -= gacha_cost
+        # Deduct cost with a conditional UPDATE (fails instead of going negative)
+        try:
+            ledger.debit_user(user.id, gacha_cost)
+        except ledger.InsufficientFunds:
+            db.session.rollback()
+            return jsonify({"error": f"Saldo tidak cukup. Anda memerlukan setidaknya Rp {gacha_cost/100}."}), 403
 
         # Select prize based on weights
         chosen_prize = random.choices(PRIZE_POOL, weights=weights, k=1)[0]
         
         # Add reward
-        user_to_update.balance += chosen_prize['reward']
+        ledger.credit_user(user.id, chosen_prize['reward'])
 
-        # Create transaction record
-        tx_desc = f"Bermain Gacha: Mendapatkan '{chosen_prize['name']}'"
+        # Journal entry
         # Net amount is reward - cost. Can be negative.
         net_amount = chosen_prize['reward'] - gacha_cost
-        
-        gacha_tx = Transaction(
-            user_id=user.id, 
-            transaction_type='GACHA_PLAY', 
-            amount=net_amount, # Storing the net change
-            description=tx_desc
-        )
-        db.session.add(gacha_tx)
+        record_entry([(user.id, JournalLeg.GACHA_PLAY, net_amount, None)], reference=chosen_prize['name'])
         db.session.commit()
 
         return jsonify({
             "success": True,
             "prize": chosen_prize,
-            "newBalance": user_to_update.balance
+            "newBalance": ledger.current_balance(user.id)
         })
 
     except Exception as e:
         db.session.rollback()
+        if should_retry(e):
+            raise
         current_app.logger.error(f"Error during gacha play: {e}")
         return jsonify({"error": "Terjadi kesalahan internal. Dana Anda aman."}), 500
\ No newline at end of file
@@ -0,0 +1,161 @@
+import hashlib
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app
+from . import bcrypt
+
+_executor_lock = threading.Lock()
+
+# Secret types with their own bcrypt cost (BCRYPT_COST_<TYPE>)
+SECRET_TYPES = ('password', 'pin', 'otp')
+
+
+def hash_secret(kind, secret):
+    """Bcrypt-hashes a password, PIN or OTP with the cost configured for its type."""
+    cost = secret_cost(kind)
+    return run_hashing(bcrypt.generate_password_hash, secret, cost).decode('utf-8')
+
+def verify_secret(kind, hashed, secret):
+    """Checks a secret against its stored hash. A missing hash never matches."""
+    if kind not in SECRET_TYPES:
+        raise ValueError(f"Unknown secret type: {kind}")
+    if not hashed or not secret:
+        return False
+    return run_hashing(bcrypt.check_password_hash, hashed, secret)
+
+def needs_rehash(kind, hashed):
+    """True if the hash was made with a different cost than the one now configured."""
+    return bool(hashed) and hash_cost(hashed) != secret_cost(kind)
+
+def verify_password(user, password):
+    """Checks a login password and upgrades the stored hash if its cost is outdated."""
+    if not verify_secret('password', user.password_hash, password):
+        return False
+    if needs_rehash('password', user.password_hash):
+        user.password_hash = hash_secret('password', password)
+    return True
+
+def verify_pin(user, pin):
+    """Checks a transaction PIN and upgrades the stored hash if its cost is outdated."""
+    if not verify_secret('pin', user.pin_hash, pin):
+        return False
+    if needs_rehash('pin', user.pin_hash):
+        user.pin_hash = hash_secret('pin', pin)
+    return True
+
+def digest_secret(secret):
+    """
+    SHA-256 of a random, high-entropy secret (API keys, webhook secrets).
+    These are never verified against the stored value, which is only kept as
+    a fingerprint, so they do not need a slow hash.
+    """
+    return hashlib.sha256(secret.encode('utf-8')).hexdigest()
+
+def secret_cost(kind):
+    if kind not in SECRET_TYPES:
+        raise ValueError(f"Unknown secret type: {kind}")
+    return current_app.config[f'BCRYPT_COST_{kind.upper()}']
+
+def hash_cost(hashed):
+    """Reads the cost out of a '$2b$12$...' bcrypt hash."""
+    try:
+        return int(hashed.split('$')[2])
+    except (IndexError, ValueError):
+        raise ValueError("Not a bcrypt hash")
+
+
+def run_hashing(fn, *args):
+    """Runs fn on the hashing executor if one is configured, else on the calling thread."""
+    executor = get_hashing_executor()
+    if executor is None:
+        return fn(*args)
+    return executor.run(fn, *args)
+
+def get_hashing_executor(app=None):
+    """Returns the app's HashingExecutor, or None when HASHING_WORKERS is 0."""
+    app = app or current_app._get_current_object()
+    if app.config['HASHING_WORKERS'] <= 0:
+        return None
+    with _executor_lock:
+        executor = app.extensions.get('hashing_executor')
+        if executor is None:
+            executor = app.extensions['hashing_executor'] = HashingExecutor(
+                app.config['HASHING_WORKERS'],
+                app.config['HASHING_MAX_PENDING']
+            )
+    return executor
+
+
+class HashingExecutor:
+    """
+    Bounded pool of OS threads for bcrypt work. bcrypt releases the GIL, so
+    hashes run in parallel and at most `workers` cores are spent on them, while
+    the request threads stay free. Callers beyond `workers + max_pending`
+    wait for a slot instead of piling more work up.
+
+    Under gevent (monkey-patched threading) the work goes to gevent's native
+    thread pool instead, so the hub keeps serving other greenlets.
+    """
+
+    def __init__(self, workers, max_pending):
+        self.workers = workers
+        self._slots = threading.BoundedSemaphore(workers + max_pending)
+        self._gevent_pool = _gevent_threadpool(workers)
+        self._executor = None
+        if self._gevent_pool is None:
+            self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='bcrypt')
+
+    def run(self, fn, *args):
+        with self._slots:
+            if self._gevent_pool is not None:
+                return self._gevent_pool.apply(fn, args)
+            return self._executor.submit(fn, *args).result()
+
+def _gevent_threadpool(workers):
+    try:
+        from gevent import get_hub
+        from gevent.monkey import is_module_patched
+    except ImportError:
+        return None
+    if not is_module_patched('threading'):
+        return None
+    pool = get_hub().threadpool
+    pool.maxsize = max(pool.maxsize, workers)
+    return pool
+
+
+def measure_cost(cost, seconds=1.0, min_hashes=3):
+    """Seconds per bcrypt hash at the given cost, on one thread."""
+    started = time.perf_counter()
+    hashes = 0
+    while hashes < min_hashes or time.perf_counter() - started < seconds:
+        bcrypt.generate_password_hash('benchmark-secret', cost)
+        hashes += 1
+    return (time.perf_counter() - started) / hashes
+
+def measure_throughput(cost, threads, seconds=2.0):
+    """Total bcrypt hashes per second at the given cost with `threads` threads hashing at once."""
+    deadline = time.perf_counter() + seconds
+    counts = [0] * threads
+
+    def hash_until_deadline(i):
+        while time.perf_counter() < deadline:
+            bcrypt.generate_password_hash('benchmark-secret', cost)
+            counts[i] += 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        list(pool.map(hash_until_deadline, range(threads)))
+    return sum(counts) / (time.perf_counter() - started)
+
+def suggest_cost(timings, target_ms):
+    """Highest measured cost whose hash time stays within target_ms (at least the lowest measured)."""
+    within = [cost for cost, seconds in timings.items() if seconds * 1000 <= target_ms]
+    return max(within) if within else min(timings)
+
+def cpu_count():
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
@@ -0,0 +1,161 @@
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from flask import current_app, has_app_context
+from flask_login import UserMixin
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from . import db
+from .models import User
+
+_cache_lock = threading.Lock()
+
+# The User fields read on (almost) every page: login/ban checks, the navbar and the dashboard
+Identity = namedtuple('Identity', ['id', 'email', 'is_admin', 'banned_until', 'balance', 'login_streak', 'has_pin'])
+
+_IDENTITY_COLUMNS = (User.id, User.email, User.is_admin, User.banned_until, User.balance, User.login_streak, User.pin_hash)
+
+
+def load_identity(user_id):
+    """Returns a CachedUser for Flask-Login, or None if the user does not exist."""
+    cache = get_identity_cache()
+    identity = cache.get(user_id)
+    if identity is None:
+        row = db.session.query(*_IDENTITY_COLUMNS).filter(User.id == user_id).first()
+        if row is None:
+            return None
+        identity = Identity(row.id, row.email, row.is_admin, row.banned_until, row.balance,
+                            row.login_streak, row.pin_hash is not None)
+        cache.put(user_id, identity)
+    return CachedUser(identity)
+
+def mark_identity_changed(user_id, session=None):
+    """
+    Drops the user's cached identity once the current transaction commits.
+    ORM changes to User rows are tracked automatically; bulk UPDATEs
+    (ledger.py) have to call this themselves.
+    """
+    session = session or db.session()
+    session.info.setdefault('_identity_changes', set()).add(user_id)
+
+def get_identity_cache(app=None):
+    """Returns the app's single IdentityCache, creating it if needed."""
+    app = app or current_app._get_current_object()
+    with _cache_lock:
+        cache = app.extensions.get('identity_cache')
+        if cache is None:
+            cache = app.extensions['identity_cache'] = IdentityCache(
+                app.config['IDENTITY_CACHE_SIZE'],
+                app.config['IDENTITY_CACHE_TTL']
+            )
+    return cache
+
+
+@event.listens_for(Session, 'after_flush')
+def _track_user_changes(session, flush_context):
+    for obj in list(session.dirty) + list(session.deleted):
+        if isinstance(obj, User) and obj.id is not None:
+            mark_identity_changed(obj.id, session)
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_committed_changes(session):
+    changed = session.info.pop('_identity_changes', None)
+    if changed and has_app_context():
+        cache = get_identity_cache()
+        for user_id in changed:
+            cache.invalidate(user_id)
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_rolled_back_changes(session):
+    session.info.pop('_identity_changes', None)
+
+
+class CachedUser(UserMixin):
+    """
+    current_user backed by a cached Identity. The identity fields are served
+    from the cache; anything else (pin_hash, relationships, methods, writes)
+    loads the full User row on first use, once per request.
+
+    It is not an ORM instance: query by current_user.id rather than passing
+    current_user itself into filters or relationships.
+    """
+
+    def __init__(self, identity):
+        object.__setattr__(self, '_identity', identity)
+        object.__setattr__(self, '_user', None)
+
+    def get_id(self):
+        return str(self._identity.id)
+
+    def get_user(self):
+        """The full User row, loaded on first use."""
+        if self._user is None:
+            user = db.session.get(User, self._identity.id)
+            if user is None:
+                raise LookupError(f"User {self._identity.id} no longer exists")
+            object.__setattr__(self, '_user', user)
+        return self._user
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return getattr(self.get_user(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self.get_user(), name, value)
+
+    def __repr__(self):
+        return f"CachedUser('{self._identity.email}')"
+
+def _identity_field(name):
+    def getter(self):
+        # Once the row is loaded it is the fresher source
+        if self._user is not None:
+            if name == 'has_pin':
+                return self._user.pin_hash is not None
+            return getattr(self._user, name)
+        return getattr(self._identity, name)
+    return property(getter)
+
+for _field in Identity._fields:
+    setattr(CachedUser, _field, _identity_field(_field))
+
+
+class IdentityCache:
+    """Thread-safe LRU cache of Identity tuples by user id, with a TTL."""
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()  # user_id -> (expires_at, Identity)
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return None
+            expires_at, identity = entry
+            if expires_at <= now:
+                del self._entries[user_id]
+                return None
+            self._entries.move_to_end(user_id)
+            return identity
+
+    def put(self, user_id, identity):
+        if self.max_size <= 0 or self.ttl <= 0:
+            return
+        with self._lock:
+            self._entries[user_id] = (time.monotonic() + self.ttl, identity)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
@@ -0,0 +1,75 @@
+from datetime import datetime, timedelta
+from sqlalchemy import func
+from . import db
+from .models import APIKey, InboundLog, InboundDailyUsage
+from .lock_stats import timed_lock
+
+def utc_today():
+    return datetime.utcnow().date()
+
+def lock_daily_usage(api_key_id, day=None):
+    """
+    Returns today's usage row for a key, locked for update, creating it if needed.
+    Callers must already hold the APIKey row lock, which is what makes the
+    create-if-missing step race free. The caller commits.
+    """
+    day = day or utc_today()
+    with timed_lock('inbound_usage.lock', 'inbound_daily_usage', api_key_id):
+        usage = db.session.query(InboundDailyUsage).filter_by(api_key_id=api_key_id, day=day).with_for_update().first()
+    if usage is None:
+        usage = InboundDailyUsage(api_key_id=api_key_id, day=day, total_amount=0, transfer_count=0)
+        db.session.add(usage)
+    return usage
+
+def record_usage(usage, amount):
+    usage.total_amount += amount
+    usage.transfer_count += 1
+
+def rebuild_daily_usage(day):
+    """
+    Recomputes every key's counter for one UTC day from InboundLog.
+    Locks the keys first, like the transfer endpoints do, so no transfer can
+    commit between the SUM and the counter update and be counted twice or
+    not at all. Returns a list of (api_key_id, old_total, new_total) for
+    counters that changed. The caller commits.
+    """
+    day_start = datetime.combine(day, datetime.min.time())
+    day_logs = db.session.query(InboundLog).filter(
+        InboundLog.timestamp >= day_start,
+        InboundLog.timestamp < day_start + timedelta(days=1),
+        InboundLog.status == 'SUCCESS'
+    )
+    # Keys that get their first transfer of the day after this are never touched, so need no lock
+    api_key_ids = {api_key_id for (api_key_id,) in day_logs.with_entities(InboundLog.api_key_id).distinct()}
+    api_key_ids |= {api_key_id for (api_key_id,) in
+                    db.session.query(InboundDailyUsage.api_key_id).filter_by(day=day)}
+    if not api_key_ids:
+        return []
+
+    # In id order, so two rebuilds cannot deadlock each other
+    with timed_lock('inbound_usage.rebuild', 'api_key'):
+        db.session.query(APIKey.id).filter(APIKey.id.in_(api_key_ids))\
+            .order_by(APIKey.id).with_for_update().all()
+    with timed_lock('inbound_usage.rebuild', 'inbound_daily_usage'):
+        existing = {usage.api_key_id: usage for usage in
+                    db.session.query(InboundDailyUsage).filter_by(day=day)
+                    .filter(InboundDailyUsage.api_key_id.in_(api_key_ids)).with_for_update().all()}
+
+    totals = day_logs.filter(InboundLog.api_key_id.in_(api_key_ids)).with_entities(
+        InboundLog.api_key_id, func.sum(InboundLog.amount), func.count(InboundLog.id)
+    ).group_by(InboundLog.api_key_id).all()
+    totals = {api_key_id: (amount, count) for api_key_id, amount, count in totals}
+
+    changes = []
+    for api_key_id in sorted(api_key_ids):
+        amount, count = totals.get(api_key_id, (0, 0))
+        usage = existing.get(api_key_id)
+        if usage is None:
+            # Safe to create: this key's row lock is held
+            usage = InboundDailyUsage(api_key_id=api_key_id, day=day, total_amount=0, transfer_count=0)
+            db.session.add(usage)
+        if usage.total_amount != amount or usage.transfer_count != count:
+            changes.append((api_key_id, usage.total_amount, amount))
+            usage.total_amount = amount
+            usage.transfer_count = count
+    return changes
@@ -0,0 +1,31 @@
+from sqlalchemy.orm import joinedload
+from . import db
+from .models import JournalEntry, JournalLeg
+
+def record_entry(legs, payment=None, payment_id=None, reference=None):
+    """
+    Adds one journal entry with its legs to the session. The caller commits.
+
+    legs: iterable of (account_id, leg_type, amount, counterparty_id) tuples,
+    amounts signed in cents. Zero-amount legs are kept so a transfer without
+    fees still shows the fee line it always showed.
+    """
+    entry = JournalEntry(reference=reference[:150] if reference else None)
+    if payment is not None:
+        entry.payment = payment
+    elif payment_id is not None:
+        entry.payment_id = payment_id
+    entry.legs = [
+        JournalLeg(account_id=account_id, leg_type=leg_type, amount=amount, counterparty_id=counterparty_id)
+        for account_id, leg_type, amount, counterparty_id in legs
+    ]
+    db.session.add(entry)
+    return entry
+
+def leg_query():
+    """JournalLeg query that loads everything the templates render, without N+1 lazy loads."""
+    return JournalLeg.query.options(
+        joinedload(JournalLeg.entry).joinedload(JournalEntry.payment),
+        joinedload(JournalLeg.counterparty),
+        joinedload(JournalLeg.account)
+    )
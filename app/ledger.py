@@ -0,0 +1,70 @@
+from collections import defaultdict
+from . import db
+from .models import User
+from .lock_stats import timed_lock
+from .identity import mark_identity_changed
+from .stats import add_stat_delta
+
+
+class InsufficientFunds(Exception):
+    """A conditional debit matched no row: the balance was too low (or the user is gone)."""
+
+    def __init__(self, user_id):
+        super().__init__(f"Insufficient balance for user {user_id}")
+        self.user_id = user_id
+
+
+def post(debits=None, credits=None):
+    """
+    Applies balance changes as single-statement UPDATEs, without reading or locking rows first.
+
+    Debits run as `balance = balance - x WHERE balance >= x` and raise
+    InsufficientFunds when no row matched; credits are blind increments.
+    Rows are touched in ascending user id order so concurrent postings
+    between the same users cannot deadlock. Nothing is committed: on
+    InsufficientFunds the caller must roll back, because earlier rows in
+    the same posting may already have been updated.
+
+    debits / credits: iterables of (user_id, amount) pairs, amounts in cents.
+    """
+    changes = defaultdict(lambda: [0, 0])  # user_id -> [debit, credit]
+    for user_id, amount in debits or ():
+        changes[user_id][0] += amount
+    for user_id, amount in credits or ():
+        changes[user_id][1] += amount
+
+    for user_id in sorted(changes):
+        debit, credit = changes[user_id]
+        # A user must afford the whole debit even if they are credited in the same posting
+        debit_user(user_id, debit)
+        credit_user(user_id, credit)
+
+def debit_user(user_id, amount):
+    """Atomically takes amount from a user's balance, or raises InsufficientFunds."""
+    if amount <= 0:
+        return
+    with timed_lock('ledger.debit', 'user', user_id):
+        updated = db.session.query(User).filter(User.id == user_id, User.balance >= amount).update(
+            {User.balance: User.balance - amount},
+            synchronize_session=False
+        )
+    if updated != 1:
+        raise InsufficientFunds(user_id)
+    mark_identity_changed(user_id)
+    add_stat_delta('total_balance', -amount)
+
+def credit_user(user_id, amount):
+    """Adds amount to a user's balance as a blind increment."""
+    if amount <= 0:
+        return
+    with timed_lock('ledger.credit', 'user', user_id):
+        db.session.query(User).filter(User.id == user_id).update(
+            {User.balance: User.balance + amount},
+            synchronize_session=False
+        )
+    mark_identity_changed(user_id)
+    add_stat_delta('total_balance', amount)
+
+def current_balance(user_id):
+    """Reads a balance straight from the database (ORM objects may be stale after a posting)."""
+    return db.session.query(User.balance).filter(User.id == user_id).scalar()
@@ -0,0 +1,141 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+from flask import current_app, g, has_request_context, request
+
+_stats_lock = threading.Lock()
+
+# Upper bounds of the wait-time histogram buckets, in milliseconds (the last bucket is open ended)
+BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+
+
+@contextmanager
+def timed_lock(site, table, row=None):
+    """
+    Times a statement that takes row locks (SELECT ... FOR UPDATE or a
+    conditional UPDATE) and records it under (site, table).
+
+    The locking statements are single-row lookups by key, so their elapsed
+    time is almost entirely time spent waiting for the lock. `row` is the
+    locked row's key, used to find hot rows; leave it None for multi-row locks.
+    """
+    if not current_app.config['LOCK_STATS_ENABLED']:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        wait_ms = (time.perf_counter() - start) * 1000
+        if has_request_context():
+            site = f"{request.endpoint}:{site}"
+            g.lock_wait_ms = g.get('lock_wait_ms', 0.0) + wait_ms
+        get_lock_stats().record(site, table, row, wait_ms)
+
+def get_lock_stats(app=None):
+    """Returns the app's LockStats, creating it if needed."""
+    app = app or current_app._get_current_object()
+    with _stats_lock:
+        stats = app.extensions.get('lock_stats')
+        if stats is None:
+            stats = app.extensions['lock_stats'] = LockStats(app.config['LOCK_STATS_HOT_ROWS'])
+    return stats
+
+
+class WaitHistogram:
+    def __init__(self):
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.buckets = [0] * (len(BUCKETS_MS) + 1)
+
+    def add(self, wait_ms):
+        self.count += 1
+        self.total_ms += wait_ms
+        self.max_ms = max(self.max_ms, wait_ms)
+        for i, bound in enumerate(BUCKETS_MS):
+            if wait_ms <= bound:
+                self.buckets[i] += 1
+                return
+        self.buckets[-1] += 1
+
+    def percentile(self, fraction):
+        """Upper bound of the bucket holding the given percentile (None if it is the open bucket)."""
+        if not self.count:
+            return 0
+        target = fraction * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= target:
+                return BUCKETS_MS[i] if i < len(BUCKETS_MS) else None
+        return None
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'total_ms': round(self.total_ms, 3),
+            'mean_ms': round(self.total_ms / self.count, 3) if self.count else 0,
+            'max_ms': round(self.max_ms, 3),
+            'p50_ms': self.percentile(0.5),
+            'p95_ms': self.percentile(0.95),
+            'p99_ms': self.percentile(0.99),
+            'buckets': self.buckets[:],
+        }
+
+
+class LockStats:
+    """
+    Per-process lock wait aggregates: a histogram per lock site, one per
+    table, and the rows with the most total wait (bounded to hot_rows entries).
+    """
+
+    def __init__(self, hot_rows):
+        self.hot_rows = hot_rows
+        self.started_at = time.time()
+        self._sites = {}   # (site, table) -> WaitHistogram
+        self._tables = {}  # table -> WaitHistogram
+        self._rows = {}    # (table, row) -> [count, total_ms]
+        self._lock = threading.Lock()
+
+    def record(self, site, table, row, wait_ms):
+        with self._lock:
+            self._sites.setdefault((site, table), WaitHistogram()).add(wait_ms)
+            self._tables.setdefault(table, WaitHistogram()).add(wait_ms)
+            if row is not None and self.hot_rows > 0:
+                entry = self._rows.get((table, row))
+                if entry is None:
+                    if len(self._rows) >= self.hot_rows:
+                        # Evict the coolest row; hot rows keep accumulating
+                        coolest = min(self._rows, key=lambda key: self._rows[key][1])
+                        if self._rows[coolest][1] > wait_ms:
+                            return
+                        del self._rows[coolest]
+                    entry = self._rows[(table, row)] = [0, 0.0]
+                entry[0] += 1
+                entry[1] += wait_ms
+
+    def snapshot(self, top_rows=20):
+        with self._lock:
+            sites = [dict(site=site, table=table, **hist.as_dict()) for (site, table), hist in self._sites.items()]
+            tables = [dict(table=table, **hist.as_dict()) for table, hist in self._tables.items()]
+            rows = sorted(self._rows.items(), key=lambda item: -item[1][1])[:top_rows]
+        return {
+            'pid': os.getpid(),
+            'since': self.started_at,
+            'buckets_ms': list(BUCKETS_MS),
+            'sites': sorted(sites, key=lambda s: -s['total_ms']),
+            'tables': sorted(tables, key=lambda t: -t['total_ms']),
+            'hot_rows': [
+                {'table': table, 'row': row, 'count': count, 'total_ms': round(total_ms, 3)}
+                for (table, row), (count, total_ms) in rows
+            ],
+        }
+
+    def reset(self):
+        with self._lock:
+            self.started_at = time.time()
+            self._sites.clear()
+            self._tables.clear()
+            self._rows.clear()
@@ -7,7 +7,9 @@ from datetime import datetime
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    # Served from the identity cache; the full User row is only loaded if a view needs it
+    from .identity import load_identity
+    return load_identity(int(user_id))
 
 class User(db.Model, UserMixin):
     id = db.Column(db.Integer, primary_key=True)
@@ -25,15 +27,29 @@ class User(db.Model, UserMixin):
     created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
     last_seen = db.Column(db.DateTime, nullable=True)
     login_streak = db.Column(db.Integer, nullable=False, server_default='0', default=0)
+
+    __table_args__ = (
+        # Last line of defence behind the conditional debits in ledger.py
+        db.CheckConstraint('balance >= 0', name='ck_user_balance_non_negative'),
+        # Case-insensitive email prefix search in the admin panel (app/user_search.py).
+        # PostgreSQL additionally gets an optional trigram index in the migration.
+        db.Index('ix_user_email_lower', db.func.lower(email).label('email_lower'),
+                 postgresql_ops={'email_lower': 'text_pattern_ops'}),
+    )
     
     # Relationship to APIKey
     api_keys = db.relationship('APIKey', backref='owner', lazy=True, cascade="all, delete-orphan")
     push_subscriptions = db.relationship('PushSubscription', backref='user', lazy=True, cascade="all, delete-orphan")
+    pin_sessions = db.relationship('PinSession', backref='user', lazy=True, cascade="all, delete-orphan")
     achievements = db.relationship('UserAchievement', backref='user', lazy=True, cascade="all, delete-orphan")
 
     def __repr__(self):
         return f"User('{self.email}')"
 
+    @property
+    def has_pin(self):
+        return self.pin_hash is not None
+
     def get_reset_token(self, expires_sec=1800):
         s = URLSafeTimedSerializer(current_app.config['SECRET_KEY'])
         return s.dumps({'user_id': self.id}, salt='password-reset-salt')
@@ -99,7 +115,10 @@ class InboundLog(db.Model):
     timestamp = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
 
     # Unique constraint for idempotency: Partner + External ID
-    __table_args__ = (db.UniqueConstraint('partner_id', 'external_id', name='_partner_external_id_uc'),)
+    __table_args__ = (
+        db.UniqueConstraint('partner_id', 'external_id', name='_partner_external_id_uc'),
+        db.Index('ix_inbound_log_api_key_timestamp', 'api_key_id', 'timestamp'),
+    )
 
     partner = db.relationship('User', foreign_keys=[partner_id])
     recipient = db.relationship('User', foreign_keys=[recipient_id])
@@ -108,23 +127,139 @@ class InboundLog(db.Model):
     def __repr__(self):
         return f"<InboundLog {self.external_id} - {self.amount}>"
 
+class InboundDailyUsage(db.Model):
+    """
+    Running total of successful inbound transfers per API key and UTC day.
+    Updated in the same transaction as each InboundLog, so the daily limit
+    check reads one row instead of summing the day's logs.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    api_key_id = db.Column(db.Integer, db.ForeignKey('api_key.id', ondelete='CASCADE'), nullable=False)
+    day = db.Column(db.Date, nullable=False) # UTC
+    total_amount = db.Column(db.Integer, nullable=False, default=0) # In cents
+    transfer_count = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    __table_args__ = (db.UniqueConstraint('api_key_id', 'day', name='_inbound_usage_key_day_uc'),)
 
-class Transaction(db.Model):
+    def __repr__(self):
+        return f"<InboundDailyUsage {self.api_key_id} {self.day}: {self.total_amount}>"
+
+
+class JournalEntry(db.Model):
+    """
+    One business event (a transfer, a payment, a bonus, ...). The balance
+    changes it caused are its legs; their descriptions are rendered when
+    read instead of being stored per row.
+    """
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     payment_id = db.Column(db.Integer, db.ForeignKey('payment.id'), nullable=True) # Link to the payment
-    transaction_type = db.Column(db.String(20), nullable=False)
-    amount = db.Column(db.Integer, nullable=False)
+    reference = db.Column(db.String(150), nullable=True) # Store name, external ID, API key, bill title, prize or admin reason
+    memo = db.Column(db.String(255), nullable=True) # Only for migrated rows whose old description could not be parsed
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    payment = db.relationship('Payment', backref=db.backref('journal_entries', cascade="all, delete-orphan"))
+    legs = db.relationship('JournalLeg', backref='entry', lazy=True, cascade="all, delete-orphan")
+
+    def __repr__(self):
+        return f"<JournalEntry {self.id}>"
+
+class JournalLeg(db.Model):
+    """A signed balance change on one account, belonging to a JournalEntry."""
+
+    # Stored leg_type codes. Never renumber; only append.
+    WELCOME_BONUS = 1
+    BONUS = 2
+    KEY_PURCHASE = 3
+    TRANSFER_OUT = 4
+    TRANSFER_IN = 5
+    TRANSFER_PAYER_FEE = 6
+    TRANSFER_RECIPIENT_FEE = 7
+    TRANSFER_SENDER_FEE = 8
+    PAYMENT_OUT = 9
+    PAYMENT_IN = 10
+    PAYMENT_PAYER_FEE = 11
+    PAYMENT_MERCHANT_FEE = 12
+    PAYMENT_SERVICE_FEE = 13
+    SPLIT_BILL_OUT = 14
+    SPLIT_BILL_IN = 15
+    INBOUND_DEPOSIT = 16
+    INBOUND_PAYMENT = 17
+    ADMIN_CREDIT = 18
+    ADMIN_DEBIT = 19
+    SYSTEM_WITHDRAWAL = 20
+    ADMIN_DEPOSIT = 21
+    GACHA_PLAY = 22
+    LEGACY = 99 # Migrated row of an unknown type; the type name is kept in entry.reference
+
+    # leg_type -> (transaction type shown to users, description template)
+    TYPES = {
+        WELCOME_BONUS: ('WELCOME_BONUS', 'Bonus selamat datang'),
+        BONUS: ('BONUS', 'Bonus login harian'),
+        KEY_PURCHASE: ('KEY_PURCHASE', 'Pembelian API Key {reference}'),
+        TRANSFER_OUT: ('TRANSFER_OUT', 'Transfer ke {counterparty}'),
+        TRANSFER_IN: ('TRANSFER_IN', 'Transfer dari {counterparty}'),
+        TRANSFER_PAYER_FEE: ('PAYER_FEE', 'Biaya layanan transfer ke {counterparty}'),
+        TRANSFER_RECIPIENT_FEE: ('ADMIN_FEE', 'Biaya admin dari transfer (sisi penerima: {counterparty})'),
+        TRANSFER_SENDER_FEE: ('ADMIN_FEE', 'Biaya layanan dari transfer (sisi pengirim: {counterparty})'),
+        PAYMENT_OUT: ('PAYMENT_OUT', 'Pembayaran ke {reference}'),
+        PAYMENT_IN: ('PAYMENT_IN', 'Pembayaran dari {counterparty}'),
+        PAYMENT_PAYER_FEE: ('PAYER_FEE', 'Biaya layanan pembayaran ke {reference}'),
+        PAYMENT_MERCHANT_FEE: ('ADMIN_FEE', 'Biaya admin dari pembayaran (sisi merchant: {counterparty})'),
+        PAYMENT_SERVICE_FEE: ('ADMIN_FEE', 'Biaya layanan dari pembayaran (sisi pembayar: {counterparty})'),
+        SPLIT_BILL_OUT: ('SPLIT_BILL_OUT', "Bayar patungan: '{reference}'"),
+        SPLIT_BILL_IN: ('SPLIT_BILL_IN', "Terima patungan dari {counterparty} untuk '{reference}'"),
+        INBOUND_DEPOSIT: ('INBOUND_DEPOSIT', 'Inbound top up dari {counterparty} (Ref: {reference})'),
+        INBOUND_PAYMENT: ('INBOUND_PAYMENT', 'Inbound payment ke {counterparty} (Ref: {reference})'),
+        ADMIN_CREDIT: ('ADMIN_CREDIT', 'Admin: {reference}'),
+        ADMIN_DEBIT: ('ADMIN_DEBIT', 'Admin: {reference}'),
+        SYSTEM_WITHDRAWAL: ('SYSTEM_WITHDRAWAL', 'Penarikan dana ke akun admin {counterparty}'),
+        ADMIN_DEPOSIT: ('ADMIN_DEPOSIT', 'Deposit dana dari Akun Kas Sistem'),
+        GACHA_PLAY: ('GACHA_PLAY', "Bermain Gacha: Mendapatkan '{reference}'"),
+    }
+
+    id = db.Column(db.Integer, primary_key=True)
+    entry_id = db.Column(db.Integer, db.ForeignKey('journal_entry.id'), nullable=False)
+    account_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     counterparty_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)
-    description = db.Column(db.String(255), nullable=True)
-    timestamp = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    leg_type = db.Column(db.SmallInteger, nullable=False)
+    amount = db.Column(db.Integer, nullable=False) # Signed, in cents
 
-    user = db.relationship('User', foreign_keys=[user_id], backref=db.backref('transactions', cascade="all, delete-orphan"))
+    account = db.relationship('User', foreign_keys=[account_id], backref=db.backref('journal_legs', cascade="all, delete-orphan"))
     counterparty = db.relationship('User', foreign_keys=[counterparty_id])
-    payment = db.relationship('Payment', backref=db.backref('transactions', cascade="all, delete-orphan"))
+
+    # Covers the per-user history listing (newest first) and its keyset cursor
+    __table_args__ = (db.Index('ix_journal_leg_account_id', 'account_id', 'id'),)
+
+    # --- Read-side view of the old Transaction row, used by the templates ---
+
+    @property
+    def transaction_type(self):
+        if self.leg_type == JournalLeg.LEGACY:
+            return self.entry.reference or 'LAINNYA'
+        return JournalLeg.TYPES[self.leg_type][0]
+
+    @property
+    def description(self):
+        if self.entry.memo:
+            return self.entry.memo
+        if self.leg_type not in JournalLeg.TYPES:
+            return ''
+        return JournalLeg.TYPES[self.leg_type][1].format(
+            counterparty=self.counterparty.email if self.counterparty else '-',
+            reference=self.entry.reference or ''
+        )
+
+    @property
+    def timestamp(self):
+        return self.entry.created_at
+
+    @property
+    def payment(self):
+        return self.entry.payment
 
     def __repr__(self):
-        return f"Transaction('{self.user.email}', '{self.transaction_type}', {self.amount})"
+        return f"<JournalLeg {self.account_id} {self.transaction_type} {self.amount}>"
 
 class Payment(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -151,6 +286,9 @@ class Payment(db.Model):
     merchant = db.relationship('User', foreign_keys=[merchant_id])
     payer = db.relationship('User', foreign_keys=[payer_id])
 
+    # Lets the expiry sweeper find the oldest PENDING rows without scanning paid ones
+    __table_args__ = (db.Index('ix_payment_status_created_at', 'status', 'created_at'),)
+
     def __repr__(self):
         return f"<Payment {self.payment_id} - {self.status}>"
 
@@ -158,6 +296,122 @@ class Payment(db.Model):
         s = URLSafeTimedSerializer(current_app.config['SECRET_KEY'])
         return s.dumps(self.payment_id, salt='payment-url-salt')
 
+class FeeShard(db.Model):
+    """
+    One of N accumulator rows for platform fees. Payments add their fees to a
+    random shard instead of the single system account row, and a roll-up
+    periodically folds the shards into the system account balance.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    shard_no = db.Column(db.Integer, unique=True, nullable=False)
+    balance = db.Column(db.Integer, nullable=False, default=0) # Fees not yet rolled up, in cents
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    def __repr__(self):
+        return f"<FeeShard {self.shard_no}: {self.balance}>"
+
+class StatShard(db.Model):
+    """
+    One of N accumulator rows for the admin dashboard totals. Each commit adds
+    its changes to a random shard (app/stats.py), so the dashboard sums a few
+    shard rows instead of scanning the user and ledger tables.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    shard_no = db.Column(db.Integer, unique=True, nullable=False)
+    user_count = db.Column(db.BigInteger, nullable=False, default=0)
+    total_balance = db.Column(db.BigInteger, nullable=False, default=0) # Sum of user balances, in cents
+    journal_leg_count = db.Column(db.BigInteger, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    recomputed_at = db.Column(db.DateTime, nullable=True) # Last full recount (flask recompute-stats)
+
+    def __repr__(self):
+        return f"<StatShard {self.shard_no}>"
+
+class RevenueHourly(db.Model):
+    """
+    Fee revenue per UTC hour, source (TRANSFER, LINK, QR) and side (payer or
+    merchant). Kept up to date on every commit that records fees (app/revenue.py),
+    each commit adding to one randomly chosen shard of the bucket; readers sum the shards.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    bucket_start = db.Column(db.DateTime, nullable=False) # UTC, start of the hour
+    source = db.Column(db.String(20), nullable=False)
+    side = db.Column(db.String(10), nullable=False)
+    shard_no = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    amount = db.Column(db.BigInteger, nullable=False, default=0) # In cents
+    fee_count = db.Column(db.Integer, nullable=False, default=0)
+
+    __table_args__ = (db.UniqueConstraint('bucket_start', 'source', 'side', 'shard_no', name='_revenue_hourly_bucket_uc'),)
+
+    def __repr__(self):
+        return f"<RevenueHourly {self.bucket_start} {self.source}/{self.side} #{self.shard_no}: {self.amount}>"
+
+class RevenueDaily(db.Model):
+    """Fee revenue per UTC day, source, side and shard; weeks and months are summed from these rows."""
+    id = db.Column(db.Integer, primary_key=True)
+    day = db.Column(db.Date, nullable=False) # UTC
+    source = db.Column(db.String(20), nullable=False)
+    side = db.Column(db.String(10), nullable=False)
+    shard_no = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    amount = db.Column(db.BigInteger, nullable=False, default=0) # In cents
+    fee_count = db.Column(db.Integer, nullable=False, default=0)
+
+    __table_args__ = (db.UniqueConstraint('day', 'source', 'side', 'shard_no', name='_revenue_daily_bucket_uc'),)
+
+    def __repr__(self):
+        return f"<RevenueDaily {self.day} {self.source}/{self.side} #{self.shard_no}: {self.amount}>"
+
+class WebhookDelivery(db.Model):
+    """A queued merchant webhook, written in the same transaction as the payment it reports."""
+    id = db.Column(db.Integer, primary_key=True)
+    payment_id = db.Column(db.Integer, db.ForeignKey('payment.id'), nullable=False)
+    api_key_id = db.Column(db.Integer, db.ForeignKey('api_key.id'), nullable=False)
+    merchant_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    event = db.Column(db.String(50), nullable=False, default='payment.paid')
+    url = db.Column(db.String(255), nullable=False)
+    payload = db.Column(db.Text, nullable=False) # Raw JSON body, signed at send time
+
+    status = db.Column(db.String(20), nullable=False, default='PENDING') # PENDING, SENDING, DELIVERED, FAILED
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow) # Retry time, or lease expiry while SENDING
+    last_status_code = db.Column(db.Integer, nullable=True)
+    last_error = db.Column(db.String(255), nullable=True)
+
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    delivered_at = db.Column(db.DateTime, nullable=True)
+
+    # The dispatcher polls for due rows by status and time
+    __table_args__ = (db.Index('ix_webhook_delivery_status_next_attempt', 'status', 'next_attempt_at'),)
+
+    payment = db.relationship('Payment')
+    api_key = db.relationship('APIKey', backref=db.backref('webhook_deliveries', lazy=True, cascade="all, delete-orphan"))
+
+    def __repr__(self):
+        return f"<WebhookDelivery {self.id} - {self.status}>"
+
+class OutboxEmail(db.Model):
+    """An email waiting to be sent by the outbox sender pool."""
+    id = db.Column(db.Integer, primary_key=True)
+    subject = db.Column(db.String(255), nullable=False)
+    sender = db.Column(db.String(120), nullable=True)
+    recipients = db.Column(db.Text, nullable=False) # Comma-separated addresses
+    body = db.Column(db.Text, nullable=False)
+    recipient_domain = db.Column(db.String(120), nullable=False) # Mailbox provider, used for rate limiting
+
+    status = db.Column(db.String(20), nullable=False, default='PENDING') # PENDING, SENDING, SENT, FAILED
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow) # Retry time, or lease expiry while SENDING
+    last_error = db.Column(db.String(255), nullable=True)
+
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    sent_at = db.Column(db.DateTime, nullable=True)
+    expires_at = db.Column(db.DateTime, nullable=True) # OTP/reset link lifetime; unsent emails are dropped after it
+
+    __table_args__ = (db.Index('ix_outbox_email_status_next_attempt', 'status', 'next_attempt_at'),)
+
+    def __repr__(self):
+        return f"<OutboxEmail {self.id} - {self.status}>"
+
 class PushSubscription(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
@@ -167,6 +421,22 @@ class PushSubscription(db.Model):
     def __repr__(self):
         return f"<PushSubscription {self.user.email}>"
 
+class PinSession(db.Model):
+    """
+    A "PIN verified for N minutes" window (see app/pin_session.py). The raw
+    token only lives in the user's signed session cookie; the row keeps its
+    hash and the device it was granted to, so it can be revoked server-side.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False, index=True)
+    token_hash = db.Column(db.String(64), nullable=False, unique=True)
+    device_hash = db.Column(db.String(64), nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    expires_at = db.Column(db.DateTime, nullable=False)
+
+    def __repr__(self):
+        return f"<PinSession user:{self.user_id} until {self.expires_at}>"
+
 class SplitBill(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(150), nullable=False)
@@ -0,0 +1,80 @@
+import re
+import threading
+import time
+from flask import current_app
+
+_store_lock = threading.Lock()
+
+NONCE_PATTERN = re.compile(r'^[A-Za-z0-9_\-]{16,64}$')
+
+
+class NonceStoreFull(Exception):
+    """Raised when the in-memory store has no room left for a new nonce."""
+
+
+def get_nonce_store(app=None):
+    """Returns the app's nonce store, built from API_NONCE_STORAGE_URI on first use."""
+    app = app or current_app._get_current_object()
+    with _store_lock:
+        store = app.extensions.get('api_nonce_store')
+        if store is None:
+            store = app.extensions['api_nonce_store'] = create_nonce_store(
+                app.config['API_NONCE_STORAGE_URI'],
+                app.config['API_NONCE_MAX_ENTRIES']
+            )
+    return store
+
+def create_nonce_store(uri, max_entries):
+    """Builds a nonce store from a storage URI (memory:// or redis://...)."""
+    if uri.startswith('memory://'):
+        return MemoryNonceStore(max_entries)
+    if uri.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisNonceStore(uri)
+    raise ValueError(f"Unsupported API_NONCE_STORAGE_URI: {uri}")
+
+
+class MemoryNonceStore:
+    """
+    Seen-nonce set for a single process, split into one-second buckets by
+    expiry time. Expired buckets are dropped whole, so cleanup costs nothing
+    per nonce and memory stays bounded by max_entries.
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._buckets = {}  # expiry second -> set of keys
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def add(self, key, expires_at):
+        """Records a nonce until expires_at (unix time). Returns False if it was already seen."""
+        now = int(time.time())
+        with self._lock:
+            self._expire(now)
+            for bucket in self._buckets.values():
+                if key in bucket:
+                    return False
+            if self._size >= self.max_entries:
+                raise NonceStoreFull()
+            self._buckets.setdefault(int(expires_at), set()).add(key)
+            self._size += 1
+            return True
+
+    def _expire(self, now):
+        for second in [s for s in self._buckets if s < now]:
+            self._size -= len(self._buckets.pop(second))
+
+
+class RedisNonceStore:
+    """Nonce store shared by every worker, using SET NX with an expiry."""
+
+    def __init__(self, uri):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("API_NONCE_STORAGE_URI points at Redis but the 'redis' package is not installed.")
+        self.client = redis.Redis.from_url(uri)
+
+    def add(self, key, expires_at):
+        ttl = max(1, int(expires_at - time.time()) + 1)
+        return bool(self.client.set(f"gabutpay:nonce:{key}", 1, nx=True, ex=ttl))
@@ -0,0 +1,234 @@
+import random
+import threading
+import time
+from datetime import datetime, timedelta
+from flask import current_app
+from flask_mail import Message
+from . import db, mail
+from .models import OutboxEmail
+
+_sender_lock = threading.Lock()
+
+def queue_email(subject, recipients, body, sender=None, expires_at=None):
+    """
+    Stores an email in the outbox and wakes the sender pool.
+    expires_at is when the body (an OTP or reset link) stops being useful; an
+    email not sent by then is dropped and its body erased.
+    Commits the current session, so call it after the request's own changes are saved.
+    """
+    recipients = list(recipients)
+    email = OutboxEmail(
+        subject=subject,
+        sender=sender or current_app.config['MAIL_USERNAME'],
+        recipients=','.join(recipients),
+        body=body,
+        recipient_domain=recipients[0].rsplit('@', 1)[-1].lower(),
+        next_attempt_at=datetime.utcnow(),
+        expires_at=expires_at
+    )
+    db.session.add(email)
+    db.session.commit()
+
+    if current_app.config['MAIL_OUTBOX_INPROCESS_WORKER']:
+        email_sender = get_email_sender()
+        email_sender.start()
+        email_sender.notify()
+    return email
+
+def get_email_sender(app=None):
+    """Returns the app's single EmailSender, creating it if needed."""
+    app = app or current_app._get_current_object()
+    with _sender_lock:
+        email_sender = app.extensions.get('email_sender')
+        if email_sender is None:
+            email_sender = app.extensions['email_sender'] = EmailSender(app)
+    return email_sender
+
+
+class DomainRateLimiter:
+    """Token bucket per recipient domain (mailbox provider), shared by every sender thread in the process."""
+
+    def __init__(self, per_minute):
+        self.rate = per_minute / 60.0
+        self.capacity = max(1, per_minute)
+        self._buckets = {}  # domain -> (tokens, last refill time)
+        self._lock = threading.Lock()
+
+    def try_acquire(self, domain):
+        now = time.monotonic()
+        with self._lock:
+            tokens, last = self._buckets.get(domain, (self.capacity, now))
+            tokens = min(self.capacity, tokens + (now - last) * self.rate)
+            if tokens < 1:
+                self._buckets[domain] = (tokens, now)
+                return False
+            self._buckets[domain] = (tokens - 1, now)
+            return True
+
+
+class EmailSender:
+    """
+    Fixed-size pool of sender threads draining the email outbox.
+
+    Each thread keeps one SMTP connection open and sends every message that
+    arrives before it has been idle for MAIL_OUTBOX_IDLE_TIMEOUT seconds,
+    instead of one handshake per email. Rows are claimed with a conditional
+    UPDATE so several processes can share the outbox, sends are throttled
+    per recipient domain, and failures are retried with backoff.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        config = app.config
+        self.pool_size = config['MAIL_OUTBOX_WORKERS']
+        self.idle_timeout = config['MAIL_OUTBOX_IDLE_TIMEOUT']
+        self.poll_interval = config['MAIL_OUTBOX_POLL_INTERVAL']
+        self.max_attempts = config['MAIL_OUTBOX_MAX_ATTEMPTS']
+        self.rate_limiter = DomainRateLimiter(config['MAIL_RATE_PER_DOMAIN_PER_MINUTE'])
+        self._threads = []
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition()
+        self._stop = threading.Event()
+
+    # --- Lifecycle ---
+
+    def start(self):
+        """Starts the sender threads if they are not already running."""
+        with self._lock:
+            if any(thread.is_alive() for thread in self._threads):
+                return
+            self._stop.clear()
+            self._threads = [
+                threading.Thread(target=self._run_worker, name=f'email-sender-{i}', daemon=True)
+                for i in range(self.pool_size)
+            ]
+            for thread in self._threads:
+                thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self.notify()
+
+    def join(self):
+        for thread in self._threads:
+            while thread.is_alive():
+                thread.join(timeout=1)
+
+    def notify(self):
+        with self._wakeup:
+            self._wakeup.notify_all()
+
+    def _wait(self, timeout):
+        with self._wakeup:
+            self._wakeup.wait(timeout)
+
+    # --- Worker ---
+
+    def _run_worker(self):
+        with self.app.app_context():
+            while not self._stop.is_set():
+                try:
+                    claimed = self._claim_next()
+                except Exception as e:
+                    db.session.rollback()
+                    self.app.logger.error(f"Email outbox poll failed: {e}")
+                    claimed = None
+
+                if claimed is None:
+                    self._wait(self.poll_interval)
+                    continue
+
+                try:
+                    with mail.connect() as conn:
+                        while claimed is not None:
+                            sent = self._send(conn, claimed)
+                            claimed = None
+                            if not sent:
+                                break  # The connection may be broken; reconnect for the next message
+                            claimed = self._claim_while_idle()
+                except Exception as e:
+                    # Connecting, logging in or quitting failed
+                    self.app.logger.error(f"SMTP connection error in email outbox: {e}")
+                    if claimed is not None:
+                        self._record_result(claimed['id'], str(e))
+                finally:
+                    db.session.remove()
+
+    def _claim_while_idle(self):
+        """Waits up to the idle timeout for another message, keeping the SMTP connection open."""
+        deadline = time.monotonic() + self.idle_timeout
+        while not self._stop.is_set():
+            claimed = self._claim_next()
+            remaining = deadline - time.monotonic()
+            if claimed is not None or remaining <= 0:
+                return claimed
+            self._wait(min(self.poll_interval, remaining))
+        return None
+
+    def _claim_next(self):
+        """Claims one due email whose domain is under its rate limit. Returns a plain snapshot or None."""
+        now = datetime.utcnow()
+        # SENDING rows whose lease has expired belong to a worker that died mid-send
+        due = OutboxEmail.query.filter(
+            OutboxEmail.status.in_(['PENDING', 'SENDING']),
+            OutboxEmail.next_attempt_at <= now
+        ).order_by(OutboxEmail.next_attempt_at).limit(20).all()
+
+        for email in due:
+            if email.expires_at and email.expires_at <= now:
+                # The code or link inside is dead; sending it would only leak it
+                email.status = 'FAILED'
+                email.body = ''
+                email.last_error = 'Expired before it could be sent'
+                continue
+            if not self.rate_limiter.try_acquire(email.recipient_domain):
+                continue
+
+            snapshot = {
+                'id': email.id, 'subject': email.subject, 'sender': email.sender,
+                'recipients': email.recipients.split(','), 'body': email.body
+            }
+            claimed = OutboxEmail.query.filter(
+                OutboxEmail.id == email.id,
+                OutboxEmail.status == email.status,
+                OutboxEmail.next_attempt_at == email.next_attempt_at
+            ).update({'status': 'SENDING', 'next_attempt_at': now + timedelta(minutes=2)}, synchronize_session=False)
+            db.session.commit()
+            if claimed:
+                return snapshot
+
+        db.session.commit()  # End the read transaction
+        return None
+
+    def _send(self, conn, claimed):
+        """Sends one message on an open connection. Returns False if it failed."""
+        msg = Message(claimed['subject'], sender=claimed['sender'], recipients=claimed['recipients'])
+        msg.body = claimed['body']
+        try:
+            conn.send(msg)
+        except Exception as e:
+            self.app.logger.error(f"Failed to send outbox email {claimed['id']}: {e}")
+            self._record_result(claimed['id'], str(e))
+            return False
+        self._record_result(claimed['id'], None)
+        return True
+
+    def _record_result(self, email_id, error):
+        email = db.session.get(OutboxEmail, email_id)
+        email.attempts += 1
+        email.last_error = error[:255] if error else None
+
+        if error is None:
+            email.status = 'SENT'
+            email.sent_at = datetime.utcnow()
+            # OTPs and reset links should not outlive delivery
+            email.body = ''
+        elif email.attempts >= self.max_attempts or (email.expires_at and email.expires_at <= datetime.utcnow()):
+            email.status = 'FAILED'
+            email.body = ''
+            self.app.logger.error(f"Outbox email {email_id} failed permanently after {email.attempts} attempt(s).")
+        else:
+            delay = min(30 * (2 ** (email.attempts - 1)), 3600)
+            email.status = 'PENDING'
+            email.next_attempt_at = datetime.utcnow() + timedelta(seconds=random.uniform(delay / 2, delay))
+        db.session.commit()
@@ -0,0 +1,124 @@
+import threading
+from datetime import datetime, timedelta
+from flask import current_app
+from . import db
+from .models import Payment, APIKey
+from .webhooks import enqueue_webhook, notify_dispatcher
+from .lock_stats import timed_lock
+
+_sweeper_lock = threading.Lock()
+
+
+def expire_pending_payments(batch_size=None, max_batches=None, now=None):
+    """
+    Marks PENDING payments older than PAYMENT_EXPIRY_MINUTES as EXPIRED, in
+    batches of batch_size rows with a commit after each, so no transaction
+    holds many row locks. Stops after max_batches batches if given.
+    Returns the number of payments expired.
+    """
+    batch_size = batch_size or current_app.config['PAYMENT_EXPIRY_BATCH_SIZE']
+    cutoff = (now or datetime.utcnow()) - timedelta(minutes=current_app.config['PAYMENT_EXPIRY_MINUTES'])
+    expired = 0
+    batches = 0
+    while max_batches is None or batches < max_batches:
+        claimed, count = _expire_batch(cutoff, batch_size)
+        expired += count
+        batches += 1
+        if claimed < batch_size:
+            break
+    return expired
+
+def _expire_batch(cutoff, batch_size):
+    """Returns (rows claimed, rows expired) for one batch."""
+    # Rows another sweeper (or a payer claiming the payment) holds are skipped, not waited for
+    with timed_lock('payment_expiry.claim', 'payment'):
+        payments = Payment.query.filter(Payment.status == 'PENDING', Payment.created_at < cutoff)\
+            .order_by(Payment.created_at).limit(batch_size)\
+            .with_for_update(skip_locked=True).all()
+    if not payments:
+        db.session.rollback()
+        return 0, 0
+
+    ids = [payment.id for payment in payments]
+    updated = Payment.query.filter(Payment.id.in_(ids), Payment.status == 'PENDING')\
+        .update({'status': 'EXPIRED'}, synchronize_session='evaluate')
+    if updated != len(ids):
+        # Only possible without row locks (SQLite): a row was paid in between. The next batch retries the rest.
+        db.session.rollback()
+        return len(ids), 0
+
+    deliveries = 0
+    if current_app.config['PAYMENT_EXPIRY_WEBHOOKS']:
+        deliveries = _queue_expiry_webhooks(payments)
+    db.session.commit()
+    if deliveries:
+        notify_dispatcher()
+    return len(ids), len(ids)
+
+def _queue_expiry_webhooks(payments):
+    # Same key choice as the payment flow: the merchant's first API key
+    merchant_ids = {payment.merchant_id for payment in payments}
+    api_keys = {}
+    for api_key in APIKey.query.filter(APIKey.user_id.in_(merchant_ids)).order_by(APIKey.id):
+        api_keys.setdefault(api_key.user_id, api_key)
+
+    deliveries = 0
+    for payment in payments:
+        api_key = api_keys.get(payment.merchant_id)
+        if api_key and api_key.webhook_url:
+            enqueue_webhook(payment, api_key, event='payment.expired')
+            deliveries += 1
+    return deliveries
+
+
+def get_expiry_sweeper(app=None):
+    """Returns the app's single PaymentExpirySweeper, creating it if needed."""
+    app = app or current_app._get_current_object()
+    with _sweeper_lock:
+        sweeper = app.extensions.get('payment_expiry_sweeper')
+        if sweeper is None:
+            sweeper = app.extensions['payment_expiry_sweeper'] = PaymentExpirySweeper(app)
+    return sweeper
+
+
+class PaymentExpirySweeper:
+    """
+    Background thread that runs expire_pending_payments every
+    PAYMENT_EXPIRY_INTERVAL seconds. Several processes may run one; locked
+    rows are skipped, so they split the work instead of blocking each other.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.interval = app.config['PAYMENT_EXPIRY_INTERVAL']
+        self.max_batches = app.config['PAYMENT_EXPIRY_MAX_BATCHES']
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Starts the sweeper thread if it is not already running."""
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self.run_forever, name='payment-expiry', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def run_forever(self):
+        """Sweeps until stopped. Used by the sweeper thread and `flask expire-payments --loop`."""
+        with self.app.app_context():
+            while not self._stop.is_set():
+                try:
+                    expired = expire_pending_payments(max_batches=self.max_batches)
+                    if expired:
+                        self.app.logger.info(f"Expired {expired} stale pending payment(s)")
+                except Exception as e:
+                    db.session.rollback()
+                    self.app.logger.error(f"Payment expiry sweep failed: {e}")
+                finally:
+                    db.session.remove()
+                self._stop.wait(self.interval)
@@ -0,0 +1,100 @@
+import hashlib
+import hmac
+import secrets
+from datetime import datetime, timedelta
+from flask import current_app, request, session, g, after_this_request
+from . import db
+from .models import PinSession
+from .hashing import verify_pin, digest_secret
+
+SESSION_KEY = '_pin_session'
+DEVICE_COOKIE = 'gabutpay_device'
+DEVICE_COOKIE_MAX_AGE = 365 * 24 * 3600 # seconds
+
+
+def check_payment_pin(user, pin, amount, remember=False):
+    """
+    Authorises a payment of `amount` cents. With the PIN left empty, an
+    active PIN window on this device covers it; a PIN that was entered is
+    always checked (bcrypt) and, if the user asked for it, opens a new
+    window. Nothing is committed.
+    """
+    if not pin:
+        return find_pin_window(user.id, amount) is not None
+    if not verify_pin(user, pin):
+        return False
+    if remember and pin_window_enabled():
+        grant_pin_window(user.id)
+    return True
+
+def pin_window_enabled():
+    return current_app.config['PIN_SESSION_MINUTES'] > 0
+
+def find_pin_window(user_id, amount=None):
+    """
+    The PinSession that lets this user, on this device, skip the PIN for a
+    payment of `amount` cents (any amount up to the limit if None), or None.
+    """
+    if not pin_window_enabled():
+        return None
+    token = session.get(SESSION_KEY)
+    if not token:
+        return None
+    if amount is not None and amount > current_app.config['PIN_SESSION_MAX_AMOUNT']:
+        return None
+    window = PinSession.query.filter_by(token_hash=digest_secret(token)).first()
+    if window is None or window.user_id != user_id or window.expires_at <= datetime.utcnow():
+        return None
+    device_hash = _device_hash()
+    if device_hash is None or not hmac.compare_digest(window.device_hash, device_hash):
+        return None
+    return window
+
+def grant_pin_window(user_id):
+    """Opens a window after a successful PIN check, replacing this device's previous one."""
+    revoke_current_pin_window()
+    now = datetime.utcnow()
+    PinSession.query.filter(PinSession.user_id == user_id, PinSession.expires_at <= now)\
+        .delete(synchronize_session=False)
+    token = secrets.token_urlsafe(32)
+    window = PinSession(
+        user_id=user_id,
+        token_hash=digest_secret(token),
+        device_hash=_device_hash(create=True),
+        created_at=now,
+        expires_at=now + timedelta(minutes=current_app.config['PIN_SESSION_MINUTES'])
+    )
+    db.session.add(window)
+    session[SESSION_KEY] = token
+    return window
+
+def revoke_current_pin_window():
+    """Ends the window held by this browser session (logout)."""
+    token = session.pop(SESSION_KEY, None)
+    if token:
+        PinSession.query.filter_by(token_hash=digest_secret(token)).delete(synchronize_session=False)
+
+def revoke_pin_windows(user_id):
+    """Ends every window of a user on every device (ban, PIN or password change)."""
+    PinSession.query.filter_by(user_id=user_id).delete(synchronize_session=False)
+
+def _device_hash(create=False):
+    """
+    HMAC of this browser's random device cookie, or None if it has none (a
+    new one is set when create is True). The cookie is separate from the
+    session and HttpOnly, so a session cookie replayed on its own does not
+    carry the window. It only helps against that: whoever copies the whole
+    cookie jar has the device cookie too.
+    """
+    device_id = request.cookies.get(DEVICE_COOKIE) or g.get('pin_device_id')
+    if not device_id:
+        if not create:
+            return None
+        device_id = g.pin_device_id = secrets.token_urlsafe(32)
+
+        @after_this_request
+        def set_device_cookie(response):
+            response.set_cookie(DEVICE_COOKIE, device_id, max_age=DEVICE_COOKIE_MAX_AGE,
+                                secure=request.is_secure, httponly=True, samesite='Lax')
+            return response
+    return hmac.new(current_app.config['SECRET_KEY'].encode('utf-8'), device_id.encode('utf-8'), hashlib.sha256).hexdigest()
@@ -1,60 +1,158 @@
 import json
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
 from flask import Blueprint, request, jsonify, current_app
 from flask_login import login_required, current_user
 from pywebpush import webpush, WebPushException
-from .models import PushSubscription, User
+from py_vapid import Vapid
+from .models import PushSubscription
 from . import db
 
 push_bp = Blueprint('push', __name__)
 
+_dispatcher_lock = threading.Lock()
+
 def send_push_notification(user_id, payload):
     """
-    Sends a push notification to a specific user.
-    Handles deletion of expired/invalid subscriptions.
+    Queues a push notification for a specific user and returns immediately.
+    Delivery, and deletion of expired/invalid subscriptions, happen on the
+    background PushDispatcher.
     Payload should be a dict, e.g., {"title": "Hello", "body": "..."}
     """
-    try:
-        user = User.query.get(user_id)
-        if not user or not user.push_subscriptions:
-            return
-
-        vapid_claims = {
-            "sub": f"mailto:{current_app.config['VAPID_CLAIM_EMAIL']}"
-        }
-        
-        subscriptions_to_delete = []
-
-        for sub in user.push_subscriptions:
-            try:
-                subscription_data = json.loads(sub.subscription_json)
-                webpush(
-                    subscription_info=subscription_data,
-                    data=json.dumps(payload),
-                    vapid_private_key=current_app.config['VAPID_PRIVATE_KEY'],
-                    vapid_claims=vapid_claims
-                )
-            except WebPushException as ex:
-                current_app.logger.warning(f"WebPushException for user {user_id}, sub ID {sub.id}: {ex}")
-                # 404 and 410 status codes indicate the subscription is no longer valid.
-                if ex.response and ex.response.status_code in [404, 410]:
-                    current_app.logger.info(f"Marking subscription {sub.id} for deletion.")
-                    subscriptions_to_delete.append(sub)
-            except Exception as e:
-                # Catch other potential errors like JSON parsing
-                current_app.logger.error(f"Inner error sending push to sub {sub.id}: {e}")
+    if not current_app.config.get('VAPID_PRIVATE_KEY'):
+        return
+    get_push_dispatcher().submit(user_id, payload)
+
+def get_push_dispatcher(app=None):
+    """Returns the app's single PushDispatcher, starting it on first use."""
+    app = app or current_app._get_current_object()
+    with _dispatcher_lock:
+        dispatcher = app.extensions.get('push_dispatcher')
+        if dispatcher is None:
+            dispatcher = app.extensions['push_dispatcher'] = PushDispatcher(app)
+            dispatcher.start()
+    return dispatcher
+
+
+class PushDispatcher:
+    """
+    Sends web push notifications off the request thread.
+
+    Jobs go into a bounded in-memory queue. A collector thread drains up to
+    PUSH_BATCH_SIZE jobs at a time, loads all their subscriptions in one
+    query, fans the sends out over a thread pool using one keep-alive
+    session per push service origin, and deletes every subscription that
+    answered 404/410 in a single statement.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.batch_size = app.config['PUSH_BATCH_SIZE']
+        self.timeout = app.config['PUSH_TIMEOUT']
+        self.jobs = queue.Queue(maxsize=app.config['PUSH_QUEUE_SIZE'])
+        self.executor = ThreadPoolExecutor(max_workers=app.config['PUSH_WORKERS'], thread_name_prefix='push')
+        self._sessions = {}  # push service origin -> requests.Session
+        self._lock = threading.Lock()
+        self._vapid = None
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='push-dispatcher', daemon=True)
+        self._thread.start()
 
+    def submit(self, user_id, payload):
+        try:
+            self.jobs.put_nowait((user_id, payload))
+        except queue.Full:
+            self.app.logger.warning(f"Push queue full, dropping notification for user {user_id}")
+
+    def _run(self):
+        while True:
+            batch = [self.jobs.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.jobs.get_nowait())
+                except queue.Empty:
+                    break
+
+            with self.app.app_context():
+                try:
+                    self._send_batch(batch)
+                except Exception as e:
+                    db.session.rollback()
+                    self.app.logger.error(f"General error sending push notification batch: {e}")
+                finally:
+                    db.session.remove()
+
+    def _send_batch(self, batch):
+        user_ids = {user_id for user_id, _ in batch}
+        subscriptions = db.session.query(
+            PushSubscription.id, PushSubscription.user_id, PushSubscription.subscription_json
+        ).filter(PushSubscription.user_id.in_(user_ids)).all()
+        # Release the connection while the network calls run
+        db.session.remove()
+
+        subs_by_user = {}
+        for sub_id, user_id, subscription_json in subscriptions:
+            subs_by_user.setdefault(user_id, []).append((sub_id, subscription_json))
+
+        futures = []
+        for user_id, payload in batch:
+            data = json.dumps(payload)
+            for sub_id, subscription_json in subs_by_user.get(user_id, []):
+                futures.append(self.executor.submit(self._send_one, user_id, sub_id, subscription_json, data))
+
+        subscriptions_to_delete = [sub_id for future in futures if (sub_id := future.result()) is not None]
         if subscriptions_to_delete:
-            current_app.logger.info(f"Deleting {len(subscriptions_to_delete)} invalid subscriptions for user {user_id}.")
-            for sub in subscriptions_to_delete:
-                db.session.delete(sub)
+            self.app.logger.info(f"Deleting {len(subscriptions_to_delete)} invalid push subscriptions.")
+            PushSubscription.query.filter(PushSubscription.id.in_(subscriptions_to_delete)).delete(synchronize_session=False)
             db.session.commit()
 
-        current_app.logger.info(f"Finished sending push notifications to user {user_id}")
+        self.app.logger.info(f"Finished sending {len(futures)} push notifications for {len(batch)} job(s)")
+
+    def _send_one(self, user_id, sub_id, subscription_json, data):
+        """Sends to one subscription. Returns the subscription id if it is gone and should be deleted."""
+        try:
+            subscription_data = json.loads(subscription_json)
+            webpush(
+                subscription_info=subscription_data,
+                data=data,
+                vapid_private_key=self._get_vapid(),
+                # webpush fills in aud/exp on this dict, so it must not be shared between calls
+                vapid_claims={"sub": f"mailto:{self.app.config['VAPID_CLAIM_EMAIL']}"},
+                timeout=self.timeout,
+                requests_session=self._session_for(subscription_data['endpoint'])
+            )
+        except WebPushException as ex:
+            self.app.logger.warning(f"WebPushException for user {user_id}, sub ID {sub_id}: {ex}")
+            # 404 and 410 status codes indicate the subscription is no longer valid.
+            if ex.response is not None and ex.response.status_code in [404, 410]:
+                return sub_id
+        except Exception as e:
+            # Catch other potential errors like JSON parsing
+            self.app.logger.error(f"Inner error sending push to sub {sub_id}: {e}")
+        return None
+
+    def _get_vapid(self):
+        """Parses the VAPID private key once instead of on every send."""
+        if self._vapid is None:
+            self._vapid = Vapid.from_string(private_key=self.app.config['VAPID_PRIVATE_KEY'])
+        return self._vapid
 
-    except Exception as e:
-        # Catch outer errors like failing to fetch the user
-        db.session.rollback()
-        current_app.logger.error(f"General error sending push notification to user {user_id}: {e}")
+    def _session_for(self, endpoint):
+        parts = urlsplit(endpoint)
+        origin = f"{parts.scheme}://{parts.netloc}"
+        with self._lock:
+            session = self._sessions.get(origin)
+            if session is None:
+                session = requests.Session()
+                session.mount(origin, HTTPAdapter(pool_maxsize=self.app.config['PUSH_WORKERS']))
+                self._sessions[origin] = session
+        return session
 
 
 @push_bp.route('/subscribe', methods=['POST'])
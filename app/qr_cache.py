@@ -0,0 +1,172 @@
+import hashlib
+import hmac
+import io
+import json
+import multiprocessing
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import qrcode
+from flask import current_app
+
+QR_LIFETIME = 300 # seconds a QR payload stays valid
+# exp is rounded down to a multiple of this, so every view of a payment within
+# the same minute (on any worker) gets the same payload, image and URL
+EXP_STEP = 60
+
+_cache_lock = threading.Lock()
+_renderer_lock = threading.Lock()
+
+
+def qr_expiry(now=None):
+    """The exp for a QR shown now: between QR_LIFETIME - EXP_STEP and QR_LIFETIME seconds away."""
+    now = time.time() if now is None else now
+    return int((now + QR_LIFETIME) // EXP_STEP * EXP_STEP)
+
+def is_valid_qr_expiry(exp, now=None):
+    """True if exp is one qr_expiry() could have issued and has not passed yet."""
+    now = time.time() if now is None else now
+    return exp % EXP_STEP == 0 and now < exp <= now + QR_LIFETIME
+
+def build_qr_data(payment, exp):
+    """The signed JSON string encoded in a payment's QR code."""
+    secret_key = current_app.config['QR_HMAC_SECRET_KEY']
+    if not secret_key:
+        raise ValueError("QR_HMAC_SECRET_KEY is not configured.")
+
+    payload = {
+        "txid": payment.payment_id,
+        "amount": payment.amount,
+        "exp": exp
+    }
+    # Sort keys to ensure consistent string for signing
+    payload_string = json.dumps(payload, sort_keys=True)
+    sig = hmac.new(
+        secret_key.encode('utf-8'),
+        payload_string.encode('utf-8'),
+        hashlib.sha256
+    ).hexdigest()
+    return json.dumps({"payload": payload, "sig": sig})
+
+def qr_digest(data):
+    """The SHA-256 of a QR payload; names both the cached image and its ETag."""
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+def get_qr_png(payment, exp):
+    """Returns (digest, png_bytes) for the payment's QR with the given exp."""
+    data = build_qr_data(payment, exp)
+    digest = qr_digest(data)
+    return digest, get_cached_qr_png(data, digest, exp)
+
+def get_cached_qr_png(data, digest, exp):
+    """
+    Returns the PNG for data, whose qr_digest() is digest. Images are cached
+    by digest until exp; concurrent requests for the same image wait for a
+    single render.
+    """
+    app = current_app._get_current_object()
+    return get_qr_cache(app).get_or_render(digest, exp, lambda: _submit_render(app, data))
+
+def render_qr_png(data):
+    """Rasterizes data into a PNG. Runs in the renderer processes, so it must not need the app."""
+    qr = qrcode.QRCode(error_correction=qrcode.constants.ERROR_CORRECT_L)
+    qr.add_data(data)
+    qr.make(fit=True)
+    img = qr.make_image(fill='black', back_color='white')
+    buffer = io.BytesIO()
+    img.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def get_qr_cache(app=None):
+    """Returns the app's single QRImageCache, creating it if needed."""
+    app = app or current_app._get_current_object()
+    with _cache_lock:
+        cache = app.extensions.get('qr_cache')
+        if cache is None:
+            cache = app.extensions['qr_cache'] = QRImageCache(
+                app.config['QR_CACHE_SIZE'],
+                app.config['QR_RENDER_TIMEOUT']
+            )
+    return cache
+
+def get_qr_renderer(app=None):
+    """Returns the app's renderer process pool, or None when QR_RENDER_PROCESSES is 0."""
+    app = app or current_app._get_current_object()
+    if app.config['QR_RENDER_PROCESSES'] <= 0:
+        return None
+    with _renderer_lock:
+        pool = app.extensions.get('qr_renderer')
+        if pool is None:
+            # Spawned, not forked: forking a process that runs threads can copy held locks
+            pool = app.extensions['qr_renderer'] = ProcessPoolExecutor(
+                max_workers=app.config['QR_RENDER_PROCESSES'],
+                mp_context=multiprocessing.get_context('spawn')
+            )
+    return pool
+
+def _submit_render(app, data):
+    pool = get_qr_renderer(app)
+    if pool is None:
+        future = Future()
+        try:
+            future.set_result(render_qr_png(data))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+    try:
+        return pool.submit(render_qr_png, data)
+    except BrokenProcessPool:
+        # A renderer died; start a fresh pool for the next request
+        with _renderer_lock:
+            if app.extensions.get('qr_renderer') is pool:
+                del app.extensions['qr_renderer']
+        raise
+
+
+class QRImageCache:
+    """
+    Thread-safe LRU of rendered QR images by content digest. Entries expire
+    with the payload they encode. Each entry is the Future of its render, so
+    requests arriving while an image is being rendered wait for that render.
+    """
+
+    def __init__(self, max_size, render_timeout):
+        self.max_size = max_size
+        self.render_timeout = render_timeout
+        self._entries = OrderedDict()  # digest -> (exp, Future)
+        self._lock = threading.Lock()
+
+    def get_or_render(self, digest, exp, submit):
+        """Returns the cached PNG for digest, calling submit() for a render Future if needed."""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(digest)
+                future = entry[1]
+            else:
+                future = submit()
+                if self.max_size > 0:
+                    self._entries[digest] = (exp, future)
+                    self._evict(now)
+        try:
+            return future.result(timeout=self.render_timeout)
+        except Exception:
+            # Do not keep a failed (or hung) render; the next request tries again
+            with self._lock:
+                if self._entries.get(digest, (None, None))[1] is future:
+                    del self._entries[digest]
+            raise
+
+    def _evict(self, now):
+        for digest in [d for d, (exp, _) in self._entries.items() if exp <= now]:
+            del self._entries[digest]
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
@@ -0,0 +1,194 @@
+import os
+import secrets
+import tempfile
+from datetime import datetime, timedelta
+from itertools import count
+from flask import url_for
+from sqlalchemy import event
+from . import db
+from .models import User, APIKey, JournalLeg, Payment, SplitBill, SplitBillParticipant
+from .journal import record_entry
+from .hashing import hash_secret
+from .fees import SYSTEM_EMAIL, ensure_fee_shards, get_system_user_id
+from .stats import recompute_stats
+
+# endpoint -> maximum queries for one GET, including the session user lookup.
+# Every page here must stay O(1) in queries no matter how many rows it lists.
+QUERY_BUDGETS = {
+    'main.dashboard': 3,
+    'main.history': 3,
+    'main.history_json': 3,
+    'main.list_split_bills': 3,
+    'main.split_bill_detail': 4,
+    'main.payment_details': 3,
+    'main.show_qr': 3,
+    'main.pay_page': 4,
+    'admin.dashboard': 4,
+    'admin.revenue': 8,
+    'admin.users': 2,
+}
+
+
+# Rows created per list, so an N+1 shows up as a page over its budget
+FIXTURE_ROWS = 5
+
+# The throwaway app runs without rate limits or background workers, and cheap hashes for its fixture users
+FIXTURE_CONFIG = {
+    'RATELIMIT_ENABLED': False,
+    'RATELIMIT_STORAGE_URI': 'memory://',
+    'WEBHOOK_INPROCESS_WORKER': False,
+    'MAIL_OUTBOX_INPROCESS_WORKER': False,
+    'PAYMENT_EXPIRY_INPROCESS_SWEEPER': False,
+    'BCRYPT_COST_PASSWORD': 4,
+    'BCRYPT_COST_PIN': 4,
+}
+
+
+def create_fixtures(rows=FIXTURE_ROWS):
+    """
+    Fills an empty database with `rows` of everything the budgeted pages list:
+    users, API keys, transfers and paid payments (with their journal legs and
+    fees), pending payments, and split bills with several participants each.
+    Returns the ids of the user whose pages are checked and of an admin.
+    """
+    def make_user(email, **kwargs):
+        user = User(email=email, password_hash=hash_secret('password', secrets.token_hex(16)),
+                    pin_hash=hash_secret('pin', '123456'), is_verified=True, last_seen=datetime.utcnow(), **kwargs)
+        db.session.add(user)
+        return user
+
+    system = make_user(SYSTEM_EMAIL)
+    user = make_user('budget-user@gabutpay.test', balance=rows * 1000000)
+    admin = make_user('budget-admin@gabutpay.test', is_admin=True)
+    others = [make_user(f'budget-{no}@gabutpay.test', balance=1000000) for no in range(rows)]
+    ensure_fee_shards()
+    db.session.flush()
+
+    now = datetime.utcnow()
+    for no, other in enumerate(others):
+        for owner in (user, other):
+            db.session.add(APIKey(
+                public_key=f'pk_budget_{owner.id}_{no}', secret_key_hash='-', secret_key_encrypted='-',
+                webhook_secret_hash='-', webhook_secret_encrypted='-', user_id=owner.id, store_name=f'Toko {no}'
+            ))
+
+        # A transfer out, a transfer in and a paid QR payment, each with the legs the real flows record
+        for payer, payee, method, out_type, fee_type, in_type, payee_fee_type, payer_fee_type in (
+            (user, other, 'TRANSFER', JournalLeg.TRANSFER_OUT, JournalLeg.TRANSFER_PAYER_FEE, JournalLeg.TRANSFER_IN,
+             JournalLeg.TRANSFER_RECIPIENT_FEE, JournalLeg.TRANSFER_SENDER_FEE),
+            (other, user, 'TRANSFER', JournalLeg.TRANSFER_OUT, JournalLeg.TRANSFER_PAYER_FEE, JournalLeg.TRANSFER_IN,
+             JournalLeg.TRANSFER_RECIPIENT_FEE, JournalLeg.TRANSFER_SENDER_FEE),
+            (user, other, 'QR', JournalLeg.PAYMENT_OUT, JournalLeg.PAYMENT_PAYER_FEE, JournalLeg.PAYMENT_IN,
+             JournalLeg.PAYMENT_MERCHANT_FEE, JournalLeg.PAYMENT_SERVICE_FEE),
+        ):
+            payment = Payment(merchant_id=payee.id, payer_id=payer.id, amount=10000, payer_fee=100, merchant_fee=50,
+                              payment_method=method, merchant_order_id=f'budget_{secrets.token_hex(8)}',
+                              status='PAID', paid_at=now - timedelta(hours=no))
+            db.session.add(payment)
+            record_entry([
+                (payer.id, out_type, -10000, payee.id),
+                (payer.id, fee_type, -100, payee.id),
+                (payee.id, in_type, 9950, payer.id),
+                (system.id, payee_fee_type, 50, payee.id),
+                (system.id, payer_fee_type, 100, payer.id),
+            ], payment=payment)
+
+        db.session.add(Payment(merchant_id=other.id, amount=10000, payment_method='QR',
+                               merchant_order_id=f'budget_{secrets.token_hex(8)}'))
+
+        # One bill created by the user and one by someone else, each split between everyone
+        for creator in (user, other):
+            bill = SplitBill(title=f'Patungan {no}', total_amount=10000 * (rows + 1), creator_id=creator.id)
+            db.session.add(bill)
+            for participant in [user] + others:
+                if participant is not creator:
+                    db.session.add(SplitBillParticipant(
+                        split_bill=bill, participant_user_id=participant.id,
+                        participant_email=participant.email, amount_due=10000
+                    ))
+    db.session.flush()
+    recompute_stats()
+    db.session.commit()
+    return user.id, admin.id
+
+def sample_requests(user, admin):
+    """
+    Yields (endpoint, url, login_as) for every budgeted page, using the rows
+    made by create_fixtures. A page yielded with url None has no sample.
+    """
+    yield 'main.dashboard', url_for('main.dashboard'), user
+    yield 'main.history', url_for('main.history'), user
+    yield 'main.history_json', url_for('main.history_json'), user
+    yield 'main.list_split_bills', url_for('main.list_split_bills'), user
+
+    bill = SplitBill.query.filter_by(creator_id=user.id).order_by(SplitBill.id.desc()).first()
+    yield 'main.split_bill_detail', bill and url_for('main.split_bill_detail', bill_id=bill.id), user
+
+    payment = Payment.query.filter_by(payer_id=user.id, status='PAID').order_by(Payment.id.desc()).first()
+    yield 'main.payment_details', payment and url_for('main.payment_details', payment_id=payment.payment_id), user
+
+    pending = Payment.query.filter(Payment.status == 'PENDING', Payment.merchant_id != user.id)\
+        .order_by(Payment.id.desc()).first()
+    yield 'main.show_qr', pending and url_for('main.show_qr', payment_id=pending.payment_id), user
+    yield 'main.pay_page', pending and url_for('main.pay_page', signed_payment_id=pending.get_signed_id()), user
+
+    for endpoint in ('admin.dashboard', 'admin.revenue', 'admin.users'):
+        yield endpoint, url_for(endpoint), admin
+
+
+def check_query_budgets(rows=FIXTURE_ROWS):
+    """
+    Builds a throwaway app on a temporary SQLite database, fills it with
+    create_fixtures(rows), then requests every budgeted page through the test
+    client and counts the SQL statements each one runs. The real database is
+    never touched.
+
+    Returns a list of (endpoint, url, status_code, query_count, budget);
+    status_code and query_count are None for pages without a sample, which
+    callers must treat as failures.
+    """
+    from . import create_app
+
+    with tempfile.TemporaryDirectory() as tmp:
+        app = create_app(dict(FIXTURE_CONFIG, SQLALCHEMY_DATABASE_URI='sqlite:///' + os.path.join(tmp, 'query_budget.db')))
+        try:
+            return _run_checks(app, rows)
+        finally:
+            with app.app_context():
+                db.engine.dispose()
+
+def _run_checks(app, rows):
+    with app.app_context():
+        db.create_all()
+        user_id, admin_id = create_fixtures(rows)
+        # Measure the steady state, where the system account id is already cached in the process
+        get_system_user_id()
+        with app.test_request_context(base_url='https://localhost'):
+            plan = [(endpoint, url, login_as.id)
+                    for endpoint, url, login_as in sample_requests(db.session.get(User, user_id), db.session.get(User, admin_id))]
+        engine = db.engine
+
+    counter = count()
+    def count_statement(*args):
+        next(counter)
+
+    results = []
+    client = app.test_client()
+    event.listen(engine, 'after_cursor_execute', count_statement)
+    try:
+        for endpoint, url, user_id in plan:
+            if url is None:
+                results.append((endpoint, url, None, None, QUERY_BUDGETS[endpoint]))
+                continue
+            with client.session_transaction(base_url='https://localhost') as session:
+                session['_user_id'] = str(user_id)
+                session['_fresh'] = True
+            # A fresh app context per request, so nothing is served from a previous request's session
+            with app.app_context():
+                before = next(counter)
+                response = client.get(url, base_url='https://localhost')
+                queries = next(counter) - before - 1
+            results.append((endpoint, url, response.status_code, queries, QUERY_BUDGETS[endpoint]))
+    finally:
+        event.remove(engine, 'after_cursor_execute', count_statement)
+    return results
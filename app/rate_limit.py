@@ -0,0 +1,209 @@
+import math
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from limits.storage.base import Storage, SlidingWindowCounterSupport, TimestampedSlidingWindow
+
+CLEANUP_INTERVAL = 60 # seconds between purges of expired counters and local leases
+
+
+class _Lease:
+    """Hits of one limit window this worker has already reserved in the shared store."""
+
+    def __init__(self, window_end):
+        self.window_end = window_end
+        self.remaining = 0
+        self.denied_until = 0.0
+
+
+class SQLiteRateLimitStorage(Storage, SlidingWindowCounterSupport, TimestampedSlidingWindow):
+    """
+    Flask-Limiter storage in a SQLite file that every worker process on the
+    host shares, so limits are not multiplied by the worker count and survive
+    restarts. No server is needed: RATELIMIT_STORAGE_URI=sqlite:////path/file.
+
+    With the sliding-window-counter strategy each worker leases a slice of a
+    limit (lease_fraction of it, at least one hit) from the shared counter in
+    a single write and spends it locally, so most hits never touch the file.
+    A refused lease is remembered locally for about one hit's worth of the
+    window. Leases are reserved atomically: all workers together never admit
+    more than the limit, but may admit up to one unspent lease per worker less.
+    """
+
+    STORAGE_SCHEME = ['sqlite']
+
+    def __init__(self, uri, wrap_exceptions=False, lease_fraction=0.05, busy_timeout=5.0, **options):
+        self.path = uri[len('sqlite:///'):]
+        self.lease_fraction = float(lease_fraction)
+        self.busy_timeout = float(busy_timeout)
+        self._init_local_state()
+        if hasattr(os, 'register_at_fork'):
+            # Connections and leases must not be shared with forked workers
+            os.register_at_fork(after_in_child=self._init_local_state)
+        super().__init__(uri, wrap_exceptions=wrap_exceptions, **options)
+
+    def _init_local_state(self):
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._leases = {}  # current window key -> _Lease
+        self._next_cleanup = time.time() + CLEANUP_INTERVAL
+
+    @property
+    def base_exceptions(self):
+        return sqlite3.Error
+
+    # --- Fixed window (every hit goes to the shared file) ---
+
+    def incr(self, key, expiry, amount=1):
+        now = time.time()
+        with self._transaction() as conn:
+            return self._incr(conn, key, expiry, amount, now)
+
+    def get(self, key):
+        return self._get(self._connection(), key, time.time())
+
+    def get_expiry(self, key):
+        now = time.time()
+        row = self._connection().execute(
+            "SELECT expires_at FROM rate_limit_counter WHERE key = ? AND expires_at > ?", (key, now)
+        ).fetchone()
+        return row[0] if row else now
+
+    def check(self):
+        try:
+            self._connection().execute("SELECT 1").fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
+    def reset(self):
+        with self._lock:
+            self._leases.clear()
+        with self._transaction() as conn:
+            return conn.execute("DELETE FROM rate_limit_counter").rowcount
+
+    def clear(self, key):
+        with self._lock:
+            self._leases.pop(key, None)
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM rate_limit_counter WHERE key = ?", (key,))
+
+    # --- Sliding window counter (leased) ---
+
+    def acquire_sliding_window_entry(self, key, limit, expiry, amount=1):
+        if amount > limit:
+            return False
+        now = time.time()
+        previous_key, current_key = self.sliding_window_keys(key, expiry, now)
+        self._cleanup(now)
+
+        with self._lock:
+            lease = self._leases.get(current_key)
+            if lease is not None:
+                if lease.remaining >= amount:
+                    lease.remaining -= amount
+                    return True
+                if lease.denied_until > now:
+                    return False
+
+        with self._transaction() as conn:
+            previous_count = self._get(conn, previous_key, now)
+            current_count = self._get(conn, current_key, now)
+            previous_ttl = self._previous_ttl(previous_count, expiry, now)
+            available = limit - math.floor(previous_count * previous_ttl / expiry + current_count)
+            granted = 0
+            if available >= amount:
+                granted = min(available, max(amount, math.ceil(limit * self.lease_fraction)))
+                self._incr(conn, current_key, 2 * expiry, granted, now)
+
+        with self._lock:
+            lease = self._leases.get(current_key)
+            if lease is None:
+                lease = self._leases[current_key] = _Lease((math.floor(now / expiry) + 1) * expiry)
+            if granted:
+                lease.remaining += granted - amount
+                lease.denied_until = 0.0
+                return True
+            lease.denied_until = now + expiry / limit
+            return False
+
+    def get_sliding_window(self, key, expiry):
+        now = time.time()
+        previous_key, current_key = self.sliding_window_keys(key, expiry, now)
+        conn = self._connection()
+        previous_count = self._get(conn, previous_key, now)
+        current_count = self._get(conn, current_key, now)
+        current_ttl = (1 - ((now / expiry) % 1)) * expiry + expiry
+        return previous_count, self._previous_ttl(previous_count, expiry, now), current_count, current_ttl
+
+    def clear_sliding_window(self, key, expiry):
+        previous_key, current_key = self.sliding_window_keys(key, expiry, time.time())
+        with self._lock:
+            self._leases.pop(current_key, None)
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM rate_limit_counter WHERE key IN (?, ?)", (previous_key, current_key))
+
+    # --- Internals ---
+
+    @staticmethod
+    def _previous_ttl(previous_count, expiry, now):
+        if not previous_count:
+            return 0.0
+        return (1 - (((now - expiry) / expiry) % 1)) * expiry
+
+    @staticmethod
+    def _get(conn, key, now):
+        row = conn.execute(
+            "SELECT count FROM rate_limit_counter WHERE key = ? AND expires_at > ?", (key, now)
+        ).fetchone()
+        return row[0] if row else 0
+
+    @staticmethod
+    def _incr(conn, key, expiry, amount, now):
+        conn.execute("DELETE FROM rate_limit_counter WHERE key = ? AND expires_at <= ?", (key, now))
+        conn.execute(
+            "INSERT INTO rate_limit_counter (key, count, expires_at) VALUES (?, ?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET count = count + excluded.count",
+            (key, amount, now + expiry)
+        )
+        return conn.execute("SELECT count FROM rate_limit_counter WHERE key = ?", (key,)).fetchone()[0]
+
+    def _cleanup(self, now):
+        with self._lock:
+            if now < self._next_cleanup:
+                return
+            self._next_cleanup = now + CLEANUP_INTERVAL
+            for window_key in [k for k, lease in self._leases.items() if lease.window_end <= now]:
+                del self._leases[window_key]
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM rate_limit_counter WHERE expires_at <= ?", (now,))
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS rate_limit_counter "
+                "(key TEXT PRIMARY KEY, count INTEGER NOT NULL, expires_at REAL NOT NULL)"
+            )
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._connection()
+        # Take the write lock up front so concurrent read-modify-writes serialise instead of failing
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
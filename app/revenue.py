@@ -0,0 +1,184 @@
+import random
+from collections import defaultdict, namedtuple
+from datetime import datetime, timedelta
+from flask import current_app, has_app_context
+from sqlalchemy import event, insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from . import db
+from .models import JournalEntry, JournalLeg, Payment, RevenueHourly, RevenueDaily
+from .lock_stats import timed_lock
+
+# Fee legs credited to the system account -> side of the payment that paid the fee
+FEE_LEG_SIDES = {
+    JournalLeg.TRANSFER_RECIPIENT_FEE: 'merchant',
+    JournalLeg.TRANSFER_SENDER_FEE: 'payer',
+    JournalLeg.PAYMENT_MERCHANT_FEE: 'merchant',
+    JournalLeg.PAYMENT_SERVICE_FEE: 'payer',
+}
+TRANSFER_FEE_LEGS = (JournalLeg.TRANSFER_RECIPIENT_FEE, JournalLeg.TRANSFER_SENDER_FEE)
+
+SOURCES = ('TRANSFER', 'LINK', 'QR', 'OTHER')
+SIDES = ('payer', 'merchant')
+PERIODS = ('hour', 'day', 'week', 'month')
+# Buckets shown on the revenue page per period
+DEFAULT_BUCKETS = {'hour': 48, 'day': 30, 'week': 12, 'month': 12}
+
+RevenueBucket = namedtuple('RevenueBucket', ['start', 'amounts', 'total', 'fee_count'])
+
+
+def revenue_series(period, count, now=None):
+    """
+    The last `count` buckets of fee revenue (the current one included), oldest
+    first, read from the rollup tables only (shards summed). Each RevenueBucket
+    has amounts[(source, side)] in cents; empty buckets are included as zero.
+    """
+    if period not in PERIODS:
+        raise ValueError(f"Unknown revenue period: {period}")
+    now = now or datetime.utcnow()
+    starts = [bucket_start(period, now)]
+    for _ in range(count - 1):
+        starts.append(_previous_bucket(period, starts[-1]))
+    starts.reverse()
+
+    if period == 'hour':
+        rows = db.session.query(RevenueHourly.bucket_start, RevenueHourly.source, RevenueHourly.side,
+                                RevenueHourly.amount, RevenueHourly.fee_count)\
+            .filter(RevenueHourly.bucket_start >= starts[0]).all()
+    else:
+        rows = db.session.query(RevenueDaily.day, RevenueDaily.source, RevenueDaily.side,
+                                RevenueDaily.amount, RevenueDaily.fee_count)\
+            .filter(RevenueDaily.day >= starts[0].date()).all()
+
+    amounts = defaultdict(lambda: defaultdict(int))
+    fee_counts = defaultdict(int)
+    for start, source, side, amount, fee_count in rows:
+        key = bucket_start(period, start if isinstance(start, datetime) else datetime.combine(start, datetime.min.time()))
+        amounts[key][(source, side)] += amount
+        fee_counts[key] += fee_count
+    return [RevenueBucket(start, dict(amounts[start]), sum(amounts[start].values()), fee_counts[start])
+            for start in starts]
+
+def bucket_start(period, moment):
+    """Start of the UTC hour, day, week (Monday) or month containing moment."""
+    if period == 'hour':
+        return moment.replace(minute=0, second=0, microsecond=0)
+    day = moment.replace(hour=0, minute=0, second=0, microsecond=0)
+    if period == 'day':
+        return day
+    if period == 'week':
+        return day - timedelta(days=day.weekday())
+    return day.replace(day=1)
+
+def _previous_bucket(period, start):
+    if period == 'hour':
+        return start - timedelta(hours=1)
+    if period == 'day':
+        return start - timedelta(days=1)
+    if period == 'week':
+        return start - timedelta(weeks=1)
+    return (start - timedelta(days=1)).replace(day=1)
+
+
+def backfill_revenue(start_day, end_day):
+    """
+    Rebuilds the hourly and daily rollups for the UTC days start_day to
+    end_day (inclusive) from the journal, one row per bucket in shard 0.
+    Returns the number of fee legs counted. The caller commits.
+    """
+    range_start = datetime.combine(start_day, datetime.min.time())
+    range_end = datetime.combine(end_day, datetime.min.time()) + timedelta(days=1)
+    with timed_lock('revenue.backfill', 'revenue_hourly'):
+        RevenueHourly.query.filter(RevenueHourly.bucket_start >= range_start, RevenueHourly.bucket_start < range_end)\
+            .delete(synchronize_session=False)
+        RevenueDaily.query.filter(RevenueDaily.day >= start_day, RevenueDaily.day <= end_day)\
+            .delete(synchronize_session=False)
+
+    rows = _fee_leg_rows(JournalEntry.created_at >= range_start, JournalEntry.created_at < range_end)
+    hourly, daily, legs = _aggregate(rows)
+    if hourly:
+        db.session.execute(insert(RevenueHourly), [
+            {'bucket_start': hour, 'source': source, 'side': side, 'amount': amount, 'fee_count': fee_count}
+            for (hour, source, side), (amount, fee_count) in hourly.items()
+        ])
+        db.session.execute(insert(RevenueDaily), [
+            {'day': day, 'source': source, 'side': side, 'amount': amount, 'fee_count': fee_count}
+            for (day, source, side), (amount, fee_count) in daily.items()
+        ])
+    return legs
+
+def _fee_leg_rows(*criteria):
+    """(created_at, leg_type, payment_method, amount) of the non-zero fee legs matching criteria."""
+    return db.session.query(JournalEntry.created_at, JournalLeg.leg_type, Payment.payment_method, JournalLeg.amount)\
+        .join(JournalLeg.entry)\
+        .outerjoin(Payment, JournalEntry.payment_id == Payment.id)\
+        .filter(JournalLeg.leg_type.in_(list(FEE_LEG_SIDES)), JournalLeg.amount != 0, *criteria)\
+        .execution_options(yield_per=5000)
+
+def _aggregate(rows):
+    hourly = defaultdict(lambda: [0, 0])
+    daily = defaultdict(lambda: [0, 0])
+    legs = 0
+    for created_at, leg_type, payment_method, amount in rows:
+        source = _fee_source(leg_type, payment_method)
+        side = FEE_LEG_SIDES[leg_type]
+        for totals in (hourly[(bucket_start('hour', created_at), source, side)],
+                       daily[(created_at.date(), source, side)]):
+            totals[0] += amount
+            totals[1] += 1
+        legs += 1
+    return hourly, daily, legs
+
+def _fee_source(leg_type, payment_method):
+    if leg_type in TRANSFER_FEE_LEGS:
+        return 'TRANSFER'
+    source = (payment_method or '').upper()
+    return source if source in SOURCES else 'OTHER'
+
+
+def _add_to_bucket(connection, table, key, amount, fee_count):
+    """Adds to one rollup row, creating it if this is the bucket's first fee."""
+    match = [table.c[column] == value for column, value in key.items()]
+    increment = table.update().where(*match).values(
+        amount=table.c.amount + amount,
+        fee_count=table.c.fee_count + fee_count
+    )
+    if connection.execute(increment).rowcount:
+        return
+    try:
+        # A savepoint, so losing the race to insert the row does not abort the transaction
+        with connection.begin_nested():
+            connection.execute(table.insert().values(amount=amount, fee_count=fee_count, **key))
+    except IntegrityError:
+        connection.execute(increment)
+
+@event.listens_for(Session, 'after_flush')
+def _collect_fee_legs(session, flush_context):
+    for obj in session.new:
+        if isinstance(obj, JournalLeg) and obj.leg_type in FEE_LEG_SIDES and obj.amount:
+            session.info.setdefault('_revenue_legs', []).append(obj.id)
+
+@event.listens_for(Session, 'before_commit')
+def _apply_revenue_legs(session):
+    if session.new:
+        session.flush()
+    leg_ids = session.info.pop('_revenue_legs', None)
+    if not leg_ids:
+        return
+
+    hourly, daily, _ = _aggregate(_fee_leg_rows(JournalLeg.id.in_(leg_ids)).all())
+    connection = session.connection()
+    # One random shard per commit, so concurrent payments in the same hour rarely wait on each other's bucket rows
+    shard_no = random.randrange(current_app.config['REVENUE_SHARD_COUNT']) if has_app_context() else 0
+    # Sorted, so two commits touching the same buckets lock them in the same order
+    with timed_lock('revenue.apply', 'revenue_hourly', shard_no):
+        for (hour, source, side), (amount, fee_count) in sorted(hourly.items()):
+            _add_to_bucket(connection, RevenueHourly.__table__,
+                           {'bucket_start': hour, 'source': source, 'side': side, 'shard_no': shard_no}, amount, fee_count)
+        for (day, source, side), (amount, fee_count) in sorted(daily.items()):
+            _add_to_bucket(connection, RevenueDaily.__table__,
+                           {'day': day, 'source': source, 'side': side, 'shard_no': shard_no}, amount, fee_count)
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_revenue_legs(session):
+    session.info.pop('_revenue_legs', None)
@@ -1,18 +1,25 @@
 import secrets
-import requests
-import hmac
-import hashlib
-import json
+import time
 from decimal import Decimal
-from flask import Blueprint, render_template, flash, redirect, url_for, request, current_app, send_from_directory
-from flask_mail import Message
+from flask import Blueprint, render_template, flash, redirect, url_for, request, current_app, send_from_directory, jsonify, abort
 from itsdangerous import URLSafeTimedSerializer, SignatureExpired, BadTimeSignature
 from datetime import datetime
 from flask_login import login_required, current_user
-from . import db, bcrypt, mail
-from .models import APIKey, Transaction, User, Payment, SplitBill, SplitBillParticipant
-from .utils import encrypt_data, decrypt_data, generate_qr_code
+from sqlalchemy.orm import joinedload, selectinload
+from . import db, ledger
+from .models import APIKey, JournalLeg, User, Payment, SplitBill, SplitBillParticipant
+from .journal import record_entry, leg_query
+from .utils import encrypt_data, encode_cursor, decode_cursor
+from .qr_cache import build_qr_data, qr_digest, get_cached_qr_png, qr_expiry, is_valid_qr_expiry
 from .push import send_push_notification
+from .fees import get_system_user_id, credit_fee
+from .webhooks import enqueue_webhook, notify_dispatcher
+from .outbox import queue_email
+from .credentials import invalidate_api_key
+from .hashing import hash_secret, verify_pin, digest_secret
+from .pin_session import check_payment_pin, find_pin_window
+from .unit_of_work import unit_of_work, should_retry, is_retryable_error
+from .lock_stats import timed_lock
 from .forms import (
     GenerateKeyForm, SetPINForm, TransferForm, PayPageForm, BugReportForm,
     EditKeyForm, DeleteKeyForm, ResetKeyForm, RequestQRForm, SplitBillForm
@@ -20,46 +27,22 @@ from .forms import (
 
 main_bp = Blueprint('main', __name__)
 
+HISTORY_PER_PAGE = 15
+
 @main_bp.route('/sw.js')
 def service_worker():
     return send_from_directory('static', 'sw.js')
 
 def _send_webhook(payment, api_key):
-    """Helper function to send a webhook notification."""
+    """
+    Queues a webhook notification in the current DB transaction.
+    The background dispatcher delivers it (with retries) once the caller commits.
+    """
     if not api_key or not api_key.webhook_url:
         current_app.logger.info(f"Merchant {payment.merchant.email} has no webhook URL set. Skipping webhook.")
-        return
-
-    raw_webhook_secret = None
-    if api_key.webhook_secret_encrypted:
-        try:
-            decrypted_secret_bytes = decrypt_data(api_key.webhook_secret_encrypted)
-            if decrypted_secret_bytes:
-                raw_webhook_secret = decrypted_secret_bytes.decode('utf-8')
-        except Exception as e:
-            current_app.logger.error(f"Could not decrypt webhook secret for merchant {payment.merchant.email}. Error: {e}")
-            return
+        return None
 
-    if not raw_webhook_secret:
-        current_app.logger.warning(f"Webhook secret not found or could not be decrypted for merchant {payment.merchant.email}. Cannot sign webhook.")
-        return
-
-    try:
-        webhook_payload = {
-            'payment_id': payment.payment_id,
-            'merchant_order_id': payment.merchant_order_id,
-            'status': payment.status,
-            'amount': payment.amount,
-            'paid_at': payment.paid_at.isoformat() if payment.paid_at else None
-        }
-        payload_body = json.dumps(webhook_payload, separators=(',', ':')).encode('utf-8')
-        signature = hmac.new(raw_webhook_secret.encode('utf-8'), payload_body, hashlib.sha256).hexdigest()
-        headers = {'Content-Type': 'application/json', 'X-GABUTPAY-SIGNATURE': signature}
-        
-        requests.post(api_key.webhook_url, data=payload_body, headers=headers, timeout=5)
-        current_app.logger.info(f"Webhook sent to {api_key.webhook_url} for payment {payment.payment_id}")
-    except requests.exceptions.RequestException as e:
-        current_app.logger.error(f"Failed to send webhook for payment {payment.payment_id}. Error: {e}")
+    return enqueue_webhook(payment, api_key)
 
 @main_bp.route('/')
 def home():
@@ -68,7 +51,7 @@ def home():
 @main_bp.route('/dashboard')
 @login_required
 def dashboard():
-    keys = APIKey.query.filter_by(owner=current_user).all()
+    keys = APIKey.query.filter_by(user_id=current_user.id).all()
     delete_form = DeleteKeyForm()
     reset_form = ResetKeyForm()
     return render_template(
@@ -82,9 +65,10 @@ def dashboard():
 
 @main_bp.route('/generate-key', methods=['GET', 'POST'])
 @login_required
+@unit_of_work
 def generate_key():
     key_cost = current_app.config['KEY_COST']
-    first_key = APIKey.query.filter_by(owner=current_user).first()
+    first_key = APIKey.query.filter_by(user_id=current_user.id).first()
     is_first_key = first_key is None
 
     if not current_user.pin_hash:
@@ -101,7 +85,7 @@ def generate_key():
         pin = form.pin.data
         store_name = form.store_name.data.strip()
 
-        if not bcrypt.check_password_hash(current_user.pin_hash, pin):
+        if not verify_pin(current_user, pin):
             flash('PIN salah. Silakan coba lagi.', 'danger')
             return redirect(url_for('main.generate_key'))
 
@@ -110,12 +94,12 @@ def generate_key():
             return redirect(url_for('main.generate_key'))
 
         try:
-            # Lock the user row to prevent race conditions
-            user = db.session.query(User).filter_by(id=current_user.id).with_for_update().one()
-
-            if user.balance < key_cost:
+            # Conditional debit: fails instead of going negative, no row lock needed
+            try:
+                ledger.debit_user(current_user.id, key_cost)
+            except ledger.InsufficientFunds:
+                db.session.rollback()
                 flash(f'Saldo Anda tidak mencukupi. Biaya pembuatan key adalah Rp {key_cost / 100:,.2f}.', 'danger')
-                db.session.rollback()  # Release the lock
                 return redirect(url_for('main.dashboard'))
 
             final_store_name = store_name or (first_key.store_name if first_key else '')
@@ -124,21 +108,18 @@ def generate_key():
             secret_key = f'sk_test_{secrets.token_hex(24)}'
             webhook_secret = f'whsec_{secrets.token_hex(24)}'
 
-            user.balance -= key_cost
-            
             new_key = APIKey(
                 public_key=public_key,
-                secret_key_hash=bcrypt.generate_password_hash(secret_key).decode('utf-8'),
+                secret_key_hash=digest_secret(secret_key),
                 secret_key_encrypted=encrypt_data(secret_key.encode('utf-8')),
-                webhook_secret_hash=bcrypt.generate_password_hash(webhook_secret).decode('utf-8'),
+                webhook_secret_hash=digest_secret(webhook_secret),
                 webhook_secret_encrypted=encrypt_data(webhook_secret.encode('utf-8')),
-                owner=user,
+                user_id=current_user.id,
                 store_name=final_store_name
             )
             db.session.add(new_key)
 
-            new_transaction = Transaction(user_id=user.id, transaction_type='KEY_PURCHASE', amount=-key_cost, description=f'Pembelian API Key {public_key}')
-            db.session.add(new_transaction)
+            record_entry([(current_user.id, JournalLeg.KEY_PURCHASE, -key_cost, None)], reference=public_key)
             
             db.session.commit()
 
@@ -147,6 +128,8 @@ def generate_key():
 
         except Exception as e:
             db.session.rollback()
+            if should_retry(e):
+                raise
             current_app.logger.error(f"Error during key generation for user {current_user.id}: {e}")
             flash('Terjadi kesalahan internal saat membuat key. Dana Anda aman.', 'danger')
             return redirect(url_for('main.dashboard'))
@@ -162,7 +145,7 @@ def set_pin():
 
     form = SetPINForm()
     if form.validate_on_submit():
-        pin_hash = bcrypt.generate_password_hash(form.pin.data).decode('utf-8')
+        pin_hash = hash_secret('pin', form.pin.data)
         current_user.pin_hash = pin_hash
         db.session.commit()
         flash('PIN keamanan berhasil diatur!', 'success')
@@ -175,15 +158,70 @@ def set_pin():
     form.next.data = request.args.get('next')
     return render_template('set_pin.html', title='Atur PIN Keamanan', form=form)
 
+def _history_keyset_page(user_id, after=None, per_page=HISTORY_PER_PAGE):
+    """
+    Fetches one page of a user's history (journal legs), newest first.
+    Seeks past the `after` (timestamp, id) position instead of using OFFSET,
+    so every page costs the same and no COUNT(*) is needed. Leg ids grow
+    with time, so the id alone orders the page.
+    """
+    query = leg_query().filter(JournalLeg.account_id == user_id)
+    if after:
+        _, after_id = after
+        query = query.filter(JournalLeg.id < after_id)
+
+    # Fetch one extra row to know whether there is a next page
+    rows = query.order_by(JournalLeg.id.desc()).limit(per_page + 1).all()
+    next_cursor = None
+    if len(rows) > per_page:
+        rows = rows[:per_page]
+        next_cursor = encode_cursor(rows[-1].timestamp, rows[-1].id)
+    return rows, next_cursor
+
 @main_bp.route('/history')
 @login_required
 def history():
-    page = request.args.get('page', 1, type=int)
-    transactions = Transaction.query.filter_by(user_id=current_user.id).order_by(Transaction.timestamp.desc()).paginate(page=page, per_page=15)
-    return render_template('history.html', title='Riwayat Transaksi', transactions=transactions)
+    # Numbered pages are still honoured so old bookmarks keep working
+    if 'page' in request.args:
+        page = request.args.get('page', 1, type=int)
+        pagination = leg_query().filter(JournalLeg.account_id == current_user.id).order_by(JournalLeg.id.desc()).paginate(page=page, per_page=HISTORY_PER_PAGE)
+        return render_template('history.html', title='Riwayat Transaksi', transactions=pagination.items, pagination=pagination, next_cursor=None)
+
+    after = decode_cursor(request.args.get('after', ''))
+    transactions, next_cursor = _history_keyset_page(current_user.id, after)
+    return render_template('history.html', title='Riwayat Transaksi', transactions=transactions, pagination=None, next_cursor=next_cursor)
+
+@main_bp.route('/history.json')
+@login_required
+def history_json():
+    """Keyset-paginated history feed used by the infinite scroll on the history page."""
+    after = None
+    if request.args.get('after'):
+        after = decode_cursor(request.args['after'])
+        if after is None:
+            return jsonify({"error": "Invalid cursor"}), 400
+
+    transactions, next_cursor = _history_keyset_page(current_user.id, after)
+    return jsonify({
+        "items": [
+            {
+                "id": tx.id,
+                "transaction_type": tx.transaction_type,
+                "amount": tx.amount,
+                "description": tx.description,
+                "timestamp": tx.timestamp.isoformat(),
+                "payment_id": tx.payment.payment_id if tx.payment else None
+            }
+            for tx in transactions
+        ],
+        "html": render_template('_history_items.html', transactions=transactions),
+        "next_cursor": next_cursor,
+        "next_url": url_for('main.history_json', after=next_cursor) if next_cursor else None
+    })
 
 @main_bp.route('/transfer', methods=['GET', 'POST'])
 @login_required
+@unit_of_work
 def transfer():
     if not current_user.pin_hash:
         flash('Anda harus mengatur PIN sebelum bisa melakukan transfer.', 'warning')
@@ -199,25 +237,20 @@ def transfer():
             flash('Anda tidak bisa mengirim uang ke diri sendiri.', 'danger')
             return redirect(url_for('main.transfer'))
 
-        if not bcrypt.check_password_hash(current_user.pin_hash, pin):
-            flash('PIN salah.', 'danger')
+        # The PIN window's cap applies to everything debited, payer fee included
+        total_debited = amount + int(amount * current_app.config['PAYER_FEE_TRANSFER_PERCENT'])
+        if not check_payment_pin(current_user, pin, total_debited, remember=form.remember_pin.data):
+            flash('PIN salah.' if pin else 'PIN wajib diisi.', 'danger')
             return redirect(url_for('main.transfer'))
 
         try:
             # 1. FIND RECIPIENT
-            recipient_stub = User.query.filter(User.email == recipient_email, User.id != current_user.id).first()
-            if not recipient_stub:
+            recipient = User.query.filter(User.email == recipient_email, User.id != current_user.id).first()
+            if not recipient:
                 flash('Pengguna penerima tidak ditemukan.', 'danger')
                 return redirect(url_for('main.transfer'))
 
-            # 2. CONSISTENT LOCKING ORDER to prevent Deadlock
-            # Always lock the smaller ID first
-            if current_user.id < recipient_stub.id:
-                sender = db.session.query(User).filter_by(id=current_user.id).with_for_update().one()
-                recipient = db.session.query(User).filter_by(id=recipient_stub.id).with_for_update().one()
-            else:
-                recipient = db.session.query(User).filter_by(id=recipient_stub.id).with_for_update().one()
-                sender = db.session.query(User).filter_by(id=current_user.id).with_for_update().one()
+            sender = current_user
 
             # --- New Fee Logic ---
             base_amount = int(form.amount.data * 100)
@@ -226,20 +259,20 @@ def transfer():
             payer_fee = int(base_amount * current_app.config['PAYER_FEE_TRANSFER_PERCENT'])
             total_debited = base_amount + payer_fee
 
-            if sender.balance < total_debited:
-                flash('Saldo tidak mencukupi untuk melakukan transfer dan membayar biaya layanan.', 'danger')
-                db.session.rollback()
-                return redirect(url_for('main.transfer'))
-
             # 2. Calculate Payee (Recipient) Fee
             merchant_fee = int(base_amount * current_app.config['MERCHANT_FEE_PERCENT'])
             recipient_amount = base_amount - merchant_fee
             
             # 3. Update balances
-            admin_user = db.session.query(User).filter_by(email='sistem@gabutpay.com').with_for_update().one()
-            sender.balance -= total_debited
-            recipient.balance += recipient_amount
-            admin_user.balance += payer_fee + merchant_fee
+            # Conditional debit + blind credit (in user id order); fees go to a fee shard
+            system_user_id = get_system_user_id()
+            try:
+                ledger.post(debits=[(sender.id, total_debited)], credits=[(recipient.id, recipient_amount)])
+            except ledger.InsufficientFunds:
+                db.session.rollback()
+                flash('Saldo tidak mencukupi untuk melakukan transfer dan membayar biaya layanan.', 'danger')
+                return redirect(url_for('main.transfer'))
+            credit_fee(payer_fee + merchant_fee)
 
             # 4. Create unified Payment record
             transfer_payment = Payment(
@@ -256,17 +289,17 @@ def transfer():
             )
             db.session.add(transfer_payment)
             
-            # 5. Create transaction records and link them to the Payment
-            # Payer side
-            sender_tx_1 = Transaction(user_id=sender.id, payment=transfer_payment, transaction_type='TRANSFER_OUT', amount=-base_amount, description=f'Transfer ke {recipient.email}', counterparty_id=recipient.id)
-            sender_tx_2 = Transaction(user_id=sender.id, payment=transfer_payment, transaction_type='PAYER_FEE', amount=-payer_fee, description=f'Biaya layanan transfer ke {recipient.email}', counterparty_id=admin_user.id)
-            # Recipient side
-            recipient_tx = Transaction(user_id=recipient.id, payment=transfer_payment, transaction_type='TRANSFER_IN', amount=recipient_amount, description=f'Transfer dari {sender.email}', counterparty_id=sender.id)
-            # Admin side
-            admin_tx_1 = Transaction(user_id=admin_user.id, payment=transfer_payment, transaction_type='ADMIN_FEE', amount=merchant_fee, description=f'Biaya admin dari transfer (sisi penerima: {recipient.email})')
-            admin_tx_2 = Transaction(user_id=admin_user.id, payment=transfer_payment, transaction_type='ADMIN_FEE', amount=payer_fee, description=f'Biaya layanan dari transfer (sisi pengirim: {sender.email})')
-
-            db.session.add_all([sender_tx_1, sender_tx_2, recipient_tx, admin_tx_1, admin_tx_2])
+            # 5. Journal entry linked to the Payment (descriptions are rendered when read)
+            record_entry([
+                # Payer side
+                (sender.id, JournalLeg.TRANSFER_OUT, -base_amount, recipient.id),
+                (sender.id, JournalLeg.TRANSFER_PAYER_FEE, -payer_fee, recipient.id),
+                # Recipient side
+                (recipient.id, JournalLeg.TRANSFER_IN, recipient_amount, sender.id),
+                # Admin side
+                (system_user_id, JournalLeg.TRANSFER_RECIPIENT_FEE, merchant_fee, recipient.id),
+                (system_user_id, JournalLeg.TRANSFER_SENDER_FEE, payer_fee, sender.id),
+            ], payment=transfer_payment)
             db.session.commit()
 
             # Send push notifications
@@ -285,6 +318,8 @@ def transfer():
 
         except Exception as e:
             db.session.rollback()
+            if should_retry(e):
+                raise
             current_app.logger.error(f"Error during transfer: {e}")
             flash('Terjadi kesalahan internal saat transfer. Dana Anda aman.', 'danger')
             return redirect(url_for('main.transfer'))
@@ -293,11 +328,13 @@ def transfer():
         'transfer.html', 
         title='Transfer Saldo', 
         form=form, 
-        payer_fee_percent=current_app.config['PAYER_FEE_TRANSFER_PERCENT']
+        payer_fee_percent=current_app.config['PAYER_FEE_TRANSFER_PERCENT'],
+        pin_window=find_pin_window(current_user.id)
     )
 
 @main_bp.route('/pay/<signed_payment_id>', methods=['GET', 'POST'])
 @login_required
+@unit_of_work
 def pay_page(signed_payment_id):
     serializer = URLSafeTimedSerializer(current_app.config['SECRET_KEY'])
     try:
@@ -306,7 +343,9 @@ def pay_page(signed_payment_id):
         flash('Link pembayaran tidak valid atau sudah kedaluwarsa.', 'danger')
         return redirect(url_for('main.home'))
 
-    payment = Payment.query.filter_by(payment_id=payment_id, status='PENDING').first_or_404()
+    # The page shows the merchant's store name (their first API key)
+    payment = Payment.query.options(joinedload(Payment.merchant).selectinload(User.api_keys))\
+        .filter_by(payment_id=payment_id, status='PENDING').first_or_404()
 
     if current_user.id == payment.merchant_id:
         flash('Anda tidak bisa membayar ke diri Anda sendiri.', 'warning')
@@ -329,52 +368,62 @@ def pay_page(signed_payment_id):
             flash('Anda belum mengatur PIN keamanan. Silakan atur di dashboard.', 'warning')
             return redirect(url_for('main.set_pin', next=request.url))
         
-        if not bcrypt.check_password_hash(current_user.pin_hash, form.pin.data):
-            flash('PIN yang Anda masukkan salah.', 'danger')
-            return render_template('pay_page.html', title='Konfirmasi Pembayaran', payment=payment, form=form, payer_fee=payer_fee, total_debited=total_debited)
+        if not check_payment_pin(current_user, form.pin.data, total_debited, remember=form.remember_pin.data):
+            flash('PIN yang Anda masukkan salah.' if form.pin.data else 'PIN wajib diisi.', 'danger')
+            return render_template('pay_page.html', title='Konfirmasi Pembayaran', payment=payment, form=form, payer_fee=payer_fee, total_debited=total_debited,
+                                   pin_window=find_pin_window(current_user.id, total_debited))
 
         try:
-            # Lock rows for update
-            payer = db.session.query(User).filter_by(id=current_user.id).with_for_update().one()
-            merchant = db.session.query(User).filter_by(id=payment.merchant_id).with_for_update().one()
-            admin_user = db.session.query(User).filter_by(email='sistem@gabutpay.com').with_for_update().one()
-
-            if payer.balance < total_debited:
-                flash('Saldo Anda tidak mencukupi untuk membayar beserta biaya layanan.', 'danger')
-                db.session.rollback()
-                return render_template('pay_page.html', title='Konfirmasi Pembayaran', payment=payment, form=form, payer_fee=payer_fee, total_debited=total_debited)
+            payer = current_user
+            merchant = payment.merchant
+            system_user_id = get_system_user_id()
 
             # Calculate merchant fee
             merchant_fee = int(base_amount * current_app.config['MERCHANT_FEE_PERCENT'])
             merchant_amount = base_amount - merchant_fee
 
-            # Update balances
-            payer.balance -= total_debited
-            merchant.balance += merchant_amount
-            admin_user.balance += payer_fee + merchant_fee
-            
-            # Update payment record with fees and status
-            payment.status = 'PAID'
-            payment.payer_id = payer.id
-            payment.paid_at = datetime.utcnow()
-            payment.payer_fee = payer_fee
-            payment.merchant_fee = merchant_fee
+            # Claim the payment first so two concurrent submissions cannot both pay it
+            with timed_lock('payment.claim', 'payment', payment.id):
+                claimed = Payment.query.filter_by(id=payment.id, status='PENDING').update({
+                    'status': 'PAID',
+                    'payer_id': payer.id,
+                    'paid_at': datetime.utcnow(),
+                    'payer_fee': payer_fee,
+                    'merchant_fee': merchant_fee
+                }, synchronize_session='evaluate')
+            if not claimed:
+                db.session.rollback()
+                flash('Pembayaran ini sudah diproses.', 'warning')
+                return redirect(url_for('main.payment_details', payment_id=payment.payment_id))
+
+            # Update balances: conditional debit + blind credit (in user id order)
+            try:
+                ledger.post(debits=[(payer.id, total_debited)], credits=[(merchant.id, merchant_amount)])
+            except ledger.InsufficientFunds:
+                db.session.rollback()
+                flash('Saldo Anda tidak mencukupi untuk membayar beserta biaya layanan.', 'danger')
+                return render_template('pay_page.html', title='Konfirmasi Pembayaran', payment=payment, form=form, payer_fee=payer_fee, total_debited=total_debited,
+                                       pin_window=find_pin_window(current_user.id, total_debited))
+            credit_fee(payer_fee + merchant_fee)
 
             api_key = APIKey.query.filter_by(user_id=merchant.id).first()
             store_name = api_key.store_name if api_key else merchant.email
 
-            # Create transaction records
-            # Payer side
-            payer_tx_1 = Transaction(user_id=payer.id, payment_id=payment.id, transaction_type='PAYMENT_OUT', amount=-base_amount, description=f'Pembayaran ke {store_name}', counterparty_id=merchant.id)
-            payer_tx_2 = Transaction(user_id=payer.id, payment_id=payment.id, transaction_type='PAYER_FEE', amount=-payer_fee, description=f'Biaya layanan pembayaran ke {store_name}', counterparty_id=admin_user.id)
-            # Merchant side
-            merchant_tx = Transaction(user_id=merchant.id, payment_id=payment.id, transaction_type='PAYMENT_IN', amount=merchant_amount, description=f'Pembayaran dari {payer.email}', counterparty_id=payer.id)
-            # Admin side
-            admin_tx_1 = Transaction(user_id=admin_user.id, payment_id=payment.id, transaction_type='ADMIN_FEE', amount=merchant_fee, description=f'Biaya admin dari pembayaran (sisi merchant: {merchant.email})')
-            admin_tx_2 = Transaction(user_id=admin_user.id, payment_id=payment.id, transaction_type='ADMIN_FEE', amount=payer_fee, description=f'Biaya layanan dari pembayaran (sisi pembayar: {payer.email})')
-
-            db.session.add_all([payer_tx_1, payer_tx_2, merchant_tx, admin_tx_1, admin_tx_2])
+            # Journal entry (descriptions are rendered when read)
+            record_entry([
+                # Payer side
+                (payer.id, JournalLeg.PAYMENT_OUT, -base_amount, merchant.id),
+                (payer.id, JournalLeg.PAYMENT_PAYER_FEE, -payer_fee, merchant.id),
+                # Merchant side
+                (merchant.id, JournalLeg.PAYMENT_IN, merchant_amount, payer.id),
+                # Admin side
+                (system_user_id, JournalLeg.PAYMENT_MERCHANT_FEE, merchant_fee, merchant.id),
+                (system_user_id, JournalLeg.PAYMENT_SERVICE_FEE, payer_fee, payer.id),
+            ], payment_id=payment.id, reference=store_name)
+            webhook_delivery = _send_webhook(payment, api_key)
             db.session.commit()
+            if webhook_delivery:
+                notify_dispatcher()
 
             # Send notifications
             try:
@@ -387,7 +436,6 @@ def pay_page(signed_payment_id):
             except Exception as e:
                 current_app.logger.error(f"Failed to send push notification(s) for payment {payment.payment_id}: {e}")
 
-            _send_webhook(payment, api_key)
             flash('Pembayaran berhasil!', 'success')
             
             # --- Patched Redirect Logic ---
@@ -398,8 +446,12 @@ def pay_page(signed_payment_id):
 
         except Exception as e:
             db.session.rollback()
-            payment.status = 'FAILED'
-            db.session.commit()
+            if should_retry(e):
+                raise
+            if not is_retryable_error(e):
+                # A lock conflict that ran out of retries leaves the payment payable
+                payment.status = 'FAILED'
+                db.session.commit()
             current_app.logger.error(f"Error during payment execution for payment_id {payment.payment_id}: {e}")
             flash('Terjadi kesalahan internal saat memproses pembayaran. Dana Anda aman.', 'danger')
             
@@ -409,7 +461,8 @@ def pay_page(signed_payment_id):
             else:
                 return redirect(url_for('main.dashboard'))
 
-    return render_template('pay_page.html', title='Konfirmasi Pembayaran', payment=payment, form=form, payer_fee=payer_fee, total_debited=total_debited)
+    return render_template('pay_page.html', title='Konfirmasi Pembayaran', payment=payment, form=form, payer_fee=payer_fee, total_debited=total_debited,
+                           pin_window=find_pin_window(current_user.id, total_debited))
 
 @main_bp.route('/delete-key', methods=['POST'])
 @login_required
@@ -418,8 +471,10 @@ def delete_key():
     if form.validate_on_submit():
         key_to_delete = APIKey.query.get(form.key_id.data)
         if key_to_delete and key_to_delete.user_id == current_user.id:
+            public_key = key_to_delete.public_key
             db.session.delete(key_to_delete)
             db.session.commit()
+            invalidate_api_key(public_key)
             flash('API Key berhasil dihapus.', 'success')
         else:
             flash('Gagal menghapus key. Key tidak ditemukan atau bukan milik Anda.', 'danger')
@@ -440,11 +495,12 @@ def reset_key():
         new_secret_key = f'sk_test_{secrets.token_hex(24)}'
         new_webhook_secret = f'whsec_{secrets.token_hex(24)}'
 
-        key_to_reset.secret_key_hash = bcrypt.generate_password_hash(new_secret_key).decode('utf-8')
+        key_to_reset.secret_key_hash = digest_secret(new_secret_key)
         key_to_reset.secret_key_encrypted = encrypt_data(new_secret_key.encode('utf-8'))
-        key_to_reset.webhook_secret_hash = bcrypt.generate_password_hash(new_webhook_secret).decode('utf-8')
+        key_to_reset.webhook_secret_hash = digest_secret(new_webhook_secret)
         key_to_reset.webhook_secret_encrypted = encrypt_data(new_webhook_secret.encode('utf-8'))
         db.session.commit()
+        invalidate_api_key(key_to_reset.public_key)
 
         flash('API Key berhasil direset! Harap simpan Secret Key dan Webhook Secret baru Anda.', 'success')
         return render_template('display_keys.html',
@@ -558,7 +614,8 @@ def list_split_bills():
     all_bill_ids = created_bills_q.union(participated_bills_q).subquery()
 
     # Fetch the actual bill objects
-    bills = SplitBill.query.filter(SplitBill.id.in_(all_bill_ids)).order_by(SplitBill.created_at.desc()).all()
+    bills = SplitBill.query.options(joinedload(SplitBill.creator))\
+        .filter(SplitBill.id.in_(db.select(all_bill_ids))).order_by(SplitBill.created_at.desc()).all()
     
     return render_template('split_bills_list.html', bills=bills, title="Tagihan Patungan Saya")
 
@@ -566,7 +623,10 @@ def list_split_bills():
 @main_bp.route('/split-bill/<int:bill_id>')
 @login_required
 def split_bill_detail(bill_id):
-    bill = SplitBill.query.get_or_404(bill_id)
+    bill = SplitBill.query.options(
+        joinedload(SplitBill.creator),
+        selectinload(SplitBill.participants)
+    ).filter_by(id=bill_id).first_or_404()
     
     # Security check: ensure current user is part of this bill
     participant_ids = [p.participant_user_id for p in bill.participants]
@@ -579,6 +639,7 @@ def split_bill_detail(bill_id):
 
 @main_bp.route('/split-bill/pay/<int:participant_id>', methods=['POST'])
 @login_required
+@unit_of_work
 def pay_split_bill_participant(participant_id):
     # 1. INITIAL FIND (No lock yet)
     participant_stub = SplitBillParticipant.query.get_or_404(participant_id)
@@ -590,57 +651,41 @@ def pay_split_bill_participant(participant_id):
         abort(403)
 
     try:
-        # 2. LOCK PARTICIPANT & BILL to prevent double payment
-        participant = db.session.query(SplitBillParticipant).filter_by(id=participant_id).with_for_update().one()
-        bill = db.session.query(SplitBill).filter_by(id=bill_id).with_for_update().one()
+        # 2. LOCK BILL (serializes the "all paid" check below)
+        with timed_lock('split_bill.lock', 'split_bill', bill_id):
+            bill = db.session.query(SplitBill).filter_by(id=bill_id).with_for_update().one()
 
-        # 3. STATE CHECKS (inside lock)
-        if participant.status != 'PENDING':
-            flash('Tagihan ini sudah lunas atau sedang diproses.', 'warning')
-            return redirect(url_for('main.split_bill_detail', bill_id=bill.id))
+        # 3. STATE CHECKS
         if bill.status != 'ACTIVE':
             flash('Sesi patungan ini sudah tidak aktif.', 'warning')
             return redirect(url_for('main.split_bill_detail', bill_id=bill.id))
 
-        # 4. CONSISTENT LOCKING ORDER for balances
-        payer_id = current_user.id
-        creator_id = bill.creator_id
-        
-        if payer_id < creator_id:
-            payer = db.session.query(User).filter_by(id=payer_id).with_for_update().one()
-            creator = db.session.query(User).filter_by(id=creator_id).with_for_update().one()
-        else:
-            creator = db.session.query(User).filter_by(id=creator_id).with_for_update().one()
-            payer = db.session.query(User).filter_by(id=payer_id).with_for_update().one()
-
-        if payer.balance < participant.amount_due:
-            flash('Saldo Anda tidak mencukupi untuk membayar tagihan ini.', 'danger')
+        # Claim the share with a conditional UPDATE to prevent double payment (works without FOR UPDATE too)
+        participant = participant_stub
+        with timed_lock('split_bill.claim_participant', 'split_bill_participant', participant_id):
+            claimed = SplitBillParticipant.query.filter_by(id=participant_id, status='PENDING').update(
+                {'status': 'PAID'}, synchronize_session='evaluate'
+            )
+        if not claimed:
             db.session.rollback()
+            flash('Tagihan ini sudah lunas atau sedang diproses.', 'warning')
             return redirect(url_for('main.split_bill_detail', bill_id=bill.id))
 
-        # Perform the transfer
-        payer.balance -= participant.amount_due
-        creator.balance += participant.amount_due
-
-        # Update participant status
-        participant.status = 'PAID'
+        # 4. Perform the transfer: conditional debit + blind credit (in user id order)
+        payer = current_user
+        creator = bill.creator
+        try:
+            ledger.post(debits=[(payer.id, participant.amount_due)], credits=[(creator.id, participant.amount_due)])
+        except ledger.InsufficientFunds:
+            db.session.rollback()
+            flash('Saldo Anda tidak mencukupi untuk membayar tagihan ini.', 'danger')
+            return redirect(url_for('main.split_bill_detail', bill_id=bill.id))
 
-        # Create transaction records
-        payer_tx = Transaction(
-            user_id=payer.id,
-            transaction_type='SPLIT_BILL_OUT',
-            amount=-participant.amount_due,
-            description=f"Bayar patungan: '{bill.title}'",
-            counterparty_id=creator.id
-        )
-        creator_tx = Transaction(
-            user_id=creator.id,
-            transaction_type='SPLIT_BILL_IN',
-            amount=participant.amount_due,
-            description=f"Terima patungan dari {payer.email} untuk '{bill.title}'",
-            counterparty_id=payer.id
-        )
-        db.session.add_all([payer_tx, creator_tx])
+        # Journal entry
+        record_entry([
+            (payer.id, JournalLeg.SPLIT_BILL_OUT, -participant.amount_due, creator.id),
+            (creator.id, JournalLeg.SPLIT_BILL_IN, participant.amount_due, payer.id),
+        ], reference=bill.title)
         
         # Check if the whole bill is completed
         all_paid = all(p.status == 'PAID' for p in bill.participants)
@@ -653,6 +698,8 @@ def pay_split_bill_participant(participant_id):
 
     except Exception as e:
         db.session.rollback()
+        if should_retry(e):
+            raise
         current_app.logger.error(f"Error paying split bill participant {participant_id}: {e}")
         flash('Terjadi kesalahan internal saat pembayaran.', 'danger')
 
@@ -740,21 +787,47 @@ def request_payment():
 
 @main_bp.route('/show-qr/<payment_id>')
 def show_qr(payment_id):
-    payment = Payment.query.filter_by(payment_id=payment_id).first_or_404()
+    payment = Payment.query.options(joinedload(Payment.merchant)).filter_by(payment_id=payment_id).first_or_404()
     
     # For now, only pending payments can be displayed as a QR
     if payment.status != 'PENDING':
         flash('Pembayaran ini sudah tidak valid.', 'warning')
         return redirect(url_for('main.dashboard'))
 
+    if not current_app.config['QR_HMAC_SECRET_KEY']:
+        current_app.logger.error(f"Gagal membuat QR code untuk payment_id {payment.payment_id}: QR_HMAC_SECRET_KEY is not configured.")
+        flash('Gagal membuat QR code. Harap coba lagi.', 'danger')
+        return redirect(url_for('main.request_payment'))
+
+    # The image itself is served by qr_image, so the page stays small and the image cacheable
+    exp = qr_expiry()
+    return render_template('show_qr.html', title='Bayar dengan QR', payment=payment,
+                           qr_image_url=url_for('main.qr_image', payment_id=payment.payment_id, exp=exp),
+                           qr_expires_at=datetime.utcfromtimestamp(exp))
+
+@main_bp.route('/show-qr/<payment_id>/<int:exp>.png')
+def qr_image(payment_id, exp):
+    if not is_valid_qr_expiry(exp):
+        abort(404)
+    payment = Payment.query.filter_by(payment_id=payment_id, status='PENDING').first_or_404()
+
     try:
-        qr_code_data_uri = generate_qr_code(payment)
+        data = build_qr_data(payment, exp)
+        digest = qr_digest(data)
+        # A browser revalidating an image it already has gets a 304 without a render
+        if request.if_none_match.contains(digest):
+            response = current_app.response_class(status=304)
+        else:
+            response = current_app.response_class(get_cached_qr_png(data, digest, exp), mimetype='image/png')
     except Exception as e:
         current_app.logger.error(f"Gagal membuat QR code untuk payment_id {payment.payment_id}: {e}")
-        flash('Gagal membuat QR code. Harap coba lagi.', 'danger')
-        return redirect(url_for('main.request_payment'))
+        abort(503)
 
-    return render_template('show_qr.html', title='Bayar dengan QR', payment=payment, qr_code=qr_code_data_uri)
+    # The URL names the exact content, so browsers may reuse it until the QR expires
+    response.set_etag(digest)
+    response.cache_control.private = True
+    response.cache_control.max_age = max(0, int(exp - time.time()))
+    return response
 
 @main_bp.route('/scan-qr')
 @login_required
@@ -764,7 +837,8 @@ def scan_qr():
 @main_bp.route('/payment/details/<payment_id>')
 @login_required
 def payment_details(payment_id):
-    payment = Payment.query.filter_by(payment_id=payment_id).first_or_404()
+    payment = Payment.query.options(joinedload(Payment.merchant), joinedload(Payment.payer))\
+        .filter_by(payment_id=payment_id).first_or_404()
     
     # Security check: only payer or merchant can view the details
     if current_user.id not in [payment.payer_id, payment.merchant_id]:
@@ -973,11 +1047,16 @@ def docs():
 }
                                 </code></pre>
 
+                                <h4>Membuat Banyak Pembayaran Sekaligus (Batch)</h4>
+                                <p>Endpoint: <code>POST /api/v1/payments/batch</code> dengan body <code>{"payments": [{...}, ...]}</code>, setiap item memakai parameter yang sama seperti di atas (maksimal 1.000 item per permintaan).
+                                Respons berisi array <code>results</code> sesuai urutan permintaan: item yang berhasil mendapat <code>payment_id</code> dan <code>payment_url</code>, atau <code>qr_page_url</code> untuk metode <code>'qr'</code> (gambar QR dibuat saat halaman dibuka, karena kodenya hanya berlaku 5 menit). Item yang tidak valid mendapat <code>status</code> <code>FAILED</code> beserta <code>error</code>.</p>
+
                                 <hr class="my-4">
 
                                 <h3 id="webhook">3. Notifikasi Webhook</h3>
                                 <p>Jika Anda mengatur URL Webhook di dashboard, sistem kami akan mengirimkan notifikasi dengan metode <code>POST</code> ke URL tersebut setiap kali status pembayaran berubah (misalnya, dari <code>PENDING</code> menjadi <code>PAID</code>).</p>
                                 <p>Untuk memverifikasi bahwa webhook berasal dari GabutPay, setiap request webhook akan menyertakan header <code>X-GABUTPAY-SIGNATURE</code>. Signature ini dibuat dengan mengenkripsi body mentah dari webhook menggunakan algoritma HMAC-SHA256 dan <strong>Webhook Secret</strong> Anda sebagai kuncinya.</p>
+                                <p>Webhook dikirim secara asinkron. Jika server Anda tidak membalas dengan status <code>2xx</code>, pengiriman akan diulang beberapa kali dengan jeda yang makin panjang (<em>exponential backoff</em>). Header <code>X-GABUTPAY-DELIVERY</code> bernilai sama untuk setiap pengulangan, sehingga bisa Anda gunakan untuk mengabaikan duplikat.</p>
                                 
                                 <h4>Contoh Payload Webhook</h4>
                                 <pre class="bg-dark text-light p-3 rounded"><code>
@@ -1137,6 +1216,10 @@ def docs_inbound():
                                         <strong>HMAC Signature:</strong> Setiap permintaan harus disertai tanda tangan digital menggunakan algoritma <strong>HMAC-SHA256</strong>. 
                                         <em>String-to-sign</em> dibentuk dengan format: <code>{TIMESTAMP}.{RAW_JSON_BODY}</code>.
                                     </li>
+                                    <li>
+                                        <strong>Nonce (Anti-Replay):</strong> Opsional, kirim header <code>X-REQUEST-NONCE</code> berisi string acak unik (16-64 karakter <code>A-Z a-z 0-9 _ -</code>) untuk setiap permintaan.
+                                        Jika dikirim, <em>string-to-sign</em> menjadi <code>{TIMESTAMP}.{NONCE}.{RAW_JSON_BODY}</code> dan permintaan yang diputar ulang dengan nonce yang sama akan ditolak dengan status <code>409</code>.
+                                    </li>
                                     <li>
                                         <strong>IP Whitelisting:</strong> Server kami hanya akan memproses permintaan yang berasal dari alamat IP yang telah didaftarkan melalui Dashboard Admin GabutPay.
                                     </li>
@@ -1180,6 +1263,11 @@ def docs_inbound():
                                     </tbody>
                                 </table>
 
+                                <h4 id="batch">Transfer Massal (Batch)</h4>
+                                <p>Endpoint: <code>POST /api/v1/inbound-transfer/batch</code></p>
+                                <p>Untuk top up dalam jumlah besar, kirim hingga 1.000 item sekaligus dalam satu permintaan bertanda tangan dengan body <code>{"transfers": [{"amount": ..., "external_id": ..., "recipient_email": ...}, ...]}</code>.
+                                Setiap item diproses secara terpisah dengan aturan yang sama seperti endpoint tunggal (idempotensi, limit harian, saldo). Respons berisi array <code>results</code> sesuai urutan permintaan dengan <code>status</code> <code>SUCCESS</code>, <code>DUPLICATE</code>, atau <code>FAILED</code> beserta <code>code</code> dan <code>error</code> untuk setiap item.</p>
+
                                 <hr class="my-4">
 
                                 <h3 id="contoh-kode">3. Contoh Implementasi</h3>
@@ -1368,15 +1456,13 @@ def bug_report():
         
         user_info = f"Pengguna: {current_user.email} (ID: {current_user.id})" if current_user.is_authenticated else "Pengguna: Anonim"
 
-        msg = Message(f"Laporan Bug/Feedback: {subject}",
-                      sender=current_app.config['MAIL_USERNAME'],
-                      recipients=[current_app.config['ADMIN_EMAIL']])
-        msg.body = f"Laporan baru diterima.\n\nDari: {user_info}\n\nDeskripsi:\n{description}"
+        body = f"Laporan baru diterima.\n\nDari: {user_info}\n\nDeskripsi:\n{description}"
         
         try:
-            mail.send(msg)
+            queue_email(f"Laporan Bug/Feedback: {subject}", [current_app.config['ADMIN_EMAIL']], body)
             flash('Terima kasih! Laporan Anda telah berhasil dikirim.', 'success')
         except Exception as e:
+            db.session.rollback()
             current_app.logger.error(f"Error sending bug report email: {e}")
             flash('Gagal mengirim laporan. Silakan coba lagi nanti.', 'danger')
         return redirect(url_for('main.home'))
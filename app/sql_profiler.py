@@ -0,0 +1,180 @@
+import heapq
+import math
+import os
+import threading
+import time
+from collections import deque
+from flask import current_app, g, has_app_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+_stats_lock = threading.Lock()
+_listeners_installed = False
+
+MAX_STATEMENT_LENGTH = 500
+
+
+def init_sql_profiler(app):
+    """
+    Opt-in (SQL_PROFILER_ENABLED) per-request SQL profiling. Counts queries
+    and DB time for every request, sends them back in a Server-Timing header
+    and keeps a rolling per-endpoint report for /admin/sql-profile.
+    """
+    if not app.config['SQL_PROFILER_ENABLED']:
+        return
+    _install_listeners()
+
+    @app.before_request
+    def start_sql_profile():
+        g._sql_profile = RequestProfile(app.config['SQL_PROFILER_SLOW_STATEMENTS'])
+
+    @app.after_request
+    def finish_sql_profile(response):
+        profile = g.pop('_sql_profile', None)
+        if profile is None:
+            return response
+        total_ms = (time.perf_counter() - profile.started) * 1000
+        lock_ms = g.get('lock_wait_ms', 0.0) - profile.lock_wait_before
+        response.headers.add(
+            'Server-Timing',
+            f'db;dur={profile.db_ms:.2f};desc="{profile.query_count} queries", '
+            f'lock;dur={lock_ms:.2f}, app;dur={total_ms:.2f}'
+        )
+        get_profiler_stats(app).record(request.endpoint or 'unknown', profile, total_ms)
+        return response
+
+def _install_listeners():
+    # Listening on the Engine class covers every engine the app creates; it is done once per process
+    global _listeners_installed
+    with _stats_lock:
+        if _listeners_installed:
+            return
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+        _listeners_installed = True
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('_sql_profiler_start', []).append(time.perf_counter())
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    starts = conn.info.get('_sql_profiler_start')
+    if not starts:
+        return
+    duration_ms = (time.perf_counter() - starts.pop()) * 1000
+    if has_app_context():
+        profile = g.get('_sql_profile')
+        if profile is not None:
+            profile.add(statement, duration_ms)
+
+
+class RequestProfile:
+    """Query count, DB time and the slowest statements of one request."""
+
+    def __init__(self, keep_slowest):
+        self.started = time.perf_counter()
+        self.lock_wait_before = g.get('lock_wait_ms', 0.0)
+        self.query_count = 0
+        self.db_ms = 0.0
+        self.keep_slowest = keep_slowest
+        self.slowest = []  # min-heap of (duration_ms, statement)
+
+    def add(self, statement, duration_ms):
+        self.query_count += 1
+        self.db_ms += duration_ms
+        if self.keep_slowest <= 0:
+            return
+        item = (duration_ms, statement[:MAX_STATEMENT_LENGTH])
+        if len(self.slowest) < self.keep_slowest:
+            heapq.heappush(self.slowest, item)
+        elif duration_ms > self.slowest[0][0]:
+            heapq.heapreplace(self.slowest, item)
+
+
+def get_profiler_stats(app=None):
+    """Returns the app's ProfilerStats, creating it if needed."""
+    app = app or current_app._get_current_object()
+    with _stats_lock:
+        stats = app.extensions.get('sql_profiler_stats')
+        if stats is None:
+            stats = app.extensions['sql_profiler_stats'] = ProfilerStats(
+                app.config['SQL_PROFILER_WINDOW'],
+                app.config['SQL_PROFILER_SLOW_STATEMENTS']
+            )
+    return stats
+
+def _percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return 0
+    rank = max(1, math.ceil(fraction * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+class ProfilerStats:
+    """
+    Rolling per-process report: the last `window` requests per endpoint
+    (query count, DB time, total time) and the slowest statements seen.
+    """
+
+    def __init__(self, window, keep_slowest):
+        self.window = window
+        self.keep_slowest = max(keep_slowest * 4, 20)
+        self.started_at = time.time()
+        self._samples = {}   # endpoint -> deque of (query_count, db_ms, total_ms)
+        self._slowest = []   # min-heap of (duration_ms, endpoint, statement)
+        self._lock = threading.Lock()
+
+    def record(self, endpoint, profile, total_ms):
+        with self._lock:
+            samples = self._samples.get(endpoint)
+            if samples is None:
+                samples = self._samples[endpoint] = deque(maxlen=self.window)
+            samples.append((profile.query_count, profile.db_ms, total_ms))
+            for duration_ms, statement in profile.slowest:
+                item = (duration_ms, endpoint, statement)
+                if len(self._slowest) < self.keep_slowest:
+                    heapq.heappush(self._slowest, item)
+                elif duration_ms > self._slowest[0][0]:
+                    heapq.heapreplace(self._slowest, item)
+
+    def snapshot(self):
+        with self._lock:
+            samples = {endpoint: list(values) for endpoint, values in self._samples.items()}
+            slowest = sorted(self._slowest, reverse=True)
+
+        endpoints = []
+        for endpoint, values in samples.items():
+            queries = sorted(v[0] for v in values)
+            db_ms = sorted(v[1] for v in values)
+            total_ms = sorted(v[2] for v in values)
+            endpoints.append({
+                'endpoint': endpoint,
+                'requests': len(values),
+                'queries_mean': round(sum(queries) / len(queries), 2),
+                'queries_p50': _percentile(queries, 0.5),
+                'queries_p95': _percentile(queries, 0.95),
+                'queries_max': queries[-1],
+                'db_ms_p50': round(_percentile(db_ms, 0.5), 2),
+                'db_ms_p95': round(_percentile(db_ms, 0.95), 2),
+                'db_ms_p99': round(_percentile(db_ms, 0.99), 2),
+                'total_ms_p50': round(_percentile(total_ms, 0.5), 2),
+                'total_ms_p95': round(_percentile(total_ms, 0.95), 2),
+                'total_ms_p99': round(_percentile(total_ms, 0.99), 2),
+            })
+        endpoints.sort(key=lambda e: -e['db_ms_p95'])
+        return {
+            'pid': os.getpid(),
+            'since': self.started_at,
+            'window': self.window,
+            'endpoints': endpoints,
+            'slowest_statements': [
+                {'duration_ms': round(duration_ms, 2), 'endpoint': endpoint, 'statement': statement}
+                for duration_ms, endpoint, statement in slowest
+            ],
+        }
+
+    def reset(self):
+        with self._lock:
+            self.started_at = time.time()
+            self._samples.clear()
+            self._slowest.clear()
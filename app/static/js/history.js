@@ -0,0 +1,53 @@
+document.addEventListener('DOMContentLoaded', function () {
+    const historyList = document.getElementById('history-list');
+    const loadMoreBtn = document.getElementById('history-load-more');
+    if (!historyList || !loadMoreBtn) return;
+
+    let nextUrl = loadMoreBtn.dataset.nextUrl;
+    let isLoading = false;
+
+    const loadMore = async () => {
+        if (isLoading || !nextUrl) return;
+        isLoading = true;
+        loadMoreBtn.classList.add('disabled');
+        loadMoreBtn.textContent = 'Memuat...';
+
+        try {
+            const response = await fetch(nextUrl, { headers: { 'Accept': 'application/json' } });
+            const contentType = response.headers.get('content-type');
+            if (!response.ok || !contentType || contentType.indexOf('application/json') === -1) {
+                // Session expired or server error: fall back to the plain link
+                window.location.href = loadMoreBtn.href;
+                return;
+            }
+
+            const data = await response.json();
+            historyList.insertAdjacentHTML('beforeend', data.html);
+            nextUrl = data.next_url;
+
+            if (!nextUrl) {
+                loadMoreBtn.closest('.card-footer').remove();
+                observer.disconnect();
+                return;
+            }
+            loadMoreBtn.href = loadMoreBtn.href.split('?')[0] + '?after=' + encodeURIComponent(data.next_cursor);
+        } catch (error) {
+            console.error('Gagal memuat riwayat:', error);
+        } finally {
+            isLoading = false;
+            loadMoreBtn.classList.remove('disabled');
+            loadMoreBtn.textContent = 'Muat Lebih Banyak';
+        }
+    };
+
+    loadMoreBtn.addEventListener('click', function (event) {
+        event.preventDefault();
+        loadMore();
+    });
+
+    // Infinite scroll: load the next page as soon as the button scrolls into view
+    const observer = new IntersectionObserver(entries => {
+        if (entries.some(entry => entry.isIntersecting)) loadMore();
+    }, { rootMargin: '200px' });
+    observer.observe(loadMoreBtn);
+});
@@ -0,0 +1,106 @@
+import random
+from collections import namedtuple
+from datetime import datetime
+from flask import current_app, has_app_context
+from sqlalchemy import event, func
+from sqlalchemy.orm import Session
+from . import db
+from .models import User, JournalLeg, StatShard
+from .lock_stats import timed_lock
+
+COUNTERS = ('user_count', 'total_balance', 'journal_leg_count')
+
+DashboardStats = namedtuple('DashboardStats', COUNTERS + ('updated_at', 'recomputed_at'))
+
+
+def add_stat_delta(name, delta, session=None):
+    """
+    Adds delta to a dashboard total when the current transaction commits.
+    Inserted/deleted User and JournalLeg rows are counted automatically;
+    bulk statements (ledger.py, bulk deletes) have to call this themselves.
+    """
+    if not delta:
+        return
+    session = session or db.session()
+    deltas = session.info.setdefault('_stat_deltas', {})
+    deltas[name] = deltas.get(name, 0) + delta
+
+def get_dashboard_stats():
+    """Sums the shards into DashboardStats, or returns None if the totals were never computed."""
+    row = db.session.query(
+        func.coalesce(func.sum(StatShard.user_count), 0),
+        func.coalesce(func.sum(StatShard.total_balance), 0),
+        func.coalesce(func.sum(StatShard.journal_leg_count), 0),
+        func.max(StatShard.updated_at),
+        func.max(StatShard.recomputed_at)
+    ).one()
+    if row[4] is None:
+        return None
+    return DashboardStats(*row)
+
+def recompute_stats():
+    """
+    Recounts every total from the source tables: shard 0 gets the totals and
+    the other shards are zeroed, creating any missing up to STATS_SHARD_COUNT.
+    Locks the shards so no commit adds a delta in between; the caller commits.
+    """
+    with timed_lock('stats.recompute', 'stat_shard'):
+        shards = {shard.shard_no: shard for shard in
+                  StatShard.query.order_by(StatShard.shard_no).with_for_update().all()}
+
+    totals = {
+        'user_count': db.session.query(func.count(User.id)).scalar(),
+        'total_balance': db.session.query(func.coalesce(func.sum(User.balance), 0)).scalar(),
+        'journal_leg_count': db.session.query(func.count(JournalLeg.id)).scalar(),
+    }
+    now = datetime.utcnow()
+    shard_count = max([current_app.config['STATS_SHARD_COUNT']] + [no + 1 for no in shards])
+    for shard_no in range(shard_count):
+        shard = shards.get(shard_no)
+        if shard is None:
+            shard = StatShard(shard_no=shard_no)
+            db.session.add(shard)
+        for name in COUNTERS:
+            setattr(shard, name, totals[name] if shard_no == 0 else 0)
+        shard.updated_at = now
+        shard.recomputed_at = now
+    return DashboardStats(updated_at=now, recomputed_at=now, **totals)
+
+
+@event.listens_for(Session, 'after_flush')
+def _count_flushed_rows(session, flush_context):
+    for obj in session.new:
+        if isinstance(obj, User):
+            add_stat_delta('user_count', 1, session)
+            add_stat_delta('total_balance', obj.balance or 0, session)
+        elif isinstance(obj, JournalLeg):
+            add_stat_delta('journal_leg_count', 1, session)
+    for obj in session.deleted:
+        if isinstance(obj, User):
+            add_stat_delta('user_count', -1, session)
+            add_stat_delta('total_balance', -(obj.balance or 0), session)
+        elif isinstance(obj, JournalLeg):
+            add_stat_delta('journal_leg_count', -1, session)
+
+@event.listens_for(Session, 'before_commit')
+def _apply_stat_deltas(session):
+    if session.new or session.deleted:
+        # Rows added since the last flush only count once they are flushed
+        session.flush()
+    deltas = {name: delta for name, delta in session.info.pop('_stat_deltas', {}).items() if delta}
+    if not deltas or not has_app_context():
+        return
+
+    values = {getattr(StatShard, name): getattr(StatShard, name) + delta for name, delta in deltas.items()}
+    values[StatShard.updated_at] = datetime.utcnow()
+    shard_no = random.randrange(current_app.config['STATS_SHARD_COUNT'])
+    with timed_lock('stats.apply', 'stat_shard', shard_no):
+        updated = session.query(StatShard).filter_by(shard_no=shard_no).update(values, synchronize_session=False)
+    if not updated:
+        # Shard not seeded yet (e.g. STATS_SHARD_COUNT was raised); shard 0 always exists once computed.
+        # If nothing was ever computed the delta is dropped: the first recompute counts it anyway.
+        session.query(StatShard).filter_by(shard_no=0).update(values, synchronize_session=False)
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_stat_deltas(session):
+    session.info.pop('_stat_deltas', None)
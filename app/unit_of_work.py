@@ -0,0 +1,137 @@
+import random
+import threading
+import time
+from collections import defaultdict
+from functools import wraps
+from flask import current_app, g
+from sqlalchemy.exc import DBAPIError
+from . import db
+
+# SQLSTATEs after which the database has rolled the transaction back and running it again is safe
+RETRYABLE_SQLSTATES = {
+    '40001',  # serialization_failure
+    '40P01',  # deadlock_detected
+    '55P03',  # lock_not_available (lock_timeout)
+}
+
+_stats_lock = threading.Lock()
+
+
+def is_retryable_error(exc):
+    """True if exc is a lock conflict that aborted the whole transaction."""
+    if not isinstance(exc, DBAPIError) or exc.connection_invalidated:
+        # A dropped connection may have lost a COMMIT that actually succeeded
+        return False
+    return _error_code(exc) is not None
+
+def should_retry(exc):
+    """
+    For `except Exception` blocks inside a unit_of_work view: True means
+    re-raise so the decorator runs the view again. On the last attempt this
+    is False and the view's own error handling takes over.
+    """
+    if not is_retryable_error(exc):
+        return False
+    if g.get('_uow_attempts_left', 0) > 0:
+        return True
+    if g.get('_uow_active'):
+        get_retry_stats().record_exhausted(g.get('_uow_view'), _error_code(exc))
+    return False
+
+def _error_code(exc):
+    orig = exc.orig
+    # psycopg2 exposes pgcode, psycopg 3 exposes sqlstate
+    sqlstate = getattr(orig, 'pgcode', None) or getattr(orig, 'sqlstate', None)
+    if sqlstate in RETRYABLE_SQLSTATES:
+        return sqlstate
+    # SQLite (local development): another connection holds the write lock
+    if 'database is locked' in str(orig):
+        return 'SQLITE_BUSY'
+    return None
+
+
+def unit_of_work(f):
+    """
+    Re-runs a view from the start when it fails on a deadlock or serialization
+    failure, with jittered exponential backoff, up to DB_RETRY_MAX_ATTEMPTS.
+
+    Place it below login/API auth decorators so a retry does not repeat them
+    (a retried signed request would otherwise trip replay protection). Views
+    that catch Exception must re-raise when should_retry(e) is True.
+    """
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if g.get('_uow_active'):
+            # Already inside a unit of work: only the outermost one may retry
+            return f(*args, **kwargs)
+
+        max_attempts = max(1, current_app.config['DB_RETRY_MAX_ATTEMPTS'])
+        g._uow_active = True
+        g._uow_view = f.__name__
+        try:
+            for attempt in range(1, max_attempts + 1):
+                g._uow_attempts_left = max_attempts - attempt
+                try:
+                    return f(*args, **kwargs)
+                except DBAPIError as e:
+                    db.session.rollback()
+                    if not is_retryable_error(e):
+                        raise
+                    code = _error_code(e)
+                    if attempt == max_attempts:
+                        get_retry_stats().record_exhausted(f.__name__, code)
+                        current_app.logger.error(f"DB retry budget exhausted for {f.__name__} after {attempt} attempts ({code})")
+                        raise
+                    delay = _backoff(attempt)
+                    get_retry_stats().record_retry(f.__name__, code)
+                    current_app.logger.warning(f"DB retry {f.__name__}: attempt {attempt} hit {code}, retrying in {delay:.3f}s")
+                    time.sleep(delay)
+        finally:
+            g.pop('_uow_active', None)
+            g.pop('_uow_attempts_left', None)
+            g.pop('_uow_view', None)
+    return decorated_function
+
+def _backoff(attempt):
+    """Exponential backoff with full jitter, capped at DB_RETRY_MAX_DELAY seconds."""
+    config = current_app.config
+    delay = min(config['DB_RETRY_BASE_DELAY'] * (2 ** (attempt - 1)), config['DB_RETRY_MAX_DELAY'])
+    return random.uniform(0, delay)
+
+
+def get_retry_stats(app=None):
+    """Returns the app's RetryStats, creating it if needed."""
+    app = app or current_app._get_current_object()
+    with _stats_lock:
+        stats = app.extensions.get('db_retry_stats')
+        if stats is None:
+            stats = app.extensions['db_retry_stats'] = RetryStats()
+    return stats
+
+
+class RetryStats:
+    """Per-process retry counters, keyed by view name and error code."""
+
+    def __init__(self):
+        self._retries = defaultdict(int)    # (view, code) -> retries
+        self._exhausted = defaultdict(int)  # (view, code) -> requests that ran out of attempts
+        self._lock = threading.Lock()
+
+    def record_retry(self, view, code):
+        with self._lock:
+            self._retries[(view, code)] += 1
+
+    def record_exhausted(self, view, code):
+        with self._lock:
+            self._exhausted[(view, code)] += 1
+
+    def snapshot(self):
+        """Returns [{'view', 'code', 'retries', 'exhausted'}, ...] sorted by most retries."""
+        with self._lock:
+            keys = set(self._retries) | set(self._exhausted)
+            rows = [
+                {'view': view, 'code': code, 'retries': self._retries.get((view, code), 0),
+                 'exhausted': self._exhausted.get((view, code), 0)}
+                for view, code in keys
+            ]
+        return sorted(rows, key=lambda row: (-row['retries'], row['view']))
@@ -0,0 +1,72 @@
+import threading
+from flask import current_app
+from sqlalchemy import func, inspect, or_
+from . import db
+from .models import User
+
+USERS_PER_PAGE = 15
+TRIGRAM_INDEX = 'ix_user_email_trgm'
+MIN_TRIGRAM_TERM = 3 # pg_trgm cannot use the index for shorter patterns
+MAX_USER_ID = 2**31 - 1
+
+_trigram_lock = threading.Lock()
+
+
+def search_users(term='', after=None, per_page=USERS_PER_PAGE):
+    """
+    One page of the admin user list, newest first, optionally filtered by a
+    search term: an exact user id ('123' or '#123') or an email. Emails are
+    matched by substring where the trigram index exists (PostgreSQL with
+    pg_trgm) and by prefix otherwise; both are served by an index.
+
+    Users are ordered by id alone, so the cursor is just the last id shown:
+    the page seeks below `after` instead of using OFFSET and needs no
+    COUNT(*). Returns (users, next_cursor, match) where match is
+    'substring', 'prefix' or None when not searching.
+    """
+    query = User.query
+    term = term.strip().lower()
+    match = None
+    if term:
+        match = 'substring' if len(term) >= MIN_TRIGRAM_TERM and trigram_search_enabled() else 'prefix'
+        criteria = [_email_criterion(term, match)]
+        user_id = term.lstrip('#')
+        if user_id.isdigit() and int(user_id) <= MAX_USER_ID:
+            criteria.append(User.id == int(user_id))
+        query = query.filter(or_(*criteria))
+    if after is not None:
+        query = query.filter(User.id < after)
+
+    # Fetch one extra row to know whether there is a next page
+    users = query.order_by(User.id.desc()).limit(per_page + 1).all()
+    next_cursor = None
+    if len(users) > per_page:
+        users = users[:per_page]
+        next_cursor = users[-1].id
+    return users, next_cursor, match
+
+def trigram_search_enabled(app=None):
+    """True if the optional trigram index on lower(email) exists. Checked once per process."""
+    app = app or current_app._get_current_object()
+    with _trigram_lock:
+        enabled = app.extensions.get('user_search_trigram')
+        if enabled is None:
+            enabled = db.engine.dialect.name == 'postgresql' and any(
+                index['name'] == TRIGRAM_INDEX for index in inspect(db.engine).get_indexes('user')
+            )
+            app.extensions['user_search_trigram'] = enabled
+    return enabled
+
+def _email_criterion(term, match):
+    email = func.lower(User.email)
+    if match == 'substring':
+        return email.like(f'%{_escape_like(term)}%', escape='\\')
+    if db.engine.dialect.name == 'postgresql':
+        # Served by the text_pattern_ops index
+        return email.like(f'{_escape_like(term)}%', escape='\\')
+    # SQLite only uses an expression index for LIKE under special pragmas, but always for a range
+    upper = term[:-1] + chr(ord(term[-1]) + 1)
+    return (email >= term) & (email < upper)
+
+def _escape_like(term):
+    return term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
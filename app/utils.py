@@ -1,13 +1,8 @@
 import os
 import base64
 from cryptography.fernet import Fernet, InvalidToken
-import qrcode
-import json
-import time
-import hmac
-import hashlib
-import io
-from flask import current_app
+from datetime import datetime
+from .qr_cache import get_qr_png, qr_expiry
 
 # Load the master encryption key from environment variables
 ENCRYPTION_KEY = os.environ.get('ENCRYPTION_KEY')
@@ -36,47 +31,26 @@ def decrypt_data(token: str) -> bytes | None:
         # This handles invalid tokens (tampered with, incorrect padding, etc.)
         return None
 
-def generate_qr_code(payment):
-    """Generates a secure, dynamic QR code for a given payment."""
-    secret_key = current_app.config['QR_HMAC_SECRET_KEY']
-    if not secret_key:
-        raise ValueError("QR_HMAC_SECRET_KEY is not configured.")
-
-    # 1. Create the payload
-    payload = {
-        "txid": payment.payment_id,
-        "amount": payment.amount,
-        "exp": int(time.time()) + 300  # Expires in 5 minutes
-    }
-    
-    # Sort keys to ensure consistent string for signing
-    payload_string = json.dumps(payload, sort_keys=True)
+def encode_cursor(timestamp, row_id):
+    """Encodes a (timestamp, id) keyset position into an opaque, URL-safe cursor string."""
+    raw = f"{timestamp.isoformat()}|{row_id}".encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('utf-8').rstrip('=')
 
-    # 2. Generate HMAC signature
-    sig = hmac.new(
-        secret_key.encode('utf-8'),
-        payload_string.encode('utf-8'),
-        hashlib.sha256
-    ).hexdigest()
-
-    # 3. Add signature to the final data
-    data_to_encode = {
-        "payload": payload,
-        "sig": sig
-    }
-    
-    final_data_string = json.dumps(data_to_encode)
+def decode_cursor(cursor: str):
+    """Decodes a cursor made by encode_cursor. Returns (timestamp, id), or None if it is missing or malformed."""
+    if not cursor:
+        return None
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        timestamp_str, id_str = base64.urlsafe_b64decode(padded.encode('utf-8')).decode('utf-8').split('|')
+        return datetime.fromisoformat(timestamp_str), int(id_str)
+    except (ValueError, UnicodeDecodeError):
+        # binascii.Error is a ValueError subclass, so bad base64 lands here too
+        return None
 
-    # 4. Generate QR code image in memory
-    qr = qrcode.QRCode(error_correction=qrcode.constants.ERROR_CORRECT_L)
-    qr.add_data(final_data_string)
-    qr.make(fit=True)
-    
-    img = qr.make_image(fill='black', back_color='white')
-    
-    # 5. Save image to a buffer and encode as Base64
-    buffer = io.BytesIO()
-    img.save(buffer, format="PNG")
-    img_str = base64.b64encode(buffer.getvalue()).decode("utf-8")
+def generate_qr_code(payment):
+    """Generates a secure, dynamic QR code for a given payment as a data URI."""
+    _, png = get_qr_png(payment, qr_expiry())
+    img_str = base64.b64encode(png).decode("utf-8")
 
     return f"data:image/png;base64,{img_str}"
@@ -0,0 +1,244 @@
+import json
+import hmac
+import hashlib
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+from flask import current_app
+from . import db
+from .models import WebhookDelivery, APIKey
+from .utils import decrypt_data
+
+_dispatcher_lock = threading.Lock()
+
+def build_webhook_payload(payment):
+    """Serializes the webhook body exactly as it will be signed and sent."""
+    webhook_payload = {
+        'payment_id': payment.payment_id,
+        'merchant_order_id': payment.merchant_order_id,
+        'status': payment.status,
+        'amount': payment.amount,
+        'paid_at': payment.paid_at.isoformat() if payment.paid_at else None
+    }
+    return json.dumps(webhook_payload, separators=(',', ':'))
+
+def enqueue_webhook(payment, api_key, event='payment.paid'):
+    """
+    Adds a delivery row to the current session. It is committed (or rolled
+    back) together with the payment, so a webhook is never lost or sent for
+    a payment that did not happen.
+    """
+    delivery = WebhookDelivery(
+        payment_id=payment.id,
+        api_key_id=api_key.id,
+        merchant_id=payment.merchant_id,
+        event=event,
+        url=api_key.webhook_url,
+        payload=build_webhook_payload(payment),
+        next_attempt_at=datetime.utcnow()
+    )
+    db.session.add(delivery)
+    return delivery
+
+def notify_dispatcher():
+    """Wakes the in-process dispatcher after new deliveries were committed, starting it on first use."""
+    if not current_app.config['WEBHOOK_INPROCESS_WORKER']:
+        return
+    dispatcher = get_dispatcher()
+    dispatcher.start()
+    dispatcher.notify()
+
+def get_dispatcher(app=None):
+    """Returns the app's single WebhookDispatcher, creating it if needed."""
+    app = app or current_app._get_current_object()
+    with _dispatcher_lock:
+        dispatcher = app.extensions.get('webhook_dispatcher')
+        if dispatcher is None:
+            dispatcher = app.extensions['webhook_dispatcher'] = WebhookDispatcher(app)
+    return dispatcher
+
+
+class WebhookDispatcher:
+    """
+    Delivers queued webhooks in the background.
+
+    A poller thread claims due rows with a conditional UPDATE (so several
+    processes can share the queue) and hands them to a thread pool. HTTP
+    sessions are kept per merchant origin for keep-alive, each merchant gets
+    at most WEBHOOK_PER_MERCHANT_CONCURRENCY requests in flight, and failures
+    are retried with jittered exponential backoff up to WEBHOOK_MAX_ATTEMPTS.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        config = app.config
+        self.batch_size = config['WEBHOOK_BATCH_SIZE']
+        self.max_attempts = config['WEBHOOK_MAX_ATTEMPTS']
+        self.backoff_base = config['WEBHOOK_BACKOFF_BASE']
+        self.backoff_max = config['WEBHOOK_BACKOFF_MAX']
+        self.timeout = config['WEBHOOK_TIMEOUT']
+        self.per_merchant = config['WEBHOOK_PER_MERCHANT_CONCURRENCY']
+        self.poll_interval = config['WEBHOOK_POLL_INTERVAL']
+
+        self.executor = ThreadPoolExecutor(max_workers=config['WEBHOOK_WORKERS'], thread_name_prefix='webhook')
+        self._sessions = {}  # origin -> requests.Session
+        self._inflight = {}  # merchant_id -> requests currently being sent
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    # --- Lifecycle ---
+
+    def start(self):
+        """Starts the poller thread if it is not already running."""
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self.run_forever, name='webhook-dispatcher', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wakeup.set()
+
+    def notify(self):
+        self._wakeup.set()
+
+    def run_forever(self):
+        """Polls the queue until stopped. Used by the poller thread and `flask webhook-worker`."""
+        with self.app.app_context():
+            while not self._stop.is_set():
+                try:
+                    dispatched = self.run_once()
+                except Exception as e:
+                    db.session.rollback()
+                    self.app.logger.error(f"Webhook dispatcher poll failed: {e}")
+                    dispatched = 0
+
+                if not dispatched:
+                    self._wakeup.wait(self.poll_interval)
+                    self._wakeup.clear()
+
+    # --- Claiming ---
+
+    def run_once(self):
+        """Claims due deliveries and submits them to the pool. Returns how many were dispatched."""
+        now = datetime.utcnow()
+        # SENDING rows whose lease has expired belong to a worker that died mid-request
+        due = WebhookDelivery.query.filter(
+            WebhookDelivery.status.in_(['PENDING', 'SENDING']),
+            WebhookDelivery.next_attempt_at <= now
+        ).order_by(WebhookDelivery.next_attempt_at).limit(self.batch_size).all()
+
+        dispatched = 0
+        for delivery in due:
+            with self._lock:
+                if self._inflight.get(delivery.merchant_id, 0) >= self.per_merchant:
+                    continue
+
+            lease_until = now + timedelta(seconds=self.timeout * 3)
+            claimed = WebhookDelivery.query.filter(
+                WebhookDelivery.id == delivery.id,
+                WebhookDelivery.status == delivery.status,
+                WebhookDelivery.next_attempt_at == delivery.next_attempt_at
+            ).update({'status': 'SENDING', 'next_attempt_at': lease_until}, synchronize_session=False)
+            db.session.commit()
+            if not claimed:
+                continue  # Another worker got it first
+
+            with self._lock:
+                self._inflight[delivery.merchant_id] = self._inflight.get(delivery.merchant_id, 0) + 1
+            self.executor.submit(
+                self._deliver, delivery.id, delivery.merchant_id, delivery.api_key_id,
+                delivery.url, delivery.payload, delivery.attempts
+            )
+            dispatched += 1
+        return dispatched
+
+    # --- Delivery ---
+
+    def _session_for(self, url):
+        """Returns a keep-alive session dedicated to the URL's origin."""
+        parts = urlsplit(url)
+        origin = f"{parts.scheme}://{parts.netloc}"
+        with self._lock:
+            session = self._sessions.get(origin)
+            if session is None:
+                session = requests.Session()
+                session.mount(origin, HTTPAdapter(pool_connections=1, pool_maxsize=self.per_merchant))
+                self._sessions[origin] = session
+        return session
+
+    def _deliver(self, delivery_id, merchant_id, api_key_id, url, payload, attempts):
+        with self.app.app_context():
+            try:
+                status_code, error, retryable = self._post(delivery_id, api_key_id, url, payload)
+                self._record_result(delivery_id, attempts + 1, status_code, error, retryable)
+            except Exception as e:
+                db.session.rollback()
+                self.app.logger.error(f"Webhook delivery {delivery_id} crashed: {e}")
+            finally:
+                db.session.remove()
+                with self._lock:
+                    self._inflight[merchant_id] -= 1
+                self._wakeup.set()
+
+    def _post(self, delivery_id, api_key_id, url, payload):
+        """Signs and sends one delivery. Returns (status_code, error, retryable)."""
+        api_key = db.session.get(APIKey, api_key_id)
+        raw_webhook_secret = None
+        if api_key and api_key.webhook_secret_encrypted:
+            decrypted_secret_bytes = decrypt_data(api_key.webhook_secret_encrypted)
+            if decrypted_secret_bytes:
+                raw_webhook_secret = decrypted_secret_bytes.decode('utf-8')
+
+        if not raw_webhook_secret:
+            # Retrying cannot fix a missing secret
+            return None, 'Webhook secret not found or could not be decrypted', False
+
+        payload_body = payload.encode('utf-8')
+        signature = hmac.new(raw_webhook_secret.encode('utf-8'), payload_body, hashlib.sha256).hexdigest()
+        headers = {
+            'Content-Type': 'application/json',
+            'X-GABUTPAY-SIGNATURE': signature,
+            'X-GABUTPAY-DELIVERY': str(delivery_id)
+        }
+
+        try:
+            response = self._session_for(url).post(url, data=payload_body, headers=headers, timeout=self.timeout)
+        except requests.exceptions.RequestException as e:
+            return None, str(e)[:255], True
+
+        if 200 <= response.status_code < 300:
+            return response.status_code, None, False
+        return response.status_code, f"HTTP {response.status_code}", True
+
+    def _record_result(self, delivery_id, attempts, status_code, error, retryable):
+        delivery = db.session.get(WebhookDelivery, delivery_id)
+        delivery.attempts = attempts
+        delivery.last_status_code = status_code
+        delivery.last_error = error
+
+        if error is None:
+            delivery.status = 'DELIVERED'
+            delivery.delivered_at = datetime.utcnow()
+            self.app.logger.info(f"Webhook {delivery_id} delivered to {delivery.url}")
+        elif not retryable or attempts >= self.max_attempts:
+            delivery.status = 'FAILED'
+            self.app.logger.error(f"Webhook {delivery_id} to {delivery.url} failed permanently after {attempts} attempt(s): {error}")
+        else:
+            delivery.status = 'PENDING'
+            delivery.next_attempt_at = datetime.utcnow() + timedelta(seconds=self._backoff(attempts))
+            self.app.logger.warning(f"Webhook {delivery_id} to {delivery.url} failed (attempt {attempts}): {error}. Retrying at {delivery.next_attempt_at}.")
+        db.session.commit()
+
+    def _backoff(self, attempts):
+        """Exponential backoff with equal jitter (half the delay is fixed), capped at WEBHOOK_BACKOFF_MAX seconds."""
+        delay = min(self.backoff_base * (2 ** (attempts - 1)), self.backoff_max)
+        return random.uniform(delay / 2, delay)
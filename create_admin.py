@@ -1,7 +1,8 @@
 import sys
 import getpass
 from run import app
-from app import db, bcrypt
+from app import db
+from app.hashing import hash_secret
 from app.models import User
 
 def create_admin():
@@ -36,7 +37,7 @@ def create_admin():
 
         # 3. Membuat user admin baru
         try:
-            hashed_password = bcrypt.generate_password_hash(password).decode('utf-8')
+            hashed_password = hash_secret('password', password)
             new_admin = User(
                 email=email,
                 password_hash=hashed_password,
@@ -0,0 +1,44 @@
+"""add user email search indexes
+
+Revision ID: e2c7a9d31f58
+Revises: d5b8e1f04a27
+Create Date: 2026-10-17 14:22:10.493871
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e2c7a9d31f58'
+down_revision = 'd5b8e1f04a27'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    bind = op.get_bind()
+    if bind.dialect.name != 'postgresql':
+        op.create_index('ix_user_email_lower', 'user', [sa.text('lower(email)')], unique=False)
+        return
+
+    op.create_index('ix_user_email_lower', 'user', [sa.text('lower(email) text_pattern_ops')], unique=False)
+
+    # Optional substring search. Skipped when pg_trgm is not installed on the
+    # server or this role may not create it; the admin search then matches prefixes only.
+    available = bind.execute(sa.text("SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm'")).first()
+    if available is None:
+        return
+    try:
+        with bind.begin_nested():
+            bind.execute(sa.text('CREATE EXTENSION IF NOT EXISTS pg_trgm'))
+    except sa.exc.DBAPIError:
+        return
+    op.create_index('ix_user_email_trgm', 'user', [sa.text('lower(email) gin_trgm_ops')],
+                    unique=False, postgresql_using='gin')
+
+
+def downgrade():
+    # pg_trgm is left installed; other objects may use it
+    op.execute('DROP INDEX IF EXISTS ix_user_email_trgm')
+    op.drop_index('ix_user_email_lower', table_name='user')
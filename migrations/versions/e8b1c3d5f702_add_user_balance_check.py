@@ -0,0 +1,39 @@
+"""add non-negative balance check to user
+
+Revision ID: e8b1c3d5f702
+Revises: d2f6a9c41e73
+Create Date: 2026-10-17 09:12:30.482751
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e8b1c3d5f702'
+down_revision = 'd2f6a9c41e73'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Admins could set negative balances before this check existed. Stop with the offending
+    # ids instead of a bare constraint error, so they can be settled (e.g. via the admin
+    # balance form) before the deploy is retried.
+    negative = op.get_bind().execute(
+        sa.text('SELECT id, balance FROM "user" WHERE balance < 0 ORDER BY id')
+    ).fetchall()
+    if negative:
+        rows = ', '.join(f'#{user_id} ({balance})' for user_id, balance in negative)
+        raise RuntimeError(
+            f"Cannot add ck_user_balance_non_negative: {len(negative)} user(s) have a negative balance "
+            f"in cents: {rows}. Bring these balances to zero or above, then run the upgrade again."
+        )
+
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.create_check_constraint('ck_user_balance_non_negative', 'balance >= 0')
+
+
+def downgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.drop_constraint('ck_user_balance_non_negative', type_='check')
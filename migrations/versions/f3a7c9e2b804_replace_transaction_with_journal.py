@@ -0,0 +1,276 @@
+"""replace transaction rows with journal entries and legs
+
+Revision ID: f3a7c9e2b804
+Revises: e8b1c3d5f702
+Create Date: 2026-10-17 13:40:18.905512
+
+"""
+import re
+from collections import namedtuple
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f3a7c9e2b804'
+down_revision = 'e8b1c3d5f702'
+branch_labels = None
+depends_on = None
+
+CHUNK_SIZE = 5000
+LEGACY = 99
+
+# Frozen copy of JournalLeg.TYPES at this revision: code -> (old transaction_type, description template)
+LEG_TYPES = {
+    1: ('WELCOME_BONUS', 'Bonus selamat datang'),
+    2: ('BONUS', 'Bonus login harian'),
+    3: ('KEY_PURCHASE', 'Pembelian API Key {reference}'),
+    4: ('TRANSFER_OUT', 'Transfer ke {counterparty}'),
+    5: ('TRANSFER_IN', 'Transfer dari {counterparty}'),
+    6: ('PAYER_FEE', 'Biaya layanan transfer ke {counterparty}'),
+    7: ('ADMIN_FEE', 'Biaya admin dari transfer (sisi penerima: {counterparty})'),
+    8: ('ADMIN_FEE', 'Biaya layanan dari transfer (sisi pengirim: {counterparty})'),
+    9: ('PAYMENT_OUT', 'Pembayaran ke {reference}'),
+    10: ('PAYMENT_IN', 'Pembayaran dari {counterparty}'),
+    11: ('PAYER_FEE', 'Biaya layanan pembayaran ke {reference}'),
+    12: ('ADMIN_FEE', 'Biaya admin dari pembayaran (sisi merchant: {counterparty})'),
+    13: ('ADMIN_FEE', 'Biaya layanan dari pembayaran (sisi pembayar: {counterparty})'),
+    14: ('SPLIT_BILL_OUT', "Bayar patungan: '{reference}'"),
+    15: ('SPLIT_BILL_IN', "Terima patungan dari {counterparty} untuk '{reference}'"),
+    16: ('INBOUND_DEPOSIT', 'Inbound top up dari {counterparty} (Ref: {reference})'),
+    17: ('INBOUND_PAYMENT', 'Inbound payment ke {counterparty} (Ref: {reference})'),
+    18: ('ADMIN_CREDIT', 'Admin: {reference}'),
+    19: ('ADMIN_DEBIT', 'Admin: {reference}'),
+    20: ('SYSTEM_WITHDRAWAL', 'Penarikan dana ke akun admin {counterparty}'),
+    21: ('ADMIN_DEPOSIT', 'Deposit dana dari Akun Kas Sistem'),
+    22: ('GACHA_PLAY', "Bermain Gacha: Mendapatkan '{reference}'"),
+}
+
+_PLACEHOLDER = re.compile(r'\{(counterparty|reference)\}')
+
+def _template_regex(template):
+    parts = _PLACEHOLDER.split(template)
+    # split() alternates literal text and placeholder names
+    pattern = ''.join(re.escape(p) if i % 2 == 0 else f'(?P<{p}>.*)' for i, p in enumerate(parts))
+    return re.compile(f'^{pattern}$', re.DOTALL)
+
+_CANDIDATES = {}  # old transaction_type -> [(code, template, regex)]
+for _code, (_name, _template) in LEG_TYPES.items():
+    _CANDIDATES.setdefault(_name, []).append((_code, _template, _template_regex(_template)))
+
+Parsed = namedtuple('Parsed', ['leg_type', 'counterparty_id', 'reference', 'memo'])
+
+def _parse_row(row, emails, ids_by_email):
+    """Maps an old transaction row to a leg type, counterparty and reference that render its description exactly."""
+    candidates = _CANDIDATES.get(row.transaction_type)
+    if not candidates:
+        return Parsed(LEGACY, row.counterparty_id, row.transaction_type, row.description)
+
+    description = row.description or ''
+    for code, template, regex in candidates:
+        match = regex.match(description)
+        if not match:
+            continue
+        groups = match.groupdict()
+        # None when the template has no reference, so the leg can share any payment entry
+        reference = groups.get('reference')
+        counterparty_id = row.counterparty_id
+        if 'counterparty' in groups and emails.get(counterparty_id) != groups['counterparty']:
+            # Fee rows were written with no counterparty (or the system account); use the email in the text
+            counterparty_id = ids_by_email.get(groups['counterparty'], counterparty_id)
+        rendered = template.format(
+            counterparty=emails.get(counterparty_id, '-'),
+            reference=reference or ''
+        )
+        if rendered == description and (reference is None or len(reference) <= 150):
+            return Parsed(code, counterparty_id, reference, None)
+
+    # Known type with a description we cannot reproduce: keep the text verbatim
+    return Parsed(candidates[0][0], row.counterparty_id, None, description)
+
+
+def _sql_literal(text):
+    return "'" + text.replace("'", "''") + "'"
+
+def _description_sql(template):
+    parts = _PLACEHOLDER.split(template)
+    pieces = []
+    for i, part in enumerate(parts):
+        if i % 2 == 0:
+            if part:
+                pieces.append(_sql_literal(part))
+        elif part == 'counterparty':
+            pieces.append("COALESCE(c.email, '-')")
+        else:
+            pieces.append("COALESCE(e.reference, '')")
+    return ' || '.join(pieces)
+
+def _create_compat_view():
+    type_cases = ' '.join(f"WHEN {code} THEN {_sql_literal(name)}" for code, (name, _) in LEG_TYPES.items())
+    description_cases = ' '.join(
+        f"WHEN {code} THEN {_description_sql(template)}" for code, (_, template) in LEG_TYPES.items()
+    )
+    op.execute(
+        'CREATE VIEW "transaction" AS SELECT '
+        'l.id AS id, l.account_id AS user_id, e.payment_id AS payment_id, '
+        f'CASE l.leg_type {type_cases} ELSE e.reference END AS transaction_type, '
+        'l.amount AS amount, l.counterparty_id AS counterparty_id, '
+        f'COALESCE(e.memo, CASE l.leg_type {description_cases} END) AS description, '
+        'e.created_at AS "timestamp" '
+        'FROM journal_leg l JOIN journal_entry e ON e.id = l.entry_id '
+        'LEFT OUTER JOIN "user" c ON c.id = l.counterparty_id'
+    )
+
+
+def upgrade():
+    # ### commands auto generated by Alembic - please adjust! ###
+    op.create_table('journal_entry',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('payment_id', sa.Integer(), nullable=True),
+    sa.Column('reference', sa.String(length=150), nullable=True),
+    sa.Column('memo', sa.String(length=255), nullable=True),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['payment_id'], ['payment.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_table('journal_leg',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('entry_id', sa.Integer(), nullable=False),
+    sa.Column('account_id', sa.Integer(), nullable=False),
+    sa.Column('counterparty_id', sa.Integer(), nullable=True),
+    sa.Column('leg_type', sa.SmallInteger(), nullable=False),
+    sa.Column('amount', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['account_id'], ['user.id'], ),
+    sa.ForeignKeyConstraint(['counterparty_id'], ['user.id'], ),
+    sa.ForeignKeyConstraint(['entry_id'], ['journal_entry.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    with op.batch_alter_table('journal_leg', schema=None) as batch_op:
+        batch_op.create_index('ix_journal_leg_account_id', ['account_id', 'id'], unique=False)
+
+    # ### end Alembic commands ###
+
+    _backfill_journal()
+
+    op.drop_table('transaction')
+    # Old reporting queries keep working against a read-only view with the same columns
+    _create_compat_view()
+
+
+def _backfill_journal():
+    """
+    Converts transaction rows in id order. Legs keep the old transaction ids.
+    Rows of one payment share an entry when their descriptions parse cleanly;
+    any row that does not round-trip gets its own entry with the old text as memo.
+    """
+    bind = op.get_bind()
+    transaction = sa.table('transaction',
+        sa.column('id', sa.Integer), sa.column('user_id', sa.Integer), sa.column('payment_id', sa.Integer),
+        sa.column('transaction_type', sa.String), sa.column('amount', sa.Integer),
+        sa.column('counterparty_id', sa.Integer), sa.column('description', sa.String),
+        sa.column('timestamp', sa.DateTime)
+    )
+    journal_entry = sa.table('journal_entry',
+        sa.column('id', sa.Integer), sa.column('payment_id', sa.Integer), sa.column('reference', sa.String),
+        sa.column('memo', sa.String), sa.column('created_at', sa.DateTime)
+    )
+    journal_leg = sa.table('journal_leg',
+        sa.column('id', sa.Integer), sa.column('entry_id', sa.Integer), sa.column('account_id', sa.Integer),
+        sa.column('counterparty_id', sa.Integer), sa.column('leg_type', sa.SmallInteger), sa.column('amount', sa.Integer)
+    )
+
+    emails = dict(bind.execute(sa.text('SELECT id, email FROM "user"')).fetchall())
+    ids_by_email = {email: user_id for user_id, email in emails.items()}
+
+    next_entry_id = 1
+    payment_entries = {}  # payment_id -> (entry_id, reference), kept across chunks
+    last_id = 0
+    while True:
+        rows = bind.execute(
+            sa.select(transaction).where(transaction.c.id > last_id).order_by(transaction.c.id).limit(CHUNK_SIZE)
+        ).fetchall()
+        if not rows:
+            break
+        last_id = rows[-1].id
+
+        entries, legs = [], []
+        for row in rows:
+            parsed = _parse_row(row, emails, ids_by_email)
+            entry_id = None
+            if row.payment_id is not None and parsed.memo is None:
+                shared = payment_entries.get(row.payment_id)
+                if shared is None:
+                    payment_entries[row.payment_id] = (next_entry_id, parsed.reference)
+                elif shared[1] == parsed.reference or parsed.reference is None:
+                    entry_id = shared[0]
+                elif shared[1] is None:
+                    # First leg of the payment had no reference (e.g. PAYMENT_IN); adopt this one
+                    entry_id = shared[0]
+                    payment_entries[row.payment_id] = (entry_id, parsed.reference)
+                    bind.execute(journal_entry.update().where(journal_entry.c.id == entry_id)
+                                 .values(reference=parsed.reference))
+                    for entry in entries:
+                        if entry['id'] == entry_id:
+                            entry['reference'] = parsed.reference
+            if entry_id is None:
+                entry_id = next_entry_id
+                next_entry_id += 1
+                entries.append({
+                    'id': entry_id, 'payment_id': row.payment_id, 'reference': parsed.reference,
+                    'memo': parsed.memo, 'created_at': row.timestamp
+                })
+            legs.append({
+                'id': row.id, 'entry_id': entry_id, 'account_id': row.user_id,
+                'counterparty_id': parsed.counterparty_id, 'leg_type': parsed.leg_type, 'amount': row.amount
+            })
+
+        if entries:
+            bind.execute(journal_entry.insert(), entries)
+        bind.execute(journal_leg.insert(), legs)
+
+    if bind.dialect.name == 'postgresql':
+        for table in ('journal_entry', 'journal_leg'):
+            op.execute(
+                f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), "
+                f"COALESCE((SELECT MAX(id) FROM {table}), 0) + 1, false)"
+            )
+
+
+def downgrade():
+    # Rebuild the old table from the view before dropping the journal it reads from
+    op.create_table('transaction_restored',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('payment_id', sa.Integer(), nullable=True),
+    sa.Column('transaction_type', sa.String(length=20), nullable=False),
+    sa.Column('amount', sa.Integer(), nullable=False),
+    sa.Column('counterparty_id', sa.Integer(), nullable=True),
+    sa.Column('description', sa.String(length=255), nullable=True),
+    sa.Column('timestamp', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['counterparty_id'], ['user.id'], ),
+    sa.ForeignKeyConstraint(['payment_id'], ['payment.id'], name='fk_transaction_payment_id_payment'),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.execute(
+        'INSERT INTO transaction_restored '
+        '(id, user_id, payment_id, transaction_type, amount, counterparty_id, description, "timestamp") '
+        'SELECT id, user_id, payment_id, COALESCE(transaction_type, \'LAINNYA\'), amount, counterparty_id, '
+        'SUBSTR(description, 1, 255), "timestamp" FROM "transaction"'
+    )
+    op.execute('DROP VIEW "transaction"')
+    op.rename_table('transaction_restored', 'transaction')
+    with op.batch_alter_table('transaction', schema=None) as batch_op:
+        batch_op.create_index('ix_transaction_user_timestamp_id', ['user_id', 'timestamp', 'id'], unique=False)
+
+    if op.get_bind().dialect.name == 'postgresql':
+        op.execute(
+            "SELECT setval(pg_get_serial_sequence('transaction', 'id'), "
+            "COALESCE((SELECT MAX(id) FROM \"transaction\"), 0) + 1, false)"
+        )
+
+    with op.batch_alter_table('journal_leg', schema=None) as batch_op:
+        batch_op.drop_index('ix_journal_leg_account_id')
+
+    op.drop_table('journal_leg')
+    op.drop_table('journal_entry')